@@ -24,6 +24,7 @@ REQUIRED_PKGS = [
     "regex>=2022.7.9",
     "requests",
     "responses>=0.18.0",
+    "safetensors",
     "scipy>=1.10.1",
     "sentencepiece>=0.1.96",
     "six>=1.16.0",
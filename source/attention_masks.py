@@ -0,0 +1,206 @@
+# Copyright (C) 2024. Huawei Technologies Co., Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+
+import math
+import logging
+from typing import Dict, Optional, Tuple
+import torch
+from torch import nn
+
+
+logger = logging.getLogger(__name__)
+
+ATTENTION_BACKENDS = ('eager', 'sdpa')
+
+# (window_size, device) -> boolean causal mask over the positions, shared by all the attention layers
+_CAUSAL_MASKS: Dict[Tuple[Optional[int], torch.device], torch.BoolTensor] = {}
+
+
+def shared_causal_mask(
+    query_length: int,
+    key_length: int,
+    window_size: Optional[int] = None,
+    device: Optional[torch.device] = None
+) -> torch.BoolTensor:
+    """
+    Causal mask of the last `query_length` of `key_length` positions, restricted to the last `window_size` positions
+    of every query for local attention. This replaces the `(max_positions, max_positions)` `bias` buffer every
+    attention layer used to register: one mask per window size and device is built on first use, grown to the longest
+    sequence seen, and all layers slice views of it.
+
+    Returns:
+        `torch.BoolTensor` of shape `(1, 1, query_length, key_length)`
+    """
+    device = torch.device(device) if device is not None else torch.device('cpu')
+    mask = _CAUSAL_MASKS.get((window_size, device))
+    if mask is None or mask.size(-1) < key_length:
+        size = 1 << max(key_length - 1, 0).bit_length()  # grown by powers of two
+        positions = torch.arange(size, device=device)
+        distance = positions[:, None] - positions[None, :]
+        mask = distance >= 0
+        if window_size is not None:
+            mask = mask & (distance < window_size)
+        _CAUSAL_MASKS[(window_size, device)] = mask
+    return mask[None, None, key_length - query_length: key_length, :key_length]
+
+
+def packed_attention_mask(
+    segment_ids: torch.LongTensor,
+    prefix_lm_mask: Optional[torch.Tensor] = None,
+    query_length: Optional[int] = None
+) -> torch.BoolTensor:
+    """
+    Attention mask of packed documents, built on the fly from their per-position descriptions instead of a dense
+    `(batch_size, seq_length, seq_length)` mask from the collator: a position attends causally to the positions of its
+    own document, and bidirectionally inside the prefix of its document with `prefix_lm_mask`.
+
+    Args:
+        segment_ids (`torch.LongTensor` of shape `(batch_size, key_length)`):
+            Index of the document of every position in its packed sequence, -1 for padding (which attends to nothing)
+        prefix_lm_mask (`torch.BoolTensor` of shape `(batch_size, key_length)`, *optional*):
+            Whether every position is in the prefix of its document
+        query_length (`int`, *optional*):
+            Number of query positions, the last ones of the sequence (all of them by default)
+
+    Returns:
+        `torch.BoolTensor` of shape `(batch_size, 1, query_length, key_length)`, `True` where attention is allowed
+    """
+    key_length = segment_ids.size(-1)
+    query_length = query_length or key_length
+    query_segments = segment_ids[:, -query_length:, None]
+
+    query_positions = torch.arange(key_length - query_length, key_length, device=segment_ids.device)[:, None]
+    key_positions = torch.arange(key_length, device=segment_ids.device)[None, :]
+    allowed = key_positions <= query_positions
+    if prefix_lm_mask is not None:
+        prefix_lm_mask = prefix_lm_mask.bool()
+        allowed = allowed | (prefix_lm_mask[:, -query_length:, None] & prefix_lm_mask[:, None, :])
+
+    allowed = allowed & (query_segments == segment_ids[:, None, :]) & (query_segments >= 0)
+    return allowed[:, None, :, :]
+
+
+def build_prefix_key_mask(
+    prefix_lm_mask: torch.LongTensor,
+    key_length: int,
+    cached: Optional[torch.BoolTensor] = None
+) -> torch.BoolTensor:
+    """
+    Keys every query attends to bidirectionally at generation, those up to the prefix index of their sequence.
+    `cached` is the mask of the previous decoding step, which is extended by the columns of the new keys only.
+
+    Args:
+        prefix_lm_mask (`torch.LongTensor` of shape `(batch_size,)`):
+            Index of the last prefix position of every sequence
+        key_length (`int`):
+            Number of keys, cached and new ones
+        cached (`torch.BoolTensor` of shape `(batch_size, cached_length)`, *optional*):
+            Mask of the first `cached_length <= key_length` keys
+
+    Returns:
+        `torch.BoolTensor` of shape `(batch_size, key_length)`
+    """
+    start = 0 if cached is None or cached.size(-1) > key_length else cached.size(-1)
+    if start == key_length:
+        return cached
+    positions = torch.arange(start, key_length, device=prefix_lm_mask.device)
+    new_keys = positions[None, :] <= prefix_lm_mask[:, None]
+    return new_keys if start == 0 else torch.cat([cached, new_keys], dim=-1)
+
+
+def sliding_window_mask(
+    key_positions: torch.LongTensor,
+    query_positions: torch.LongTensor,
+    window_size: int,
+    prefix_lm_mask: Optional[torch.Tensor] = None
+) -> torch.BoolTensor:
+    """
+    Mask of a local attention layer whose keys are not the whole sequence but the states of a sliding window cache,
+    found at `key_positions`: every query attends to the keys of the last `window_size` positions up to its own,
+    and to all the keys of the prefix.
+
+    Args:
+        key_positions (`torch.LongTensor` of shape `(key_length,)`):
+            Position of every key in the sequence, -1 for empty slots (which nothing attends to)
+        query_positions (`torch.LongTensor` of shape `(query_length,)`):
+            Position of every query in the sequence
+        window_size (`int`):
+            Number of positions a query attends to, including its own
+        prefix_lm_mask (`torch.Tensor`, *optional*):
+            Index of the last prefix position of every sequence, of shape `(batch_size,)`, or the
+            `(batch_size, sequence_length)` mask of the prefix keys (see `build_prefix_key_mask`)
+
+    Returns:
+        `torch.BoolTensor` of shape `(batch_size or 1, 1, query_length, key_length)`
+    """
+    valid = key_positions >= 0
+    distance = query_positions[:, None] - key_positions[None, :]
+    allowed = (valid & (distance >= 0) & (distance < window_size))[None, None, :, :]
+    if prefix_lm_mask is not None:
+        if len(prefix_lm_mask.size()) == 1:
+            prefix_keys = key_positions[None, :] <= prefix_lm_mask[:, None]
+        else:
+            prefix_keys = prefix_lm_mask[:, key_positions.clamp(min=0)]
+        allowed = allowed | (valid & prefix_keys)[:, None, None, :]
+    return allowed
+
+
+def sdpa_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    mask: Optional[torch.BoolTensor] = None,
+    padding_mask: Optional[torch.Tensor] = None,
+    scale: float = 1.0,
+    dropout_p: float = 0.0,
+    is_causal: bool = False
+) -> torch.Tensor:
+    """
+    Attention through `torch.nn.functional.scaled_dot_product_attention`, which fuses the score matrix, softmax and
+    second matmul. `mask` is the boolean mask of the allowed positions (causal, local, packed and prefix-LM, as built
+    by the eager `_attn`), `padding_mask` the additive `(batch_size, 1, 1, key_length)` mask of padded keys. Both are
+    combined into one additive mask, so that rows without any allowed position stay finite as in the eager path.
+    Scores are multiplied by `scale` (the kernel itself divides them by the square root of the head size).
+    """
+    query = query * (scale * math.sqrt(query.size(-1)))
+    attn_mask = None
+    if mask is not None:
+        attn_mask = torch.zeros(mask.shape, dtype=query.dtype, device=query.device)
+        attn_mask = attn_mask.masked_fill(~mask, torch.finfo(query.dtype).min / 2)
+    if padding_mask is not None:
+        padding_mask = padding_mask.to(query.dtype)
+        attn_mask = padding_mask if attn_mask is None else attn_mask + padding_mask
+    return nn.functional.scaled_dot_product_attention(
+        query, key, value, attn_mask=attn_mask, dropout_p=dropout_p, is_causal=is_causal and attn_mask is None
+    )
+
+
+def set_attention_backend(model: nn.Module, backend: str) -> str:
+    """
+    Selects the attention implementation of all the attention layers of `model`: `eager` (the reference, which also
+    returns attention weights) or `sdpa` (`scaled_dot_product_attention`, torch >= 2.0, numerically close but not
+    bitwise identical). Layers fall back to `eager` when attention weights or a head mask are requested.
+    """
+    if backend not in ATTENTION_BACKENDS:
+        raise ValueError(f"Unknown attention backend {backend}, choose from {ATTENTION_BACKENDS}")
+    if backend == 'sdpa' and not hasattr(nn.functional, 'scaled_dot_product_attention'):
+        logger.warning(f"scaled_dot_product_attention needs torch >= 2.0 (found {torch.__version__}), using eager")
+        backend = 'eager'
+
+    for module in model.modules():
+        if hasattr(module, 'attention_backend'):
+            module.attention_backend = backend
+    model.config.attention_backend = backend
+    return backend
@@ -0,0 +1,1310 @@
+# Copyright (C) 2024. Huawei Technologies Co., Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+
+"""
+Micro-benchmarks of the generation and training code paths, run on small randomly initialised models so that they
+do not need a checkpoint, e.g.
+
+    python benchmark.py --benchmark fan_out --model_type pangu --num_samples 200
+"""
+
+import os
+import copy
+import time
+import tempfile
+import logging
+from types import SimpleNamespace
+from dataclasses import dataclass, field, replace
+import numpy as np
+import torch
+from transformers import HfArgumentParser, set_seed
+from pangu_alpha import PanguAlphaConfig, PanguAlphaModel
+from gpt_neo import GPTNeoConfig, GPTNeoForCausalLM
+from pangu_alpha.generation_utils import SpeculativeDecodingStats, StaticKVCache
+from vocab_partition import VocabPartition, ReplicatedTokensRemapper
+from custom_collator import create_attn_masks_and_pos, create_segment_ids_and_pos
+from attention_masks import set_attention_backend, build_prefix_key_mask, shared_causal_mask
+from quantization import quantize_model, save_quantized_model, load_quantized_model, QUANTIZED_WEIGHTS_NAME
+from compilation import compile_model, eager_forward
+from fast_loading import save_safetensors_model, load_safetensors_model, SAFETENSORS_WEIGHTS_NAME
+from layer_streaming import stream_layers, streamed_blocks
+
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+
+BENCHMARKS = {}
+
+
+def register_benchmark(name):
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+@dataclass
+class BenchmarkArguments:
+    benchmark: str = field(default='fan_out', metadata={"help": "Which benchmark to run"})
+    model_type: str = field(default='pycodegpt', metadata={"help": "Model type (pycodegpt or pangu)"})
+    vocab_size: int = field(default=8192, metadata={"help": "Vocabulary size of the random model"})
+    hidden_size: int = field(default=256, metadata={"help": "Hidden size of the random model"})
+    num_layers: int = field(default=4, metadata={"help": "Number of layers of the random model"})
+    num_heads: int = field(default=8, metadata={"help": "Number of attention heads of the random model"})
+    max_positions: int = field(default=1024, metadata={"help": "Maximum sequence length of the random model"})
+    window_size: int = field(default=128, metadata={"help": "Window of the local attention layers of GPT-Neo"})
+    prompt_length: int = field(default=256, metadata={"help": "Number of prompt tokens"})
+    max_new_tokens: int = field(default=32, metadata={"help": "Max new tokens, excluding prompt"})
+    num_samples: int = field(default=64, metadata={"help": "Number of sequences per prompt"})
+    batch_size: int = field(default=16, metadata={"help": "Batch size"})
+    draft_num_layers: int = field(default=1, metadata={"help": "Number of layers of the random draft model"})
+    num_draft_tokens: int = field(default=4, metadata={"help": "Tokens proposed by the draft model per step"})
+    prompt_lookup_ngram_size: int = field(default=3, metadata={"help": "Longest n-gram looked up in the sequence"})
+    num_examples: int = field(default=1000000, metadata={"help": "Number of tokenized examples to remap"})
+    example_length: int = field(default=64, metadata={"help": "Average number of tokens of the remapped examples"})
+    repeats: int = field(default=3, metadata={"help": "Number of timed repetitions"})
+    seed: int = field(default=1234, metadata={"help": "Seed"})
+    no_cuda: bool = field(default=False, metadata={"help": ""})
+
+
+class _VocabStub:
+    """
+    Stands in for the tokenizer in the model constructors, which only need its length
+    """
+    def __init__(self, vocab_size):
+        self.vocab_size = vocab_size
+
+    def __len__(self):
+        return self.vocab_size
+
+
+def build_random_model(args, model_args=None):
+    if model_args is None:
+        model_args = SimpleNamespace(replicated_tokens_map=None)
+
+    if args.model_type == 'pangu':
+        config = PanguAlphaConfig(
+            vocab_size=args.vocab_size,
+            n_positions=args.max_positions,
+            n_embd=args.hidden_size,
+            n_layer=args.num_layers,
+            n_head=args.num_heads,
+        )
+        model = PanguAlphaModel(config, args=model_args, tokenizer=_VocabStub(args.vocab_size))
+    else:
+        config = GPTNeoConfig(
+            vocab_size=args.vocab_size,
+            max_position_embeddings=args.max_positions,
+            hidden_size=args.hidden_size,
+            num_layers=args.num_layers,
+            # alternating global and local layers, an odd last one is global
+            attention_types=[[["global", "local"], args.num_layers // 2]] + [[["global"], args.num_layers % 2]],
+            num_heads=args.num_heads,
+            window_size=args.window_size,
+        )
+        model = GPTNeoForCausalLM(config, args=model_args, tokenizer=_VocabStub(args.vocab_size))
+
+    device = torch.device('cpu') if args.no_cuda or not torch.cuda.is_available() else torch.device('cuda')
+    return model.to(device).eval()
+
+
+def forward_flops(model, num_tokens, context_length):
+    """
+    Approximate forward FLOPs for `num_tokens` tokens attending to `context_length` positions
+    (2 x non-embedding parameters + 2 x layers x context x hidden, per token)
+    """
+    num_params = sum(
+        p.numel() for name, p in model.named_parameters() if 'wte' not in name and 'wpe' not in name
+    )
+    config = model.config
+    return num_tokens * (2 * num_params + 2 * config.num_hidden_layers * context_length * config.hidden_size)
+
+
+def timed(function, repeats, device):
+    times = []
+    result = None
+    for _ in range(repeats):
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start_time = time.time()
+        result = function()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time.time() - start_time)
+    return min(times), result
+
+
+def peak_memory(function, device):
+    """
+    Runs `function` and returns its result and the peak of allocated memory in bytes during the call (CUDA only,
+    `None` on CPU)
+    """
+    if device.type != 'cuda':
+        return function(), None
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats(device)
+    baseline = torch.cuda.memory_allocated(device)
+    result = function()
+    torch.cuda.synchronize()
+    return result, torch.cuda.max_memory_allocated(device) - baseline
+
+
+@register_benchmark('fan_out')
+def benchmark_fan_out(args):
+    """
+    Prefilling the prompt once per task and fanning the cache out to all samples, against the `sample_no` loop of
+    `generation.py` that prefills the prompt for every sample. Rows whose first token is eos have to be padded after
+    it, like `sample` pads finished rows.
+    """
+    model = build_random_model(args)
+    device = model.device
+    input_ids = torch.randint(1, args.vocab_size - 1, (1, args.prompt_length), device=device)
+    generate_kwargs = dict(
+        do_sample=True,
+        top_k=0,
+        top_p=0.9,
+        pad_token_id=0,
+        eos_token_id=args.vocab_size - 1,
+        sample_replacement=True
+    )
+
+    def batched():
+        outputs = []
+        for start in range(0, args.num_samples, args.batch_size):
+            batch_size = min(args.batch_size, args.num_samples - start)
+            outputs.append(model.generate(
+                input_ids=input_ids.expand(batch_size, -1),
+                attention_mask=torch.ones((batch_size, args.prompt_length), dtype=torch.long, device=device),
+                max_new_tokens=args.max_new_tokens,
+                **generate_kwargs
+            ))
+        return outputs
+
+    def fan_out(**kwargs):
+        return list(model.generate_fan_out(
+            input_ids,
+            num_samples=args.num_samples,
+            chunk_size=args.batch_size,
+            max_new_tokens=args.max_new_tokens,
+            **dict(generate_kwargs, **kwargs)
+        ))
+
+    def prefill(batch_size):
+        def run():
+            return model(input_ids=input_ids.expand(batch_size, -1), use_cache=True)
+        return run
+
+    with torch.no_grad():
+        batched_time, batched_outputs = timed(batched, args.repeats, device)
+        fan_out_time, fan_out_outputs = timed(fan_out, args.repeats, device)
+
+        num_chunks = (args.num_samples + args.batch_size - 1) // args.batch_size
+        batched_prefill_time = 0.0
+        for start in range(0, args.num_samples, args.batch_size):
+            batched_prefill_time += timed(
+                prefill(min(args.batch_size, args.num_samples - start)), args.repeats, device
+            )[0]
+        fan_out_prefill_time, _ = timed(prefill(1), args.repeats, device)
+
+        # same seed, so the same first tokens: the first sample (at least) is finished by its first token
+        set_seed(args.seed)
+        first_token = int(fan_out()[0][0, args.prompt_length])
+        set_seed(args.seed)
+        eos_outputs = fan_out(eos_token_id=first_token)
+
+    assert sum(output.size(0) for output in fan_out_outputs) == args.num_samples
+    assert all(output.size(-1) <= args.prompt_length + args.max_new_tokens for output in fan_out_outputs)
+    assert all(torch.equal(output[:, :args.prompt_length], input_ids.expand(output.size(0), -1))
+               for output in batched_outputs + fan_out_outputs)
+    assert eos_outputs[0][0, args.prompt_length] == first_token
+    for output in eos_outputs:
+        is_eos = (output[:, args.prompt_length:] == first_token).long()
+        after_eos = (is_eos.cumsum(dim=-1) - is_eos) > 0
+        assert (output[:, args.prompt_length:][after_eos] == 0).all(), "tokens generated after the eos of a row"
+
+    batched_flops = forward_flops(model, args.num_samples * args.prompt_length, args.prompt_length)
+    fan_out_flops = forward_flops(model, args.prompt_length, args.prompt_length)
+
+    logger.info(f'{args.model_type}: prompt of {args.prompt_length} tokens, {args.num_samples} samples '
+                f'in {num_chunks} chunks of {args.batch_size}, {args.max_new_tokens} new tokens')
+    logger.info(f'prefill GFLOPs:  sample loop {batched_flops / 1e9:.2f}  fan-out {fan_out_flops / 1e9:.2f} '
+                f'({batched_flops / fan_out_flops:.1f}x)')
+    logger.info(f'prefill time:    sample loop {batched_prefill_time:.3f}s  fan-out {fan_out_prefill_time:.3f}s')
+    logger.info(f'end-to-end time: sample loop {batched_time:.3f}s  fan-out {fan_out_time:.3f}s '
+                f'({batched_time / fan_out_time:.2f}x)')
+
+
+@register_benchmark('static_cache')
+def benchmark_static_cache(args):
+    """
+    Decoding into a preallocated `StaticKVCache` against growing the tuple cache with `torch.cat`.
+    That both give the same outputs is checked by tests/test_static_cache.py.
+    """
+    model = build_random_model(args)
+    device = model.device
+    input_ids = torch.randint(1, args.vocab_size - 1, (args.batch_size, args.prompt_length), device=device)
+    generate_kwargs = dict(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        max_new_tokens=args.max_new_tokens,
+        do_sample=False,
+        pad_token_id=0,
+        eos_token_id=args.vocab_size - 1
+    )
+
+    with torch.no_grad():
+        dynamic_time, dynamic_outputs = timed(
+            lambda: model.generate(static_cache=False, **generate_kwargs), args.repeats, device
+        )
+        static_time, _ = timed(
+            lambda: model.generate(static_cache=True, **generate_kwargs), args.repeats, device
+        )
+
+    num_tokens = args.batch_size * (dynamic_outputs.size(-1) - args.prompt_length)
+    logger.info(f'{args.model_type}: batch of {args.batch_size}, prompt of {args.prompt_length} tokens, '
+                f'{args.max_new_tokens} new tokens')
+    logger.info(f'torch.cat cache: {dynamic_time:.3f}s ({num_tokens / dynamic_time:.1f} tokens/s)')
+    logger.info(f'static cache:    {static_time:.3f}s ({num_tokens / static_time:.1f} tokens/s)')
+
+
+@register_benchmark('speculative')
+def benchmark_speculative(args):
+    """
+    Speculative decoding with a small PyCodeGPT draft against plain decoding, greedy and sampled. With a copy of the
+    target that only differs on the padding fed to finished rows, shows the forward passes after a row finished
+    early. That speculation keeps the greedy outputs is checked by tests/test_speculative.py.
+    """
+    model = build_random_model(args)
+    draft_model = build_random_model(replace(args, model_type='pycodegpt', num_layers=args.draft_num_layers))
+    device = model.device
+    input_ids = torch.randint(1, args.vocab_size - 1, (args.batch_size, args.prompt_length), device=device)
+    generate_kwargs = dict(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        max_new_tokens=args.max_new_tokens,
+        pad_token_id=0,
+        eos_token_id=args.vocab_size - 1
+    )
+
+    with torch.no_grad():
+        greedy_time, greedy_outputs = timed(lambda: model.generate(do_sample=False, **generate_kwargs), args.repeats, device)
+        stats = SpeculativeDecodingStats()
+        speculative_time, _ = timed(
+            lambda: model.generate(
+                do_sample=False, draft_model=draft_model, num_draft_tokens=args.num_draft_tokens,
+                speculative_stats=stats, **generate_kwargs
+            ),
+            args.repeats,
+            device
+        )
+        # the second token of the first row ends it, the other rows go on
+        early_kwargs = dict(generate_kwargs, eos_token_id=int(greedy_outputs[0, args.prompt_length + 1]))
+        padding_draft = copy.deepcopy(model)
+        padding_noise = torch.randn(args.hidden_size, device=device)
+        padding_draft.transformer.wte.register_forward_hook(
+            lambda module, inputs, output: output + (inputs[0] == 0)[..., None] * padding_noise
+        )
+        early_stats = SpeculativeDecodingStats()
+        model.generate(
+            do_sample=False, draft_model=padding_draft, num_draft_tokens=args.num_draft_tokens,
+            speculative_stats=early_stats, **early_kwargs
+        )
+
+        sample_time, _ = timed(lambda: model.generate(do_sample=True, top_p=0.9, **generate_kwargs), args.repeats, device)
+        sample_stats = SpeculativeDecodingStats()
+        speculative_sample_time, _ = timed(
+            lambda: model.generate(
+                do_sample=True, top_p=0.9, draft_model=draft_model, num_draft_tokens=args.num_draft_tokens,
+                speculative_stats=sample_stats, **generate_kwargs
+            ),
+            args.repeats,
+            device
+        )
+
+    logger.info(f'{args.model_type} ({args.num_layers} layers) with a {args.draft_num_layers} layer draft, '
+                f'{args.num_draft_tokens} draft tokens')
+    logger.info(f'row finished after 2 tokens, drafting with the target: {early_stats.summary()}')
+    logger.info(f'greedy:   {stats.summary()}, {greedy_time:.3f}s -> {speculative_time:.3f}s '
+                f'({greedy_time / speculative_time:.2f}x)')
+    logger.info(f'sampling: {sample_stats.summary()}, {sample_time:.3f}s -> {speculative_sample_time:.3f}s '
+                f'({sample_time / speculative_sample_time:.2f}x)')
+
+
+@register_benchmark('prompt_lookup')
+def benchmark_prompt_lookup(args):
+    """
+    Prompt-lookup speculation against plain decoding. The prompt repeats a span of itself so that there is something
+    to copy. Also shows the forward passes after a row finished early, whose padding never matches what the model
+    predicts. That prompt lookup keeps the greedy outputs is checked by tests/test_speculative.py.
+    """
+    model = build_random_model(args)
+    device = model.device
+    span = torch.randint(1, args.vocab_size - 1, (args.batch_size, args.prompt_length // 4), device=device)
+    input_ids = torch.cat(
+        [span, torch.randint(1, args.vocab_size - 1, (args.batch_size, args.prompt_length // 2), device=device), span],
+        dim=-1
+    )
+    generate_kwargs = dict(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        max_new_tokens=args.max_new_tokens,
+        pad_token_id=0,
+        eos_token_id=args.vocab_size - 1
+    )
+
+    with torch.no_grad():
+        greedy_time, greedy_outputs = timed(lambda: model.generate(do_sample=False, **generate_kwargs), args.repeats, device)
+        stats = SpeculativeDecodingStats()
+        lookup_time, _ = timed(
+            lambda: model.generate(
+                do_sample=False, prompt_lookup_ngram_size=args.prompt_lookup_ngram_size,
+                num_draft_tokens=args.num_draft_tokens, speculative_stats=stats, **generate_kwargs
+            ),
+            args.repeats,
+            device
+        )
+
+        # the second token of the first row ends it, the other rows go on
+        early_kwargs = dict(generate_kwargs, eos_token_id=int(greedy_outputs[0, input_ids.size(-1) + 1]))
+        early_stats = SpeculativeDecodingStats()
+        model.generate(
+            do_sample=False, prompt_lookup_ngram_size=args.prompt_lookup_ngram_size,
+            num_draft_tokens=args.num_draft_tokens, speculative_stats=early_stats, **early_kwargs
+        )
+
+    logger.info(f'{args.model_type}: prompt of {input_ids.size(-1)} tokens, n-grams up to '
+                f'{args.prompt_lookup_ngram_size}, {args.num_draft_tokens} proposed tokens')
+    logger.info(f'greedy: {stats.summary()}, {greedy_time:.3f}s -> {lookup_time:.3f}s ({greedy_time / lookup_time:.2f}x)')
+    logger.info(f'row finished after 2 tokens: {early_stats.summary()}')
+    logger.info(f'per row acceptance of the last run: '
+                f'{[f"{a}/{p}" for a, p in zip(stats.row_accepted, stats.row_proposed)]}')
+
+
+@register_benchmark('lm_head')
+def benchmark_lm_head(args):
+    """
+    Prefill latency and peak memory with the vocabulary projection over all prompt positions against over the last
+    one only (`num_logits_to_keep=1`). The last logits have to be the same.
+    """
+    model = build_random_model(args)
+    device = model.device
+    input_ids = torch.randint(1, args.vocab_size - 1, (args.batch_size, args.prompt_length), device=device)
+
+    def prefill(num_logits_to_keep):
+        def run():
+            return model(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                use_cache=True,
+                return_dict=True,
+                num_logits_to_keep=num_logits_to_keep
+            ).logits
+        return run
+
+    with torch.no_grad():
+        full_time, _ = timed(prefill(None), args.repeats, device)
+        last_time, _ = timed(prefill(1), args.repeats, device)
+        full_logits, full_memory = peak_memory(prefill(None), device)
+        last_logits, last_memory = peak_memory(prefill(1), device)
+
+    assert last_logits.shape == (args.batch_size, 1, args.vocab_size)
+    assert torch.allclose(full_logits[:, -1:], last_logits, atol=1e-5), "the last logits differ"
+
+    logits_bytes = full_logits.numel() * full_logits.element_size()
+    logger.info(f'{args.model_type}: batch of {args.batch_size}, prompt of {args.prompt_length} tokens, '
+                f'vocabulary of {args.vocab_size} (full logits {logits_bytes / 2 ** 20:.1f} MB)')
+    logger.info(f'prefill time: all positions {full_time:.3f}s  last position {last_time:.3f}s '
+                f'({full_time / last_time:.2f}x)')
+    if full_memory is not None:
+        logger.info(f'peak memory:  all positions {full_memory / 2 ** 20:.1f} MB  '
+                    f'last position {last_memory / 2 ** 20:.1f} MB')
+
+
+@register_benchmark('compact_vocab')
+def benchmark_compact_vocab(args):
+    """
+    Decoding with a replicated vocabulary (the first half replicated into the second) over the full, masked logits
+    against over the compacted code vocabulary. That both give the same greedy outputs is checked by
+    tests/test_compact_vocab.py.
+    """
+    half = args.vocab_size // 2
+    model_args = SimpleNamespace(replicated_tokens_map={token_id: token_id + half for token_id in range(half)})
+    model = build_random_model(args, model_args=model_args)
+    device = model.device
+    input_ids = torch.randint(half, args.vocab_size - 1, (args.batch_size, args.prompt_length), device=device)
+    generate_kwargs = dict(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        max_new_tokens=args.max_new_tokens,
+        repetition_penalty=1.2,
+        pad_token_id=0,
+        eos_token_id=args.vocab_size - 1
+    )
+
+    with torch.no_grad():
+        full_time, _ = timed(lambda: model.generate(do_sample=True, top_p=0.9, **generate_kwargs), args.repeats, device)
+        model.compact_vocabulary()
+        compact_time, _ = timed(
+            lambda: model.generate(do_sample=True, top_p=0.9, **generate_kwargs), args.repeats, device
+        )
+
+    logger.info(f'{args.model_type}: vocabulary of {args.vocab_size}, {model.compact_token_ids.numel()} code tokens')
+    logger.info(f'top-p sampling: full vocabulary {full_time:.3f}s  compacted {compact_time:.3f}s '
+                f'({full_time / compact_time:.2f}x)')
+
+
+def _token_masks_loop(replicated_tokens_map, vocab_size):
+    """
+    Per-token construction of the code and docstring masks the model constructors used before `VocabPartition`
+    """
+    code_tokens_mask = torch.zeros((vocab_size,))
+    doc_tokens_mask = torch.zeros((vocab_size,))
+    for tok_id in range(0, vocab_size):
+        if tok_id in replicated_tokens_map:
+            code_tokens_mask[replicated_tokens_map[tok_id]] = 1
+            doc_tokens_mask[tok_id] = 1
+        elif (tok_id not in replicated_tokens_map.keys()) and (tok_id not in replicated_tokens_map.values()):
+            code_tokens_mask[tok_id] = 1
+            doc_tokens_mask[tok_id] = 1
+    return code_tokens_mask, doc_tokens_mask
+
+
+@register_benchmark('vocab_partition')
+def benchmark_vocab_partition(args):
+    """
+    Token masks of a fully separated vocabulary (`--separate_embeds`: every token replicated) built by the per-token
+    loop, from the replicated tokens map and from a saved `VocabPartition`, plus the model construction time.
+    The masks have to be identical.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        half = args.vocab_size // 2
+        replicated_tokens_map = {token_id: token_id + half for token_id in range(half)}
+        device = torch.device('cpu')
+
+        loop_time, loop_masks = timed(lambda: _token_masks_loop(replicated_tokens_map, args.vocab_size), 1, device)
+        map_time, partition = timed(
+            lambda: VocabPartition.from_replicated_tokens_map(replicated_tokens_map, args.vocab_size),
+            args.repeats, device
+        )
+        partition.save(directory)
+        load_time, loaded = timed(lambda: VocabPartition.load(directory), args.repeats, device)
+
+        for masks in (partition.token_masks(), loaded.token_masks()):
+            assert all(torch.equal(a, b) for a, b in zip(loop_masks, masks)), "the partition changes the token masks"
+        assert loaded.to_replicated_tokens_map() == replicated_tokens_map
+
+        model_args = SimpleNamespace(replicated_tokens_map=replicated_tokens_map, vocab_partition=loaded)
+        model_time, _ = timed(lambda: build_random_model(args, model_args=model_args), 1, device)
+
+    logger.info(f'vocabulary of {args.vocab_size}, {half} replicated tokens, masks identical')
+    logger.info(f'token masks: per-token loop {loop_time:.3f}s  from map {map_time:.4f}s  '
+                f'from saved partition {load_time:.4f}s ({loop_time / load_time:.0f}x)')
+    logger.info(f'{args.model_type} construction with the saved partition: {model_time:.3f}s')
+
+
+def _remap_loop(code_ids, new_id_map):
+    """
+    Per-token remapping the tokenization functions used before `ReplicatedTokensRemapper`
+    """
+    new_code_ids = []
+    for cid in code_ids:
+        if cid in new_id_map:
+            new_code_ids.append(new_id_map[cid])
+        else:
+            new_code_ids.append(cid)
+    return copy.deepcopy(new_code_ids)
+
+
+@register_benchmark('remap')
+def benchmark_remap(args):
+    """
+    Replacing the tokens of `num_examples` tokenized examples by their code replicas, in batches of 1000 as
+    `datasets.map` hands them to the tokenization functions: per-token dictionary lookups against one gather per batch
+    of lists and per Arrow column. The remapped ids have to be identical.
+    """
+    import pyarrow as pa
+
+    half = args.vocab_size // 2
+    replicated_tokens_map = {token_id: token_id + half for token_id in range(half)}
+    remapper = ReplicatedTokensRemapper(replicated_tokens_map, vocab_size=args.vocab_size)
+    rng = np.random.default_rng(args.seed)
+
+    loop_time, batch_time, arrow_time, num_tokens = 0.0, 0.0, 0.0, 0
+    for start in range(0, args.num_examples, 1000):
+        lengths = rng.integers(1, 2 * args.example_length, min(1000, args.num_examples - start))
+        flat = rng.integers(0, args.vocab_size, int(lengths.sum()))
+        batch = [chunk.tolist() for chunk in np.split(flat, np.cumsum(lengths)[:-1])]
+        column = pa.array(batch, type=pa.list_(pa.int64()))
+        num_tokens += len(flat)
+
+        start_time = time.time()
+        loop_ids = [_remap_loop(code_ids, replicated_tokens_map) for code_ids in batch]
+        loop_time += time.time() - start_time
+
+        start_time = time.time()
+        batch_ids = remapper.remap_batch(batch)
+        batch_time += time.time() - start_time
+
+        start_time = time.time()
+        arrow_ids = remapper.remap_arrow(column)
+        arrow_time += time.time() - start_time
+
+        assert batch_ids == loop_ids, "the remapper changes the ids of a batch of lists"
+        assert arrow_ids.to_pylist() == loop_ids, "the remapper changes the ids of an Arrow column"
+
+    logger.info(f'{args.num_examples} examples, {num_tokens} tokens, {half} replicated tokens, ids identical')
+    logger.info(f'per-token loop {loop_time:.2f}s  batch of lists {batch_time:.2f}s ({loop_time / batch_time:.1f}x)  '
+                f'Arrow column {arrow_time:.2f}s ({loop_time / arrow_time:.1f}x)')
+
+
+def random_packed_lengths(args, rng):
+    """
+    Document lengths and prefix indexes of `batch_size` packed sequences of up to `prompt_length` tokens, as
+    `concatenate_examples` builds them
+    """
+    lengths, prefix_token_idxs = [], []
+    for _ in range(args.batch_size):
+        row_lengths, row_prefixes = [], []
+        while True:
+            length = int(rng.integers(16, max(17, args.prompt_length // 2)))
+            if sum(row_lengths) + length > args.prompt_length:
+                break
+            row_lengths.append(length)
+            row_prefixes.append(int(rng.integers(1, length - 1)))
+        lengths.append(row_lengths or [args.prompt_length])
+        prefix_token_idxs.append(row_prefixes or [args.prompt_length // 2])
+    return lengths, prefix_token_idxs
+
+
+@register_benchmark('packed_masks')
+def benchmark_packed_masks(args):
+    """
+    Training batches of packed documents with the dense `(batch, length, length)` attention and prefix masks of the
+    collator against per-position segment ids and prefix flags expanded in the attention layers. Logits of the
+    non-padding positions have to match.
+    """
+    lengths, prefix_token_idxs = random_packed_lengths(args, np.random.default_rng(args.seed))
+    model = build_random_model(args)
+    device = model.device
+    input_ids = torch.randint(1, args.vocab_size, (args.batch_size, max(sum(row) for row in lengths)))
+
+    dense_time, (attention_mask, position_ids, prefix_mask) = timed(
+        lambda: create_attn_masks_and_pos(lengths, prefix_token_idxs), args.repeats, torch.device('cpu')
+    )
+    packed_time, (segment_ids, packed_position_ids, prefix_flags) = timed(
+        lambda: create_segment_ids_and_pos(lengths, prefix_token_idxs), args.repeats, torch.device('cpu')
+    )
+    assert torch.equal(position_ids, packed_position_ids), "the packed collation changes the position ids"
+    dense_bytes = sum(t.numel() * t.element_size() for t in (attention_mask, prefix_mask))
+    packed_bytes = sum(t.numel() * t.element_size() for t in (segment_ids, prefix_flags))
+
+    with torch.no_grad():
+        dense_logits = model(
+            input_ids=input_ids.to(device),
+            attention_mask=attention_mask.to(device),
+            position_ids=position_ids.to(device),
+            prefix_lm_mask=prefix_mask.to(device)
+        ).logits
+        packed_logits = model(
+            input_ids=input_ids.to(device),
+            segment_ids=segment_ids.to(device),
+            position_ids=position_ids.to(device),
+            prefix_lm_mask=prefix_flags.to(device)
+        ).logits
+
+    tokens = (segment_ids >= 0).to(device)
+    assert torch.allclose(dense_logits[tokens], packed_logits[tokens], atol=1e-4), "the packed masks change the logits"
+
+    logger.info(f'{args.model_type}: {args.batch_size} x {input_ids.size(1)} tokens, '
+                f'{sum(len(row) for row in lengths)} documents, logits identical')
+    logger.info(f'masks per batch: dense {dense_bytes / 2 ** 20:.1f} MB  packed {packed_bytes / 2 ** 20:.3f} MB  '
+                f'({dense_bytes / packed_bytes:.0f}x)')
+    logger.info(f'collation: dense {dense_time * 1000:.1f}ms  packed {packed_time * 1000:.1f}ms')
+
+
+@register_benchmark('collator_masks')
+def benchmark_collator_masks(args):
+    """
+    Dense attention masks, prefix masks and position ids of packed batches (`batch_size` sequences of up to
+    `prompt_length` tokens) broadcast from segment ids, against the segment ids alone. Their equivalence with the
+    per-segment construction they replace is tested in `tests/test_custom_collator.py`.
+    """
+    lengths, prefix_token_idxs = random_packed_lengths(args, np.random.default_rng(args.seed))
+    cpu = torch.device('cpu')
+    vectorized_time, _ = timed(lambda: create_attn_masks_and_pos(lengths, prefix_token_idxs), args.repeats, cpu)
+    packed_time, _ = timed(lambda: create_segment_ids_and_pos(lengths, prefix_token_idxs), args.repeats, cpu)
+
+    logger.info(f'{args.batch_size} x {args.prompt_length} tokens, {sum(len(row) for row in lengths)} documents: '
+                f'dense masks {vectorized_time * 1000:.1f}ms  segment ids only {packed_time * 1000:.1f}ms')
+
+
+@register_benchmark('attention_backend')
+def benchmark_attention_backend(args):
+    """
+    Eager attention against `scaled_dot_product_attention`, on training shapes (forward and backward over packed
+    batches with the dense causal and prefix masks of the collator) and decoding shapes (left padded prompts with a
+    prefix-LM index). Logits have to match up to float rounding, greedy tokens are reported since near-ties may flip.
+    """
+    if not hasattr(torch.nn.functional, 'scaled_dot_product_attention'):
+        raise RuntimeError("scaled_dot_product_attention is not available in this torch version")
+
+    model = build_random_model(args)
+    device = model.device
+    lengths, prefix_token_idxs = random_packed_lengths(args, np.random.default_rng(args.seed))
+    attention_mask, position_ids, prefix_mask = create_attn_masks_and_pos(lengths, prefix_token_idxs)
+    train_inputs = dict(
+        input_ids=torch.randint(1, args.vocab_size, (args.batch_size, attention_mask.size(-1))).to(device),
+        attention_mask=attention_mask.to(device),
+        position_ids=position_ids.to(device),
+        prefix_lm_mask=prefix_mask.to(device)
+    )
+
+    def train_step():
+        model.zero_grad(set_to_none=True)
+        logits = model(**train_inputs).logits
+        logits.float().pow(2).mean().backward()
+        return logits.detach()
+
+    prompt_lengths = torch.randint(args.prompt_length // 2, args.prompt_length + 1, (args.batch_size,))
+    prompt_lengths[0] = args.prompt_length
+    prompt_mask = (torch.arange(args.prompt_length)[None, :] >= (args.prompt_length - prompt_lengths)[:, None]).long()
+    input_ids = torch.randint(1, args.vocab_size - 1, (args.batch_size, args.prompt_length)) * prompt_mask
+    generate_kwargs = dict(
+        input_ids=input_ids.to(device),
+        attention_mask=prompt_mask.to(device),
+        prefix_lm_mask=torch.full((args.batch_size,), args.prompt_length // 4, dtype=torch.long, device=device),
+        max_new_tokens=args.max_new_tokens,
+        do_sample=False,
+        pad_token_id=0,
+        eos_token_id=args.vocab_size - 1
+    )
+
+    results = {}
+    for backend in ('eager', 'sdpa'):
+        set_attention_backend(model, backend)
+        train_time, train_logits = timed(train_step, args.repeats, device)
+        with torch.no_grad():
+            prefill_logits = model(
+                input_ids=generate_kwargs['input_ids'],
+                attention_mask=generate_kwargs['attention_mask'],
+                prefix_lm_mask=generate_kwargs['prefix_lm_mask']
+            ).logits
+            decode_time, outputs = timed(lambda: model.generate(**generate_kwargs), args.repeats, device)
+        results[backend] = (train_time, train_logits, prefill_logits, decode_time, outputs)
+
+    eager, sdpa = results['eager'], results['sdpa']
+    tokens = (attention_mask.sum(-1) > 0).to(device)
+    assert torch.allclose(eager[1][tokens], sdpa[1][tokens], atol=1e-4), "sdpa changes the training logits"
+    prompt_tokens = prompt_mask.bool().to(device)
+    assert torch.allclose(eager[2][prompt_tokens], sdpa[2][prompt_tokens], atol=1e-4), "sdpa changes the prompt logits"
+    new_tokens = min(eager[4].size(-1), sdpa[4].size(-1))
+    agreement = (eager[4][:, :new_tokens] == sdpa[4][:, :new_tokens]).float()[:, args.prompt_length:].mean().item()
+
+    num_tokens = args.batch_size * args.max_new_tokens
+    logger.info(f'{args.model_type}: training batch of {args.batch_size} x {attention_mask.size(-1)} packed tokens, '
+                f'decoding {args.batch_size} left padded prompts of up to {args.prompt_length} tokens, logits close')
+    logger.info(f'training step: eager {eager[0] * 1000:.1f}ms  sdpa {sdpa[0] * 1000:.1f}ms '
+                f'({eager[0] / sdpa[0]:.2f}x)')
+    logger.info(f'decoding:      eager {num_tokens / eager[3]:.1f} tokens/s  sdpa {num_tokens / sdpa[3]:.1f} tokens/s '
+                f'({eager[3] / sdpa[3]:.2f}x), {100 * agreement:.1f}% of the greedy tokens identical')
+
+
+def _attention_layers(model):
+    if isinstance(model, PanguAlphaModel):
+        return [block.attn for block in model.transformer.h] + [model.top_query_layer.attn]
+    return [block.attn.attention for block in model.transformer.h]
+
+
+def _prefix_causal_masks_loop(model, key_length, prefix_lm_mask):
+    """
+    Causal and prefix-LM masks of a decoding step built by every attention layer from the prefix index, as before
+    the models shared them across layers
+    """
+    masks = []
+    for attention in _attention_layers(model):
+        causal_mask = shared_causal_mask(1, key_length, getattr(attention, 'window_size', None), prefix_lm_mask.device)
+        cond1 = prefix_lm_mask[:, None, None, None]  # broadcast prefix indexes
+        cond2 = torch.arange(causal_mask.size(-1)).to(causal_mask.device)[None, None, None, :]  # broadcast all indexes
+        masks.append(torch.where(torch.le(cond2, cond1), True, causal_mask))
+    return masks
+
+
+def _shared_prefix_causal_masks(model, key_length, prefix_lm_mask, prefix_key_mask):
+    """
+    Same masks as built by the model forward: extends the prefix keys of the previous step and builds one mask per
+    attention type
+    """
+    prefix_key_mask = build_prefix_key_mask(prefix_lm_mask, key_length, prefix_key_mask)
+    layers = _attention_layers(model)
+    attention_types = [getattr(attention, 'attention_type', 'global') for attention in layers]
+    causal_masks = {}
+    for attention, attention_type in zip(layers, attention_types):
+        if attention_type not in causal_masks:
+            causal_masks[attention_type] = attention._causal_mask(1, key_length, prefix_lm_mask=prefix_key_mask)
+    return [causal_masks[attention_type] for attention_type in attention_types], prefix_key_mask
+
+
+@register_benchmark('prefix_mask')
+def benchmark_prefix_mask(args):
+    """
+    Causal and prefix-LM masks of prefix-LM decoding built by every layer at every step against once per forward and
+    extended across steps. Masks have to be identical, and so do the greedy outputs of `generate` (which extends the
+    prefix keys) and of a decoding loop giving the model the prefix index only.
+    """
+    model = build_random_model(args)
+    device = model.device
+    input_ids = torch.randint(1, args.vocab_size - 1, (args.batch_size, args.prompt_length), device=device)
+    prefix_lm_mask = torch.randint(0, args.prompt_length // 2, (args.batch_size,), device=device)
+
+    def per_layer():
+        return [_prefix_causal_masks_loop(model, key_length, prefix_lm_mask)
+                for key_length in range(args.prompt_length + 1, args.prompt_length + args.max_new_tokens + 1)]
+
+    def shared():
+        steps, prefix_key_mask = [], build_prefix_key_mask(prefix_lm_mask, args.prompt_length)
+        for key_length in range(args.prompt_length + 1, args.prompt_length + args.max_new_tokens + 1):
+            masks, prefix_key_mask = _shared_prefix_causal_masks(model, key_length, prefix_lm_mask, prefix_key_mask)
+            steps.append(masks)
+        return steps
+
+    per_layer_time, per_layer_masks = timed(per_layer, args.repeats, device)
+    shared_time, shared_masks = timed(shared, args.repeats, device)
+    for expected, actual in zip(per_layer_masks, shared_masks):
+        assert all(torch.equal(a, b) for a, b in zip(expected, actual)), "sharing the masks changes them"
+
+    with torch.no_grad():
+        decode_time, outputs = timed(lambda: model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            prefix_lm_mask=prefix_lm_mask,
+            max_new_tokens=args.max_new_tokens,
+            min_length=args.prompt_length + args.max_new_tokens,
+            do_sample=False,
+            pad_token_id=0,
+            eos_token_id=args.vocab_size - 1
+        ), args.repeats, device)
+
+        expected, past = input_ids, None
+        for _ in range(args.max_new_tokens):
+            model_outputs = model(
+                input_ids=expected if past is None else expected[:, -1:],
+                past_key_values=past,
+                attention_mask=torch.ones_like(expected),
+                prefix_lm_mask=prefix_lm_mask,
+                use_cache=True
+            )
+            past = model_outputs.past_key_values
+            next_token_logits = model_outputs.logits[:, -1, :]
+            next_token_logits[:, args.vocab_size - 1] = float('-inf')  # min_length
+            expected = torch.cat([expected, next_token_logits.argmax(-1, keepdim=True)], dim=-1)
+    assert torch.equal(outputs, expected), "extending the prefix keys changes the greedy outputs"
+
+    num_layers = len(_attention_layers(model))
+    logger.info(f'{args.model_type}: batch of {args.batch_size}, prompt of {args.prompt_length} tokens, '
+                f'{args.max_new_tokens} new tokens, {num_layers} attention layers, masks and outputs identical')
+    logger.info(f'masks per token: per layer {per_layer_time / args.max_new_tokens * 1e6:.0f}us  '
+                f'shared {shared_time / args.max_new_tokens * 1e6:.0f}us  '
+                f'(saves {(per_layer_time - shared_time) / args.max_new_tokens * 1e6:.0f}us of the '
+                f'{decode_time / args.max_new_tokens * 1e3:.2f}ms per decoding step)')
+
+
+def _cache_bytes(past):
+    return sum(
+        states.numel() * states.element_size() for layer in past for states in vars(layer).values()
+        if isinstance(states, torch.Tensor) and states.is_floating_point()
+    )
+
+
+@register_benchmark('sliding_window_cache')
+def benchmark_sliding_window_cache(args):
+    """
+    Decoding GPT-Neo into a static cache whose local layers keep their window (and the prefix) in a ring buffer,
+    against a static cache of `max_length` positions for all layers and the tuple cache grown with `torch.cat`.
+    Left padded prompts with a prefix-LM index; that the caches give the same outputs is checked by
+    tests/test_static_cache.py.
+    """
+    if args.model_type != 'pycodegpt':
+        raise ValueError("Only GPT-Neo (pycodegpt) has local attention layers")
+    model = build_random_model(args)
+    device = model.device
+    max_length = args.prompt_length + args.max_new_tokens
+    prompt_lengths = torch.randint(args.prompt_length // 2, args.prompt_length + 1, (args.batch_size,))
+    prompt_lengths[0] = args.prompt_length
+    prompt_mask = (torch.arange(args.prompt_length)[None, :] >= (args.prompt_length - prompt_lengths)[:, None]).long()
+    prefix_lm_mask = args.prompt_length - prompt_lengths + torch.randint(0, args.prompt_length // 4, (args.batch_size,))
+    input_ids = torch.randint(1, args.vocab_size - 1, (args.batch_size, args.prompt_length)) * prompt_mask
+    generate_kwargs = dict(
+        input_ids=input_ids.to(device),
+        attention_mask=prompt_mask.to(device),
+        prefix_lm_mask=prefix_lm_mask.to(device),
+        max_new_tokens=args.max_new_tokens,
+        min_length=max_length,
+        do_sample=False,
+        pad_token_id=0,
+        eos_token_id=args.vocab_size - 1
+    )
+
+    def full_static_cache():
+        num_heads = model.config.num_attention_heads
+        return StaticKVCache(
+            num_layers=model.config.num_layers,
+            batch_size=args.batch_size,
+            num_heads=num_heads,
+            max_length=max_length,
+            head_dim=model.config.hidden_size // num_heads,
+            dtype=model.dtype,
+            device=device
+        )
+
+    sliding_cache = model.init_static_cache(args.batch_size, max_length, generate_kwargs['prefix_lm_mask'])
+    # GPT-Neo imports its cache classes as `source.pangu_alpha`, so they are told apart by their attributes
+    num_sliding = sum(hasattr(layer, 'key_positions') for layer in sliding_cache)
+    if num_sliding == 0:
+        raise ValueError(f"No layer gets a sliding window cache: the window ({args.window_size}) and the prefix have "
+                         f"to be shorter than the {max_length} positions of the prompts and new tokens")
+    full_bytes, sliding_bytes = _cache_bytes(full_static_cache()), _cache_bytes(sliding_cache)
+
+    with torch.no_grad():
+        tuple_time, _ = timed(lambda: model.generate(**generate_kwargs), args.repeats, device)
+        full_time, _ = timed(
+            lambda: model.generate(past=full_static_cache(), **generate_kwargs), args.repeats, device
+        )
+        sliding_time, _ = timed(
+            lambda: model.generate(static_cache=True, **generate_kwargs), args.repeats, device
+        )
+
+    num_tokens = args.batch_size * args.max_new_tokens
+    logger.info(f'pycodegpt: batch of {args.batch_size}, prompts of up to {args.prompt_length} tokens, '
+                f'{args.max_new_tokens} new tokens, {num_sliding}/{model.config.num_layers} layers with a window of '
+                f'{model.config.window_size}')
+    logger.info(f'cache memory: full {full_bytes / 2 ** 20:.1f} MB  sliding window {sliding_bytes / 2 ** 20:.1f} MB')
+    logger.info(f'torch.cat cache: {tuple_time:.3f}s ({num_tokens / tuple_time:.1f} tokens/s)')
+    logger.info(f'static cache:    {full_time:.3f}s ({num_tokens / full_time:.1f} tokens/s)')
+    logger.info(f'sliding window:  {sliding_time:.3f}s ({num_tokens / sliding_time:.1f} tokens/s)')
+
+
+def _causal_bias_buffer(max_positions, window_size=None):
+    """
+    `bias` buffer every attention layer registered before the causal masks were shared
+    """
+    bias = torch.tril(torch.ones((max_positions, max_positions), dtype=torch.uint8)).view(
+        1, 1, max_positions, max_positions
+    )
+    if window_size is not None:
+        bias = torch.bitwise_xor(bias, torch.tril(bias, -window_size))
+    return bias
+
+
+def _register_causal_bias_buffers(model):
+    max_positions = model.config.max_position_embeddings
+    for attention in _attention_layers(model):
+        bias = _causal_bias_buffer(max_positions, getattr(attention, 'window_size', None))
+        attention.register_buffer("bias", bias.to(attention.masked_bias.device))
+    return model
+
+
+def _rss_bytes():
+    """
+    Resident memory of the process (Linux)
+    """
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+@register_benchmark('causal_bias')
+def benchmark_causal_bias(args):
+    """
+    Model construction, `.to(device)` and resident memory with the causal masks shared by all attention layers against
+    a `(max_positions, max_positions)` bias buffer per layer. Every slice the layers take of the shared masks has to be
+    identical to the one of their former buffer.
+    """
+    device = build_random_model(args).device  # warm up
+    rss = _rss_bytes()
+    shared_time, model = timed(lambda: build_random_model(args), 1, device)
+    shared_rss = _rss_bytes() - rss
+
+    rss = _rss_bytes()
+    buffers_time, _ = timed(lambda: _register_causal_bias_buffers(build_random_model(args)), 1, device)
+    buffers_rss = _rss_bytes() - rss
+
+    layers = _attention_layers(model)
+    max_positions = model.config.max_position_embeddings
+    key_lengths = sorted({1, max_positions // 3, max_positions // 2 + 1, max_positions})
+    for attention in layers:
+        bias = _causal_bias_buffer(max_positions, getattr(attention, 'window_size', None)).to(device)
+        for key_length in key_lengths:
+            for query_length in {1, key_length // 2 + 1, key_length}:
+                expected = bias[:, :, key_length - query_length: key_length, :key_length].bool()
+                actual = shared_causal_mask(query_length, key_length, getattr(attention, 'window_size', None), device)
+                assert torch.equal(expected, actual), "the shared causal mask differs from the bias buffer"
+
+    buffer_bytes = len(layers) * max_positions ** 2
+    logger.info(f'{args.model_type}: {len(layers)} attention layers, {max_positions} positions, masks identical, '
+                f'{buffer_bytes / 2 ** 20:.1f} MB of bias buffers')
+    logger.info(f'construction: per layer buffers {buffers_time:.3f}s (+{buffers_rss / 2 ** 20:.1f} MB RSS)  '
+                f'shared masks {shared_time:.3f}s (+{shared_rss / 2 ** 20:.1f} MB RSS)')
+
+    if torch.cuda.is_available() and not args.no_cuda:
+        cpu_args = replace(args, no_cuda=True)
+        shared_move, _ = timed(lambda: build_random_model(cpu_args).to(device), 1, device)
+        buffers_move, _ = timed(
+            lambda: _register_causal_bias_buffers(build_random_model(cpu_args)).to(device), 1, device
+        )
+        logger.info(f'construction and .to({device}): per layer buffers {buffers_move:.3f}s  '
+                    f'shared masks {shared_move:.3f}s')
+
+
+def _model_bytes(model):
+    tensors = {id(tensor): tensor for tensor in list(model.parameters()) + list(model.buffers())}
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors.values())
+
+
+def _quantized_load_run(directory, mode, model_class, model_kwargs, input_ids, queue):
+    """
+    Loads a `save_quantized_model` checkpoint (of the floating point model with mode `none`) in its own process, so
+    that its resident memory is not that left over by the other modes. The memory is measured after a forward of a
+    single token, which packs the int8 weights for the dynamic int8 matmul without keeping large activations around.
+    """
+    rss = _rss_bytes()
+    with torch.no_grad():
+        if mode == 'none':
+            model = model_class(model_class.config_class.from_pretrained(directory), **model_kwargs)
+            model.load_state_dict(torch.load(os.path.join(directory, QUANTIZED_WEIGHTS_NAME), map_location='cpu'))
+        else:
+            model = load_quantized_model(model_class, directory, **model_kwargs)
+        model = model.to(input_ids.device).eval()
+        model(input_ids=input_ids[:1, :1])
+        load_rss = _rss_bytes() - rss
+        logits = model(input_ids=input_ids).logits
+    queue.put((load_rss, logits.cpu().numpy()))
+
+
+@register_benchmark('quantization')
+def benchmark_quantization(args):
+    """
+    Greedy decoding with the attention and MLP weights quantized to int8, int4 and int8 with dynamically quantized
+    activations (`int8_dynamic`) against the floating point model: weight memory, tokens/s, logit error, agreement of
+    the top tokens of the prompt logits and of the greedy tokens (which diverge for good after the first flipped
+    token). pass@k has to be compared on real checkpoints, with
+    `generation.py --quantization`. Saved models have to load back to identical logits, in a new process whose
+    resident memory is measured (see `_quantized_load_run`).
+    """
+    model = build_random_model(args)
+    device = model.device
+    input_ids = torch.randint(1, args.vocab_size - 1, (args.batch_size, args.prompt_length), device=device)
+    generate_kwargs = dict(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        max_new_tokens=args.max_new_tokens,
+        min_length=args.prompt_length + args.max_new_tokens,
+        do_sample=False,
+        pad_token_id=0,
+        eos_token_id=args.vocab_size - 1
+    )
+
+    results = {}
+    context = torch.multiprocessing.get_context('spawn')
+    model_kwargs = dict(args=SimpleNamespace(replicated_tokens_map=None), tokenizer=_VocabStub(args.vocab_size))
+    with torch.no_grad():
+        for mode in ('none', 'int8', 'int8_dynamic', 'int4'):
+            quantized = quantize_model(copy.deepcopy(model), mode).eval()
+            logits = quantized(input_ids=input_ids).logits
+            decode_time, outputs = timed(lambda: quantized.generate(**generate_kwargs), args.repeats, device)
+
+            with tempfile.TemporaryDirectory() as directory:
+                save_quantized_model(quantized, directory)
+                queue = context.Queue()
+                process = context.Process(target=_quantized_load_run, args=(
+                    directory, mode, type(model), model_kwargs, input_ids, queue
+                ))
+                process.start()
+                load_rss, loaded_logits = queue.get()
+                process.join()
+            assert np.array_equal(loaded_logits, logits.cpu().numpy()), "reloading changes the logits"
+            results[mode] = (_model_bytes(quantized), decode_time, logits, outputs, load_rss)
+
+    num_tokens = args.batch_size * args.max_new_tokens
+    base_bytes, base_time, base_logits, base_outputs, base_rss = results['none']
+    logger.info(f'{args.model_type}: batch of {args.batch_size}, prompt of {args.prompt_length} tokens, '
+                f'{args.max_new_tokens} new tokens, quantized checkpoints reload identically')
+    logger.info(f'fp:   {base_bytes / 2 ** 20:.1f} MB  {num_tokens / base_time:.1f} tokens/s  '
+                f'+{base_rss / 2 ** 20:.1f} MB RSS loaded')
+    for mode in ('int8', 'int8_dynamic', 'int4'):
+        num_bytes, decode_time, logits, outputs, load_rss = results[mode]
+        error = ((logits - base_logits).abs().max() / base_logits.abs().max()).item()
+        top_agreement = (logits.argmax(-1) == base_logits.argmax(-1)).float().mean().item()
+        agreement = (outputs[:, args.prompt_length:] == base_outputs[:, args.prompt_length:]).float().mean().item()
+        logger.info(f'{mode}: {num_bytes / 2 ** 20:.1f} MB  {num_tokens / decode_time:.1f} tokens/s '
+                    f'({base_time / decode_time:.2f}x)  +{load_rss / 2 ** 20:.1f} MB RSS loaded, '
+                    f'max logit error {100 * error:.2f}%, {100 * top_agreement:.1f}% of the top prompt tokens and '
+                    f'{100 * agreement:.1f}% of the greedy tokens identical')
+
+
+@register_benchmark('bf16')
+def benchmark_bf16(args):
+    """
+    bf16 inference (bf16 weights) and training (fp32 weights under CPU autocast) against fp32 on a random model:
+    logits and loss have to stay within bf16 precision of fp32, with the softmax and the loss computed in fp32.
+    """
+    model = build_random_model(replace(args, no_cuda=True))
+    input_ids = torch.randint(1, args.vocab_size - 1, (args.batch_size, args.prompt_length))
+    generate_kwargs = dict(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        max_new_tokens=args.max_new_tokens,
+        min_length=args.prompt_length + args.max_new_tokens,
+        do_sample=False,
+        pad_token_id=0,
+        eos_token_id=args.vocab_size - 1
+    )
+    bf16_model = copy.deepcopy(model).to(torch.bfloat16)
+    device = torch.device('cpu')
+
+    with torch.no_grad():
+        logits = model(input_ids=input_ids).logits
+        bf16_logits = bf16_model(input_ids=input_ids).logits
+        fp32_time, outputs = timed(lambda: model.generate(**generate_kwargs), args.repeats, device)
+        bf16_time, bf16_outputs = timed(lambda: bf16_model.generate(**generate_kwargs), args.repeats, device)
+    logits_error = ((bf16_logits.float() - logits).abs().max() / logits.abs().max()).item()
+    agreement = (bf16_outputs[:, args.prompt_length:] == outputs[:, args.prompt_length:]).float().mean().item()
+    assert logits_error < 0.05, f"bf16 logits are {100 * logits_error:.1f}% off the fp32 ones"
+
+    model.train()
+    loss = model(input_ids=input_ids, labels=input_ids).loss
+    with torch.autocast(device_type='cpu', dtype=torch.bfloat16):
+        autocast_loss = model(input_ids=input_ids, labels=input_ids).loss
+    model.eval()
+    loss_error = abs(autocast_loss.item() - loss.item()) / loss.item()
+    assert autocast_loss.dtype == torch.float32, "the loss is not computed in fp32 under autocast"
+    assert loss_error < 0.01, f"the bf16 autocast loss is {100 * loss_error:.2f}% off the fp32 one"
+
+    num_tokens = args.batch_size * args.max_new_tokens
+    logger.info(f'{args.model_type}: batch of {args.batch_size}, prompt of {args.prompt_length} tokens, '
+                f'{args.max_new_tokens} new tokens, max logit error {100 * logits_error:.2f}%, training loss error '
+                f'{100 * loss_error:.3f}%, {100 * agreement:.1f}% of the greedy tokens identical')
+    logger.info(f'decoding: fp32 {num_tokens / fp32_time:.1f} tokens/s  bf16 {num_tokens / bf16_time:.1f} tokens/s '
+                f'({fp32_time / bf16_time:.2f}x)')
+
+
+@register_benchmark('compile')
+def benchmark_compile(args):
+    """
+    Per-token latency of greedy decoding with the prefill and decode forwards compiled against eager. A warm up
+    generation with prompts of half the length compiles them (and the logits check its prefill call), then the
+    timed generations with prompts of `prompt_length` tokens must not compile any new graph: sequence and cache
+    lengths are symbolic, and the prompts are contiguous so that their strides do not change either. Logits have to
+    stay close to the eager ones and a training step has to give the same loss.
+    """
+    from torch._dynamo.utils import counters
+
+    model = build_random_model(args)
+    for module in model.modules():
+        if isinstance(module, torch.nn.Dropout):
+            module.p = 0.0  # eager and compiled dropout draw different masks
+    device = model.device
+    input_ids = torch.randint(1, args.vocab_size - 1, (args.batch_size, args.prompt_length), device=device)
+    prefix_lm_mask = torch.randint(0, args.prompt_length // 2, (args.batch_size,), device=device)
+
+    def generate(prompt_length):
+        prompt = input_ids[:, :prompt_length].contiguous()
+        return model.generate(
+            input_ids=prompt,
+            attention_mask=torch.ones_like(prompt),
+            prefix_lm_mask=prefix_lm_mask,
+            max_new_tokens=args.max_new_tokens,
+            min_length=prompt_length + args.max_new_tokens,
+            do_sample=False,
+            pad_token_id=0,
+            eos_token_id=args.vocab_size - 1
+        )
+
+    with torch.no_grad():
+        logits = model(input_ids=input_ids, prefix_lm_mask=prefix_lm_mask).logits
+        generate(args.prompt_length)
+        eager_time, outputs = timed(lambda: generate(args.prompt_length), args.repeats, device)
+        model.train()
+        loss = model(input_ids=input_ids, labels=input_ids).loss
+        model.eval()
+
+        compile_model(model)
+        start_time = time.time()
+        generate(args.prompt_length // 2)
+        compiled_logits = model(input_ids=input_ids, prefix_lm_mask=prefix_lm_mask).logits
+        warm_up_time = time.time() - start_time
+        warm_up_calls, warm_up_graphs = dict(model.forward.calls), counters['stats']['unique_graphs']
+        compiled_time, compiled_outputs = timed(lambda: generate(args.prompt_length), args.repeats, device)
+        new_graphs = counters['stats']['unique_graphs'] - warm_up_graphs
+        model.train()
+        compiled_loss = model(input_ids=input_ids, labels=input_ids).loss
+        model.eval()
+        calls = dict(model.forward.calls)
+        eager_forward(model)
+
+    assert new_graphs == 0, f"the prompts of {args.prompt_length} tokens compiled {new_graphs} new graphs"
+    logits_error = ((compiled_logits - logits).abs().max() / logits.abs().max()).item()
+    agreement = (compiled_outputs[:, args.prompt_length:] == outputs[:, args.prompt_length:]).float().mean().item()
+    assert logits_error < 1e-3, f"compiled logits are {100 * logits_error:.2f}% off the eager ones"
+    assert abs(compiled_loss.item() - loss.item()) < 1e-3 * loss.item(), "the compiled training loss differs"
+
+    num_tokens = args.max_new_tokens
+    logger.info(f'{args.model_type}: batch of {args.batch_size}, prompts of {args.prompt_length // 2} (warm up) and '
+                f'{args.prompt_length} tokens, {args.max_new_tokens} new tokens, max logit error '
+                f'{100 * logits_error:.4f}%, {100 * agreement:.1f}% of the greedy tokens identical')
+    logger.info(f'forward calls per phase: warm up {warm_up_calls}, in total {calls}, warm up took {warm_up_time:.1f}s '
+                f'and compiled {warm_up_graphs} graphs, none after it')
+    logger.info(f'per token: eager {eager_time / num_tokens * 1e3:.2f}ms  '
+                f'compiled {compiled_time / num_tokens * 1e3:.2f}ms ({eager_time / compiled_time:.2f}x)')
+
+
+def _drop_page_cache(path):
+    """
+    Evicts the (clean) pages of a file from the page cache, for a cold load
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+@register_benchmark('fast_loading')
+def benchmark_fast_loading(args):
+    """
+    Startup of a model from a memory-mapped safetensors export against `from_pretrained` of a `pytorch_model.bin`
+    checkpoint, cold (the file evicted from the page cache) and warm, with the resident memory of the loaded model and
+    the time of its first forward (which faults the mapped weights in). Both have to give identical logits. Startup
+    times are measured in the same process after a warm up load, i.e. without the imports of a fresh process.
+    """
+    model = build_random_model(replace(args, no_cuda=True))
+    device = torch.device('cpu') if args.no_cuda or not torch.cuda.is_available() else torch.device('cuda')
+    input_ids = torch.randint(1, args.vocab_size - 1, (args.batch_size, args.prompt_length))
+    with torch.no_grad():
+        logits = model(input_ids=input_ids).logits
+    model_class = type(model)
+    model_kwargs = dict(args=SimpleNamespace(replicated_tokens_map=None), tokenizer=_VocabStub(args.vocab_size))
+
+    loaders = {
+        'from_pretrained': lambda directory: model_class.from_pretrained(directory, **model_kwargs).eval(),
+        'safetensors': lambda directory: load_safetensors_model(model_class, directory, **model_kwargs),
+    }
+    files = {'from_pretrained': 'pytorch_model.bin', 'safetensors': SAFETENSORS_WEIGHTS_NAME}
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        model.save_pretrained(directory)
+        save_safetensors_model(model, directory)
+        del model
+        for name, load in loaders.items():
+            path = os.path.join(directory, files[name])
+            load(directory)  # warm up, the first meta device models and unpickling import their modules
+            times = {}
+            for start in ('cold', 'warm'):
+                if start == 'cold':
+                    _drop_page_cache(path)
+                rss = _rss_bytes()
+                times[start], loaded = timed(lambda: load(directory).to(device), 1, device)
+                load_rss = _rss_bytes() - rss
+                with torch.no_grad():
+                    forward_time, loaded_logits = timed(lambda: loaded(input_ids=input_ids.to(device)).logits, 1, device)
+                assert torch.equal(loaded_logits.cpu(), logits), f"{name} changes the logits"
+                del loaded
+            results[name] = (os.path.getsize(path), times, load_rss, forward_time)
+
+    logger.info(f'{args.model_type}: {args.num_layers} layers of {args.hidden_size}, logits identical, on {device}')
+    for name, (num_bytes, times, load_rss, forward_time) in results.items():
+        logger.info(f'{name}: {num_bytes / 2 ** 20:.1f} MB file, startup cold {times["cold"]:.3f}s  warm '
+                    f'{times["warm"]:.3f}s, +{load_rss / 2 ** 20:.1f} MB RSS, first forward {forward_time:.3f}s')
+
+
+def _layer_streaming_run(directory, mode, model_class, model_kwargs, generate_kwargs, repeats, queue):
+    """
+    One mode of the `layer_streaming` benchmark, in its own process so that the resident memory of a mode is not
+    that left over by the previous one
+    """
+    _drop_page_cache(os.path.join(directory, SAFETENSORS_WEIGHTS_NAME))
+    rss = _rss_bytes()
+    peak = [rss]
+    with torch.no_grad():
+        model = load_safetensors_model(model_class, directory, **model_kwargs)
+        for block in streamed_blocks(model):
+            block.register_forward_hook(lambda module, inputs, outputs: peak.append(_rss_bytes()))
+        if mode != 'resident':
+            stream_layers(model, prefetch=mode.endswith('prefetch'))
+        decode_time, outputs = timed(lambda: model.generate(**generate_kwargs), repeats, torch.device('cpu'))
+    queue.put((max(peak) - rss, decode_time, outputs.numpy()))
+
+
+@register_benchmark('layer_streaming')
+def benchmark_layer_streaming(args):
+    """
+    Peak resident memory and tokens/s of greedy decoding from a memory-mapped safetensors export with all the blocks
+    resident, and streamed one at a time with and without prefetch. Every mode runs in a new process and starts with
+    the export evicted from the page cache, its peak is sampled at the end of every block (before it is released)
+    above the memory of the process before loading. The streamed models have to generate the same tokens.
+    """
+    model = build_random_model(replace(args, no_cuda=True))
+    model_class = type(model)
+    model_kwargs = dict(args=SimpleNamespace(replicated_tokens_map=None), tokenizer=_VocabStub(args.vocab_size))
+    input_ids = torch.randint(1, args.vocab_size - 1, (args.batch_size, args.prompt_length))
+    generate_kwargs = dict(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        max_new_tokens=args.max_new_tokens,
+        min_length=args.prompt_length + args.max_new_tokens,
+        do_sample=False,
+        pad_token_id=0,
+        eos_token_id=args.vocab_size - 1
+    )
+
+    results = {}
+    context = torch.multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        save_safetensors_model(model, directory)
+        num_bytes = _model_bytes(model)
+        del model
+        for mode in ('resident', 'streaming', 'streaming with prefetch'):
+            queue = context.Queue()
+            process = context.Process(target=_layer_streaming_run, args=(
+                directory, mode, model_class, model_kwargs, generate_kwargs, args.repeats, queue
+            ))
+            process.start()
+            results[mode] = queue.get()
+            process.join()
+
+    num_tokens = args.batch_size * args.max_new_tokens
+    resident_rss, resident_time, resident_outputs = results['resident']
+    logger.info(f'{args.model_type}: {args.num_layers} layers of {args.hidden_size} ({num_bytes / 2 ** 20:.1f} MB), '
+                f'batch of {args.batch_size}, prompt of {args.prompt_length} tokens, {args.max_new_tokens} new tokens, '
+                f'outputs identical')
+    for mode, (peak_rss, decode_time, outputs) in results.items():
+        assert np.array_equal(outputs, resident_outputs), f"{mode} changes the generated tokens"
+        logger.info(f'{mode}: peak +{peak_rss / 2 ** 20:.1f} MB RSS, {num_tokens / decode_time:.1f} tokens/s '
+                    f'({resident_time / decode_time:.2f}x)')
+
+def main():
+    args = HfArgumentParser(BenchmarkArguments).parse_args_into_dataclasses()[0]
+    if args.benchmark not in BENCHMARKS:
+        raise ValueError(f"Unknown benchmark {args.benchmark}, choose from {sorted(BENCHMARKS)}")
+
+    set_seed(args.seed)
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
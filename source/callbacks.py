@@ -18,7 +18,7 @@ from transformers import TrainerCallback
 from pangu_alpha import PanguAlphaTokenizer
 import re
 import os
-import copy
+from vocab_partition import ReplicatedTokensRemapper
 
 
 class ExampleInput(TrainerCallback):
@@ -100,13 +100,7 @@ class GenerationCallback(TrainerCallback):
 
         code_ids = tokenizer.encode(signature, add_special_tokens=False)
         if args.replicated_tokens_map is not None:
-            new_code_ids = []
-            for cid in code_ids:
-                if cid in args.replicated_tokens_map:
-                    new_code_ids.append(args.replicated_tokens_map[cid])
-                else:
-                    new_code_ids.append(cid)
-            code_ids = copy.deepcopy(new_code_ids)
+            code_ids = ReplicatedTokensRemapper(args.replicated_tokens_map)(code_ids)
 
         encoded_code = [self.tokenizer.convert_tokens_to_ids('<python>')] + code_ids
 
@@ -199,13 +193,7 @@ class GenerationCallbackRaw(TrainerCallback):
 
         code_ids = tokenizer.encode(signature, add_special_tokens=False)
         if args.replicated_tokens_map is not None:
-            new_code_ids = []
-            for cid in code_ids:
-                if cid in args.replicated_tokens_map:
-                    new_code_ids.append(args.replicated_tokens_map[cid])
-                else:
-                    new_code_ids.append(cid)
-            code_ids = copy.deepcopy(new_code_ids)
+            code_ids = ReplicatedTokensRemapper(args.replicated_tokens_map)(code_ids)
 
         encoded_prompt = [self.tokenizer.convert_tokens_to_ids('<|beginoftext|>')] + \
                          code_ids + \
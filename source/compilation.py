@@ -0,0 +1,106 @@
+# Copyright (C) 2024. Huawei Technologies Co., Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+
+import logging
+from collections import Counter
+import torch
+from torch import nn
+from pangu_alpha.generation_utils import cached_length
+
+
+logger = logging.getLogger(__name__)
+
+COMPILE_MODES = ('none', 'default', 'reduce-overhead', 'max-autotune')
+COMPILE_PHASES = ('train', 'prefill', 'decode')
+
+
+# one function per phase: torch.compile caches its graphs per code object, so every phase keeps its own graphs
+# (specialised on the branches its inputs take) and the recompilations of one phase never evict those of another
+def _train_forward(forward, *args, **kwargs):
+    return forward(*args, **kwargs)
+
+
+def _prefill_forward(forward, *args, **kwargs):
+    return forward(*args, **kwargs)
+
+
+def _decode_forward(forward, *args, **kwargs):
+    return forward(*args, **kwargs)
+
+
+class CompiledForward:
+    """
+    Forward of a model dispatched to a `torch.compile` variant per phase: `train` (the model is in training mode),
+    `prefill` (no cached positions) and `decode` (a single new position on a cache). Other calls, e.g. several new
+    positions on a cache when verifying speculative tokens, run eagerly.
+
+    Sequence and cache lengths are compiled as symbolic sizes, so that a phase is not recompiled for every prompt
+    length or decoding step. A phase still gets a new graph for a new combination of branches (e.g. with or without
+    `prefix_lm_mask`), of keyword arguments, or of input strides (non-contiguous prompts, the cache of the first
+    decoding step, which the later steps replace by contiguous ones), at most `torch._dynamo.config.cache_size_limit`
+    of them before falling back to eager.
+    """
+
+    def __init__(self, forward, mode='default', dynamic=True):
+        self.forward = forward
+        options = dict(mode=None if mode == 'default' else mode, dynamic=dynamic)
+        self.variants = {
+            'train': torch.compile(_train_forward, **options),
+            'prefill': torch.compile(_prefill_forward, **options),
+            'decode': torch.compile(_decode_forward, **options),
+        }
+        self.calls = Counter()
+
+    def phase(self, args, kwargs):
+        if self.forward.__self__.training:
+            return 'train'
+        if cached_length(kwargs.get('past_key_values')) == 0:
+            return 'prefill'
+        input_ids = kwargs['input_ids'] if 'input_ids' in kwargs else (args[0] if args else None)
+        if input_ids is not None and input_ids.size(-1) == 1:
+            return 'decode'
+        return None
+
+    def __call__(self, *args, **kwargs):
+        phase = self.phase(args, kwargs)
+        self.calls[phase or 'eager'] += 1
+        if phase is None:
+            return self.forward(*args, **kwargs)
+        return self.variants[phase](self.forward, *args, **kwargs)
+
+
+def compile_model(model: nn.Module, mode: str = 'default') -> nn.Module:
+    """
+    Replaces the forward of `model` by a `CompiledForward` (torch >= 2.0), in place. `eager_forward` restores it.
+    Compiled models cannot be pickled, e.g. to spawn generation workers.
+    """
+    if mode not in COMPILE_MODES:
+        raise ValueError(f"Unknown compile mode {mode}, choose from {COMPILE_MODES}")
+    if mode == 'none':
+        return model
+    if not hasattr(torch, 'compile'):
+        logger.warning(f"torch.compile needs torch >= 2.0 (found {torch.__version__}), running eagerly")
+        return model
+    if isinstance(model.forward, CompiledForward):
+        model.forward = model.forward.forward
+    model.forward = CompiledForward(model.forward, mode=mode)
+    logger.info(f'Compiling the {", ".join(COMPILE_PHASES)} forwards of {type(model).__name__} ({mode} mode)')
+    return model
+
+
+def eager_forward(model: nn.Module) -> nn.Module:
+    if isinstance(model.forward, CompiledForward):
+        del model.forward
+    return model
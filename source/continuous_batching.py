@@ -0,0 +1,398 @@
+# Copyright (C) 2024. Huawei Technologies Co., Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+
+import time
+import logging
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+from dataclasses import dataclass, field
+import torch
+from torch import nn
+from pangu_alpha.generation_utils import (
+    pad_past_key_values,
+    concat_past_key_values,
+    concat_past_key_values_list,
+    select_past_key_values,
+    trim_past_key_values
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class GenerationRequest:
+    """
+    One prompt to complete. `key` identifies the request in the output (e.g. sample number and dataset index),
+    the remaining fields are copied from an item of `PycodegptDataset`/`PanguDataset`.
+    """
+    key: Any
+    task_id: str
+    prompt_length: int
+    encoded_prompt: List[int]
+    original_prompt: str = None
+    prefix_lm_mask: Optional[int] = None
+
+
+@dataclass
+class GenerationStats:
+    generated_tokens: int = 0
+    decode_steps: int = 0
+    occupied_slots: int = 0
+    total_slots: int = 0
+    padding_tokens: int = 0
+    prompt_positions: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def tokens_per_second(self):
+        return self.generated_tokens / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def slot_utilization(self):
+        return self.occupied_slots / self.total_slots if self.total_slots > 0 else 0.0
+
+    @property
+    def padding_ratio(self):
+        return self.padding_tokens / self.prompt_positions if self.prompt_positions > 0 else 0.0
+
+    def log(self, prefix=''):
+        logger.info(
+            f'{prefix}{self.generated_tokens} tokens in {self.elapsed:.1f}s '
+            f'({self.tokens_per_second:.1f} tokens/s), '
+            f'{self.decode_steps} decode steps, slot utilization {100 * self.slot_utilization:.1f}%'
+            + (f', prompt padding {100 * self.padding_ratio:.1f}%' if self.prompt_positions > 0 else '')
+        )
+
+
+@dataclass
+class _Batch:
+    """
+    Running rows of the engine. `past_key_values` always covers all of `input_ids` and `next_token_logits` holds the
+    (unprocessed) logits of the token that comes next for every row.
+    """
+    requests: List[GenerationRequest]
+    input_ids: torch.LongTensor
+    attention_mask: torch.LongTensor
+    past_key_values: Tuple
+    next_token_logits: torch.FloatTensor
+    prefix_lm_mask: Optional[torch.LongTensor] = None
+    num_new_tokens: List[int] = field(default_factory=list)
+
+    def __len__(self):
+        return len(self.requests)
+
+
+class ContinuousBatchingEngine:
+    """
+    Generates with a fixed number of slots instead of fixed batches: after every decode step the rows that produced
+    `eos_token_id` (or hit their length limit) leave the batch and the free slots are filled with new prompts.
+
+    Rows are kept left-padded, so the caches of the running rows and of the newly prefilled ones are merged by
+    padding the shorter one on the left; the prefix-LM index of a row is shifted by the same amount.
+    """
+
+    def __init__(
+        self,
+        model,
+        num_slots,
+        pad_token_id,
+        eos_token_id,
+        max_length=None,
+        max_new_tokens=None,
+        do_sample=True,
+        temperature=1.0,
+        top_k=0,
+        top_p=1.0,
+        repetition_penalty=1.0,
+        sample_replacement=True,
+        device=None,
+        prefix_cache=None,
+        stopping_criteria=None
+    ):
+        self.model = model
+        self.num_slots = num_slots
+        self.pad_token_id = pad_token_id
+        self.eos_token_id = eos_token_id
+        self.max_length = max_length
+        self.max_new_tokens = max_new_tokens
+        if self.max_length is None and self.max_new_tokens is None:
+            self.max_length = model.config.max_length
+        self.do_sample = do_sample
+        self.sample_replacement = sample_replacement
+        self.device = device if device is not None else model.device
+        self.prefix_cache = prefix_cache
+        # per-row criteria (e.g. `FunctionBodyStoppingCriteria`), every row gets its own tracker
+        self.stopping_criteria = stopping_criteria
+        self._trackers = {}
+
+        self.logits_processor, self.logits_warper = model._get_decoding_processors(
+            do_sample=do_sample,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty
+        )
+
+        self.stats = GenerationStats()
+
+    def length_limit(self, request):
+        # `max_length` takes priority over `max_new_tokens`, like in `generate`
+        if self.max_length is not None:
+            return max(self.max_length - len(request.encoded_prompt), 1)
+        return self.max_new_tokens
+
+    def _forward(self, input_ids, attention_mask, past_key_values, prefix_lm_mask):
+        model_inputs = self.model.prepare_inputs_for_generation(
+            input_ids,
+            past=past_key_values,
+            attention_mask=attention_mask,
+            use_cache=True,
+            prefix_lm_mask=prefix_lm_mask
+        )
+        outputs = self.model(**model_inputs, return_dict=True)
+        return outputs.past_key_values, outputs.logits[:, -1, :].float()
+
+    def _prefill(self, requests):
+        max_len = max(len(request.encoded_prompt) for request in requests)
+
+        if self.stopping_criteria is not None:
+            for request in requests:
+                tracker = self.stopping_criteria.new_row()
+                # completions of incremental tasks are part of the generated code
+                for token_id in request.encoded_prompt[request.prompt_length:]:
+                    tracker.feed(token_id)
+                self._trackers[id(request)] = tracker
+
+        input_ids, attention_mask, prefix_lm_mask = [], [], []
+        for request in requests:
+            pad_rest = max_len - len(request.encoded_prompt)
+            input_ids.append([self.pad_token_id] * pad_rest + request.encoded_prompt)
+            attention_mask.append([0] * pad_rest + [1] * len(request.encoded_prompt))
+            if request.prefix_lm_mask is not None:
+                prefix_lm_mask.append(request.prefix_lm_mask + pad_rest)
+
+        input_ids = torch.tensor(input_ids, dtype=torch.long, device=self.device)
+        attention_mask = torch.tensor(attention_mask, dtype=torch.long, device=self.device)
+        prefix_lm_mask = torch.tensor(prefix_lm_mask, dtype=torch.long, device=self.device) if prefix_lm_mask else None
+
+        if self.prefix_cache is None:
+            past_key_values, next_token_logits = self._forward(input_ids, attention_mask, None, prefix_lm_mask)
+        else:
+            past_key_values, next_token_logits = self._prefill_from_prefix_cache(
+                requests, input_ids, attention_mask, prefix_lm_mask
+            )
+
+        return _Batch(
+            requests=list(requests),
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            next_token_logits=next_token_logits,
+            prefix_lm_mask=prefix_lm_mask,
+            num_new_tokens=[0] * len(requests)
+        )
+
+    def _prefill_from_prefix_cache(self, requests, input_ids, attention_mask, prefix_lm_mask):
+        """
+        Prefills only the columns of the (right-aligned) prompts that are not in the prefix cache: the first
+        `cached_length` columns come from the cache, rows that have fewer cached tokens recompute some of them.
+        """
+        max_len = input_ids.size(-1)
+        matched = [
+            self.prefix_cache.match(request.encoded_prompt, namespace=request.prefix_lm_mask) for request in requests
+        ]
+        query_length = max(len(request.encoded_prompt) - m for request, m in zip(requests, matched))
+        cached_length = max_len - query_length
+
+        past_key_values = None
+        if cached_length > 0:
+            rows = []
+            for request in requests:
+                reused = max(len(request.encoded_prompt) - query_length, 0)
+                self.prefix_cache.record(len(request.encoded_prompt), reused)
+                rows.append(
+                    self.prefix_cache.get(request.encoded_prompt, reused, namespace=request.prefix_lm_mask)
+                    if reused > 0 else None
+                )
+
+            template = next(row for row in rows if row is not None)
+            past_key_values = concat_past_key_values_list([
+                pad_past_key_values(row, cached_length - row[0][0].size(-2)) if row is not None else
+                tuple(
+                    tuple(state.new_zeros(state.shape[:-2] + (cached_length, state.size(-1))) for state in layer)
+                    for layer in template
+                )
+                for row in rows
+            ])
+        else:
+            for request in requests:
+                self.prefix_cache.record(len(request.encoded_prompt), 0)
+
+        position_ids = attention_mask.long().cumsum(-1) - 1
+        position_ids.masked_fill_(attention_mask == 0, 1)
+
+        outputs = self.model(
+            input_ids=input_ids[:, cached_length:],
+            past_key_values=past_key_values,
+            attention_mask=attention_mask,
+            position_ids=position_ids[:, cached_length:],
+            use_cache=True,
+            prefix_lm_mask=prefix_lm_mask,
+            return_dict=True,
+            num_logits_to_keep=1
+        )
+
+        for i, request in enumerate(requests):
+            start = max_len - len(request.encoded_prompt)
+            self.prefix_cache.insert(
+                request.encoded_prompt,
+                tuple(tuple(state[i:i + 1, :, start:] for state in layer) for layer in outputs.past_key_values),
+                namespace=request.prefix_lm_mask
+            )
+
+        return outputs.past_key_values, outputs.logits[:, -1, :].float()
+
+    def _left_pad(self, batch, pad_length):
+        if pad_length == 0:
+            return batch
+        batch.input_ids = nn.functional.pad(batch.input_ids, (pad_length, 0), value=self.pad_token_id)
+        batch.attention_mask = nn.functional.pad(batch.attention_mask, (pad_length, 0), value=0)
+        batch.past_key_values = pad_past_key_values(batch.past_key_values, pad_length)
+        if batch.prefix_lm_mask is not None:
+            batch.prefix_lm_mask = batch.prefix_lm_mask + pad_length
+        return batch
+
+    def _merge(self, batch, other):
+        if batch is None:
+            return other
+
+        seq_len = max(batch.input_ids.size(-1), other.input_ids.size(-1))
+        batch = self._left_pad(batch, seq_len - batch.input_ids.size(-1))
+        other = self._left_pad(other, seq_len - other.input_ids.size(-1))
+
+        if (batch.prefix_lm_mask is None) != (other.prefix_lm_mask is None):
+            raise ValueError("Either all or none of the requests should have a `prefix_lm_mask`")
+
+        return _Batch(
+            requests=batch.requests + other.requests,
+            input_ids=torch.cat((batch.input_ids, other.input_ids), dim=0),
+            attention_mask=torch.cat((batch.attention_mask, other.attention_mask), dim=0),
+            past_key_values=concat_past_key_values(batch.past_key_values, other.past_key_values),
+            next_token_logits=torch.cat((batch.next_token_logits, other.next_token_logits), dim=0),
+            prefix_lm_mask=(
+                torch.cat((batch.prefix_lm_mask, other.prefix_lm_mask), dim=0)
+                if batch.prefix_lm_mask is not None else None
+            ),
+            num_new_tokens=batch.num_new_tokens + other.num_new_tokens
+        )
+
+    def _select(self, batch, keep):
+        keep_idx = torch.tensor(keep, dtype=torch.long, device=self.device)
+
+        batch.requests = [batch.requests[i] for i in keep]
+        batch.num_new_tokens = [batch.num_new_tokens[i] for i in keep]
+        batch.input_ids = batch.input_ids.index_select(0, keep_idx)
+        batch.attention_mask = batch.attention_mask.index_select(0, keep_idx)
+        batch.past_key_values = select_past_key_values(batch.past_key_values, keep_idx)
+        batch.next_token_logits = batch.next_token_logits.index_select(0, keep_idx)
+        if batch.prefix_lm_mask is not None:
+            batch.prefix_lm_mask = batch.prefix_lm_mask.index_select(0, keep_idx)
+
+        # drop the padding columns that only the removed (longest) rows needed
+        trim_length = int(batch.attention_mask.any(dim=0).long().argmax())
+        if trim_length > 0:
+            batch.input_ids = batch.input_ids[:, trim_length:]
+            batch.attention_mask = batch.attention_mask[:, trim_length:]
+            batch.past_key_values = trim_past_key_values(batch.past_key_values, trim_length)
+            if batch.prefix_lm_mask is not None:
+                batch.prefix_lm_mask = batch.prefix_lm_mask - trim_length
+        return batch
+
+    def _next_tokens(self, batch):
+        next_tokens, _ = self.model._sample_next_tokens(
+            batch.input_ids,
+            batch.next_token_logits,
+            self.logits_processor,
+            self.logits_warper,
+            sample_replacement=self.sample_replacement,
+            do_sample=self.do_sample
+        )
+        return next_tokens
+
+    @torch.no_grad()
+    def generate(self, requests: Iterable[GenerationRequest]) -> Iterator[Tuple[GenerationRequest, List[int]]]:
+        """
+        Yields `(request, sequence)` pairs in the order the rows finish, `sequence` being the un-padded prompt
+        followed by the generated tokens (the last one is `eos_token_id` unless the length limit was hit).
+        """
+        requests = iter(requests)
+        exhausted = False
+        batch = None
+        start_time = time.time()
+
+        while True:
+            # fill the free slots with new prompts
+            num_free = self.num_slots - (len(batch) if batch is not None else 0)
+            if num_free > 0 and not exhausted:
+                new_requests = []
+                for request in requests:
+                    new_requests.append(request)
+                    if len(new_requests) == num_free:
+                        break
+                else:
+                    exhausted = True
+
+                if new_requests:
+                    batch = self._merge(batch, self._prefill(new_requests))
+
+            if batch is None or len(batch) == 0:
+                break
+
+            next_tokens = self._next_tokens(batch)
+            batch.input_ids = torch.cat([batch.input_ids, next_tokens[:, None]], dim=-1)
+            batch.attention_mask = torch.cat(
+                [batch.attention_mask, batch.attention_mask.new_ones((len(batch), 1))], dim=-1
+            )
+
+            self.stats.decode_steps += 1
+            self.stats.occupied_slots += len(batch)
+            self.stats.total_slots += self.num_slots
+            self.stats.generated_tokens += len(batch)
+
+            keep = []
+            finished = (next_tokens == self.eos_token_id).tolist()
+            next_tokens = next_tokens.tolist()
+            for i, request in enumerate(batch.requests):
+                batch.num_new_tokens[i] += 1
+                if self.stopping_criteria is not None and self._trackers[id(request)].feed(next_tokens[i]):
+                    finished[i] = True
+                if finished[i] or batch.num_new_tokens[i] >= self.length_limit(request):
+                    self._trackers.pop(id(request), None)
+                    num_tokens = len(request.encoded_prompt) + batch.num_new_tokens[i]
+                    yield request, batch.input_ids[i, -num_tokens:].tolist()
+                else:
+                    keep.append(i)
+
+            if not keep:
+                batch = None
+                continue
+            if len(keep) < len(batch):
+                batch = self._select(batch, keep)
+
+            batch.past_key_values, batch.next_token_logits = self._forward(
+                batch.input_ids, batch.attention_mask, batch.past_key_values, batch.prefix_lm_mask
+            )
+
+        self.stats.elapsed += time.time() - start_time
@@ -15,74 +15,71 @@
 
 from typing import Any, Optional
 import torch
-import itertools
-import numpy as np
 
 
 def create_attn_masks_and_pos(lengths, prefix_token_idxs):
-    # 1. locate [EOT] token for the current instance
-    # 2. attention_mask = causal_attention_mask, so replicate this as a BxNxN matrix to be given to the model
-    b = len(lengths)
-    n = max([sum(l) for l in lengths])
-    attention_masks = torch.zeros((b, n, n))
-    position_ids = -100 * torch.ones((b, n)).long()
-    prefix_mask = torch.zeros((b, n, n)).long()
-
-    for i, l in enumerate(lengths):  # for each new instance
-        csum_lengths = np.cumsum(l)
-        prefixes = prefix_token_idxs[i]
-
-        for j in range(len(csum_lengths)):
-            cur, prev = csum_lengths[j], csum_lengths[j - 1]
-            if j == 0:
-                attention_masks[i, :cur, :cur] = torch.tril(torch.ones(cur, cur))
-                prefix_mask[i, :prefixes[j]+1, :prefixes[j]+1] = 1
-
-                if len(csum_lengths) == 1:
-                    position_ids[i, :n] = torch.arange(0, n)  # single element
-                else:
-                    position_ids[i, :cur] = torch.arange(0, cur)
-
-            else:
-                attention_masks[i, prev:cur, prev:cur] = torch.tril(torch.ones(cur - prev, cur - prev))
-                prefix_mask[i, prev:prev + prefixes[j]+1, prev:prev + prefixes[j]+1] = 1
-
-                # if last element in the batch, fill position ids until the end
-                if j == len(csum_lengths) - 1:
-                    position_ids[i, prev:n] = torch.arange(0, n - prev)
-                else:
-                    position_ids[i, prev:cur] = torch.arange(0, cur - prev)
-
-    # import matplotlib.pyplot as plt
-    # import seaborn as sns
-    # import pandas as pd
-    # fig = plt.figure(figsize=(20,15))
-    # sns.heatmap(prefix_mask[0].numpy(), vmin=0.0, vmax=1.0, linewidth=0.5, cmap=sns.color_palette("rocket_r", as_cmap=True))
-    # fig.tight_layout()
-    # fig.savefig('tmp.png', bbox_inches='tight', dpi=600)
-    #
-    # fig = plt.figure(figsize=(20, 15))
-    # sns.heatmap(attention_masks[0].numpy(), vmin=0.0, vmax=1.0, linewidth=0.5,
-    #             cmap=sns.color_palette("rocket_r", as_cmap=True))
-    # fig.tight_layout()
-    # fig.savefig('tmp2.png', bbox_inches='tight', dpi=600)
-    #
-    # exit(0)
+    """
+    Dense masks of packed documents: a BxNxN block-diagonal causal attention mask, the BxNxN prefix mask (each
+    document attends bidirectionally inside its prefix) and the position ids of the tokens in their document, all
+    broadcast from the segment ids of `create_segment_ids_and_pos`
+    """
+    segment_ids, position_ids, prefix_flags = create_segment_ids_and_pos(lengths, prefix_token_idxs)
+    n = segment_ids.size(1)
+
+    same_segment = (segment_ids[:, :, None] == segment_ids[:, None, :]) & (segment_ids[:, :, None] >= 0)
+    causal = torch.tril(torch.ones((n, n), dtype=torch.bool))
+    attention_masks = (same_segment & causal).float()
+    prefix_mask = (same_segment & prefix_flags[:, :, None] & prefix_flags[:, None, :]).long()
+
     assert torch.all(position_ids != -100), f"Careful! Position IDs contain -100!\n{position_ids}"
     return attention_masks, position_ids, prefix_mask
 
 
+def create_segment_ids_and_pos(lengths, prefix_token_idxs):
+    """
+    Packed counterpart of `create_attn_masks_and_pos`, in O(batch x length): the attention layers build the
+    block-diagonal causal and prefix-LM masks from these (see `packed_attention_mask`)
+
+    Returns:
+        segment_ids: index of the document of every position, -1 for padding
+        position_ids: position of every token in its document (the last document covers the padding)
+        prefix_mask: whether every position is in the prefix of its document
+    """
+    doc_lengths = torch.nn.utils.rnn.pad_sequence(
+        [torch.tensor(l).long() for l in lengths], batch_first=True, padding_value=0
+    )
+    doc_prefixes = torch.nn.utils.rnn.pad_sequence(
+        [torch.tensor(p).long() for p in prefix_token_idxs], batch_first=True, padding_value=0
+    )
+    num_docs = torch.tensor([len(l) for l in lengths])
+    doc_ends = torch.cumsum(doc_lengths, dim=1)
+    totals = doc_ends[:, -1:]
+    b, n = len(lengths), int(totals.max())
+
+    positions = torch.arange(n).expand(b, n).contiguous()
+    # document of every position: number of documents ending before it, the last one for the padding
+    segments = torch.searchsorted(doc_ends, positions, right=True)
+    segments = torch.minimum(segments, (num_docs - 1)[:, None])
+    padding = positions >= totals
+
+    position_ids = positions - (doc_ends - doc_lengths).gather(1, segments)
+    prefix_mask = ~padding & (position_ids <= doc_prefixes.gather(1, segments))
+    segment_ids = segments.masked_fill(padding, -1)
+    return segment_ids, position_ids, prefix_mask
+
+
 class DataCollatorWithPaddingForCorruptCLM:
     """
     Data collator used for causal language modeling.
     - collates batches of tensors, honoring their tokenizer's pad_token
     """
-    def __init__(self, tokenizer=None, predict_code=False, prefix_lm=False, code_mask=False):
+    def __init__(self, tokenizer=None, predict_code=False, prefix_lm=False, code_mask=False, packed_masks=False):
         self.mlm_probability = 0.15
         self.tokenizer = tokenizer
         self.predict_code = predict_code
         self.prefix_lm = prefix_lm
         self.code_mask = code_mask
+        self.packed_masks = packed_masks
 
         self.unk_token = '<|unkoftext|>' if '<|unkoftoken|>' in self.tokenizer.all_special_tokens else '<unk>'
         self.pad_token = '<|padoftext|>' if '<|padoftext|>' in self.tokenizer.all_special_tokens else '<pad>'
@@ -153,10 +150,16 @@ class DataCollatorWithPaddingForCorruptCLM:
         # Give corrupted docstring to the input
         inputs = torch.where(docstr_mask, mlm_inputs, clm_inputs)
 
-        attention_masks, position_ids, prefix_mask = create_attn_masks_and_pos(
-            [e['length'] for e in examples],
-            [e['prefix_lm_token_idx'] for e in examples]
-        )
+        if self.packed_masks:
+            segment_ids, position_ids, prefix_mask = create_segment_ids_and_pos(
+                [e['length'] for e in examples],
+                [e['prefix_lm_token_idx'] for e in examples]
+            )
+        else:
+            attention_masks, position_ids, prefix_mask = create_attn_masks_and_pos(
+                [e['length'] for e in examples],
+                [e['prefix_lm_token_idx'] for e in examples]
+            )
 
         labels = torch.nn.utils.rnn.pad_sequence(
             [torch.tensor(e['input_ids']) for e in examples],
@@ -170,10 +173,13 @@ class DataCollatorWithPaddingForCorruptCLM:
         output_dict = {
             'input_ids': inputs,
             'labels': labels,
-            "attention_mask": attention_masks,
             "position_ids": position_ids,
             'docstr_mask': docstr_mask
         }
+        if self.packed_masks:
+            output_dict.update({"segment_ids": segment_ids})
+        else:
+            output_dict.update({"attention_mask": attention_masks})
 
         if self.code_mask:
             output_dict.update({"code_mask": code_mask})
@@ -188,11 +194,12 @@ class DataCollatorWithPaddingForCLM:
     Data collator used for causal language modeling.
     - collates batches of tensors, honoring their tokenizer's pad_token
     """
-    def __init__(self, predict_code=False, tokenizer=None, prefix_lm=False, code_mask=False):
+    def __init__(self, predict_code=False, tokenizer=None, prefix_lm=False, code_mask=False, packed_masks=False):
         self.predict_code = predict_code
         self.tokenizer = tokenizer
         self.prefix_lm = prefix_lm
         self.code_mask = code_mask
+        self.packed_masks = packed_masks
 
         self.eot_token = 'eot'
         self.unk_token = '<|unkoftext|>' if '<|unkoftoken|>' in self.tokenizer.all_special_tokens else '<unk>'
@@ -209,10 +216,16 @@ class DataCollatorWithPaddingForCLM:
             padding_value=self.unk_token_id
         )
 
-        attention_masks, position_ids, prefix_mask = create_attn_masks_and_pos(
-            [e['length'] for e in examples],
-            [e['prefix_lm_token_idx'] for e in examples]
-        )
+        if self.packed_masks:
+            segment_ids, position_ids, prefix_mask = create_segment_ids_and_pos(
+                [e['length'] for e in examples],
+                [e['prefix_lm_token_idx'] for e in examples]
+            )
+        else:
+            attention_masks, position_ids, prefix_mask = create_attn_masks_and_pos(
+                [e['length'] for e in examples],
+                [e['prefix_lm_token_idx'] for e in examples]
+            )
 
         labels = torch.nn.utils.rnn.pad_sequence(
             [torch.tensor(e['input_ids']).long() for e in examples],
@@ -239,10 +252,13 @@ class DataCollatorWithPaddingForCLM:
         output_dict = {
             "input_ids": inputs,
             "labels": labels,
-            "attention_mask": attention_masks,
             "position_ids": position_ids,
             "docstr_mask": docstr_mask
         }
+        if self.packed_masks:
+            output_dict.update({"segment_ids": segment_ids})
+        else:
+            output_dict.update({"attention_mask": attention_masks})
 
         if self.code_mask:
             output_dict.update({"code_mask": code_mask})
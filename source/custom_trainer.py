@@ -25,6 +25,7 @@ from transformers.deepspeed import deepspeed_init
 from transformers.trainer_utils import has_length
 import copy
 from optimization import get_cosine_schedule_with_warmup
+from compilation import compile_model
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +35,7 @@ from transformers.trainer_pt_utils import *
 class CustomTrainer(Trainer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        compile_model(self.model, getattr(self.args, 'compile_mode', 'none'))
 
     def create_scheduler(self, num_training_steps: int, optimizer: torch.optim.Optimizer = None):
         """
@@ -51,6 +53,14 @@ class CustomTrainer(Trainer):
         )
         return self.lr_scheduler
 
+    def autocast_smart_context_manager(self):
+        """
+        bf16 autocast on CPU with `cpu_bf16`, the context of the `Trainer` otherwise
+        """
+        if getattr(self.args, 'cpu_bf16', False):
+            return torch.autocast(device_type='cpu', dtype=torch.bfloat16)
+        return super().autocast_smart_context_manager()
+
     def log(self, logs: Dict[str, float]) -> None:
         """
         Log `logs` on the various objects watching training.
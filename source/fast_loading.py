@@ -0,0 +1,137 @@
+# Copyright (C) 2024. Huawei Technologies Co., Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+
+import os
+import re
+import json
+import mmap
+import struct
+import inspect
+import logging
+import contextlib
+from typing import Dict
+import torch
+from torch import nn
+from transformers.modeling_utils import no_init_weights
+from quantization import quantize_model
+
+
+logger = logging.getLogger(__name__)
+
+SAFETENSORS_WEIGHTS_NAME = 'model.safetensors'
+
+_SAFETENSORS_DTYPES = {
+    'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+    'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8, 'U8': torch.uint8,
+    'BOOL': torch.bool,
+}
+
+
+def is_safetensors_checkpoint(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, SAFETENSORS_WEIGHTS_NAME))
+
+
+def save_safetensors_model(model: nn.Module, save_directory: str):
+    """
+    Writes the configuration and the state dict of `model` as a `model.safetensors` export for
+    `load_safetensors_model`. Tensors sharing their storage (the output layer tied to the embeddings) are written once,
+    the models tie them again when loaded. Quantized models are exported as they are, with their `weight_quantization`.
+    """
+    from safetensors.torch import save_file
+
+    os.makedirs(save_directory, exist_ok=True)
+    model.config.save_pretrained(save_directory)
+    state_dict, seen = {}, set()
+    for name, tensor in model.state_dict().items():
+        key = (tensor.device, tensor.data_ptr(), tensor.dtype, tuple(tensor.shape))
+        if tensor.numel() and key in seen:
+            continue
+        seen.add(key)
+        state_dict[name] = tensor.detach().cpu().contiguous()
+    path = os.path.join(save_directory, SAFETENSORS_WEIGHTS_NAME)
+    save_file(state_dict, path, metadata={'format': 'pt'})
+    logger.info(f'Model exported to {path}')
+    return path
+
+
+def mmap_safetensors(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Tensors of a safetensors file as views of a private (copy-on-write) memory map of it: nothing is read before a
+    tensor is used, the pages come from the page cache shared by all the processes mapping the file, and nothing is
+    copied unless a tensor is written to. `safetensors.torch.load_file` copies every tensor out of its map instead.
+    """
+    with open(path, 'rb') as f:
+        header_size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size))
+        header.pop('__metadata__', None)
+        if not header:
+            return {}
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    data = torch.frombuffer(buffer, dtype=torch.uint8)
+    data_start = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        dtype = _SAFETENSORS_DTYPES[info['dtype']]
+        start, end = (data_start + offset for offset in info['data_offsets'])
+        values = data[start:end]
+        if start % torch.empty((), dtype=dtype).element_size() != 0:
+            values = values.clone()  # misaligned for its dtype, which safetensors writers avoid
+        tensors[name] = values.view(dtype).reshape(info['shape'])
+    return tensors
+
+
+def _can_assign_parameters() -> bool:
+    # modules built on the meta device, whose state is replaced by the mapped tensors (torch >= 2.1)
+    return 'assign' in inspect.signature(nn.Module.load_state_dict).parameters
+
+
+def load_safetensors_model(model_class, path: str, torch_dtype=None, **model_kwargs):
+    """
+    Loads a `save_safetensors_model` export without reading it: the model is built on the meta device (so neither
+    allocated nor randomly initialised) and its parameters and buffers become the memory-mapped tensors of the file.
+    They are only copied when converted to another `torch_dtype` or moved to another device, and the export already
+    has the resized embeddings of its tokenizer. With torch < 2.1 the model is built without its initialisation and
+    the mapped tensors are copied into it. `model_kwargs` are passed to the model constructor (`args` and `tokenizer`
+    of the models of this repository).
+    """
+    config = model_class.config_class.from_pretrained(path)
+    state_dict = mmap_safetensors(os.path.join(path, SAFETENSORS_WEIGHTS_NAME))
+    weight_quantization = getattr(config, 'weight_quantization', None)
+
+    assign = _can_assign_parameters()
+    with no_init_weights(), torch.device('meta') if assign else contextlib.nullcontext():
+        model = model_class(config, **model_kwargs)
+        if weight_quantization:
+            quantize_model(model, weight_quantization['mode'], weight_quantization['group_size'], empty=True)
+
+    if assign:
+        missing, unexpected = model.load_state_dict(state_dict, strict=False, assign=True)
+    else:
+        missing, unexpected = model.load_state_dict(state_dict, strict=False)
+    if unexpected:
+        raise ValueError(f"Unexpected tensors in {path}: {unexpected}")
+    model.tie_weights()
+    if assign:
+        missing = [name for name, tensor in model.state_dict().items() if tensor.is_meta]
+    else:
+        ignored = model._keys_to_ignore_on_load_missing or []
+        missing = [name for name in missing if not any(re.search(pattern, name) for pattern in ignored)]
+    if missing:
+        raise ValueError(f"Tensors missing from {path}: {missing}")
+
+    if isinstance(torch_dtype, torch.dtype):
+        model.to(torch_dtype)
+    return model.eval()
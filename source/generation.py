@@ -18,8 +18,8 @@ import os
 import re
 from typing import Optional
 from dataclasses import dataclass, field
-from utils import write_jsonl, read_problems
-from torch.utils.data import DataLoader, Dataset
+from utils import read_problems, stream_jsonl
+from torch.utils.data import DataLoader, Dataset, Sampler
 from tqdm import tqdm
 import torch
 import transformers
@@ -31,8 +31,24 @@ from pangu_alpha import (
     PanguAlphaTokenizer
 )
 from gpt_neo import GPTNeoForCausalLM
+from continuous_batching import ContinuousBatchingEngine, GenerationRequest, GenerationStats
+from prefix_cache import RadixPrefixCache
+from vocab_partition import VocabPartition, ReplicatedTokensRemapper, VOCAB_PARTITION_FILE
+from attention_masks import ATTENTION_BACKENDS, set_attention_backend
+from compilation import COMPILE_MODES, compile_model
+from fast_loading import is_safetensors_checkpoint, save_safetensors_model, load_safetensors_model
+from layer_streaming import stream_layers
+from quantization import (
+    QUANTIZATION_MODES, quantize_model, is_quantized_checkpoint, save_quantized_model, load_quantized_model
+)
+from pangu_alpha.generation_utils import FunctionBodyStoppingCriteria
+from resumable_output import ResumableOutput
+from generation_reports import FunctionBodyStopReport, SpeculationReport
+from transformers.generation_stopping_criteria import StoppingCriteriaList
+import time
 import pickle
-import copy
+import functools
+import resource
 import json
 
 
@@ -68,16 +84,116 @@ class Arguments:
     no_cuda: bool = field(default=False, metadata={"help": ""})
     num_return_sequences: int = field(default=1, metadata={"help": ""})
     mlp_samples: int = field(default=1, metadata={"help": ""})
-    torch_dtype: str = field(default="fp32", metadata={"help": "What dtype to load the model with"})
+    torch_dtype: str = field(
+        default="fp32",
+        metadata={"help": "What dtype to load the model with: fp32, fp16, bf16 (e.g. on CPUs with AVX512-BF16 or AMX, "
+                          "softmax and sampling stay in fp32) or auto"}
+    )
     replicated_tokens_map: bool = field(default=False, metadata={"help": "Allow replicated embeddings"})
     data_path: str = field(default=None, metadata={'help': "data_path"})
     model_type: str = field(default='pangu', metadata={"help": "Model type"})
     incremental: bool = field(default=False, metadata={'help': "Use incremental generations"})
     show_examples: bool = field(default=False, metadata={'help': "Show example generation"})
+    continuous_batching: bool = field(
+        default=False,
+        metadata={'help': "Refill finished rows with new prompts on every decode step, using `batch_size` slots"}
+    )
+    prefix_cache_mb: int = field(
+        default=0,
+        metadata={'help': "Reuse the key/value states of cached prompt prefixes (e.g. of incremental tasks), keeping "
+                          "at most this many MB of states. Implies --continuous_batching"}
+    )
+    stop_at_function_end: bool = field(
+        default=False,
+        metadata={'help': "Finish a sequence once the function body dedents back to column 0, since the evaluation "
+                          "drops everything after it"}
+    )
+    num_workers: int = field(
+        default=1,
+        metadata={'help': "Number of CPU generation processes sharing one copy of the weights, each pinned to its own "
+                          "slice of cores. Requires --no_cuda"}
+    )
+    compact_vocab: bool = field(
+        default=False,
+        metadata={'help': "With replicated tokens, compute and sample the logits of the code tokens only"}
+    )
+    compact_vocab_file: str = field(
+        default=None,
+        metadata={'help': "Compacted vocabulary exported by an earlier run, it is created there if it does not exist"}
+    )
+    draft_model_name_or_path: str = field(
+        default=None,
+        metadata={'help': "Small PyCodeGPT model with the same tokenizer that proposes tokens for speculative decoding"}
+    )
+    num_draft_tokens: int = field(default=4, metadata={'help': "Tokens proposed by the draft model per step"})
+    prompt_lookup_ngram_size: int = field(
+        default=0,
+        metadata={'help': "Speculative decoding without a draft model: propose the tokens that followed the last "
+                          "n-gram (of at most this size) earlier in the prompt or generation"}
+    )
+    resume: bool = field(
+        default=False,
+        metadata={'help': "Continue a killed run from its output manifest instead of starting over"}
+    )
+    length_bucketing: bool = field(
+        default=False,
+        metadata={'help': "Batch prompts of similar length together to reduce left padding, outputs keep the dataset "
+                          "order"}
+    )
+    static_cache: bool = field(
+        default=False,
+        metadata={'help': "Decode into a key/value cache preallocated to the maximum length (local attention layers "
+                          "only keep their window and the prefix)"}
+    )
+    fan_out: bool = field(
+        default=False,
+        metadata={'help': "Prefill every prompt once and sample all its sequences from the shared cache, "
+                          "`batch_size` sequences at a time"}
+    )
+    attention_backend: str = field(
+        default='eager',
+        metadata={'help': f"Attention implementation, one of {ATTENTION_BACKENDS}: `sdpa` uses the fused "
+                          "scaled_dot_product_attention of torch >= 2.0, `eager` reproduces the reference outputs "
+                          "exactly"}
+    )
+    quantization: str = field(
+        default='none',
+        metadata={'help': f"Weight-only quantization of the attention and MLP projections, one of "
+                          f"{QUANTIZATION_MODES}, without calibration. int8_dynamic also quantizes the activations "
+                          "of the int8 projections per token on CPU, which is faster but less accurate. Checkpoints "
+                          "saved with --quantized_output_dir are loaded quantized whatever this is set to"}
+    )
+    quantization_group_size: int = field(
+        default=None,
+        metadata={'help': "Input features sharing a quantization scale (128 by default with int4, all of them with "
+                          "int8)"}
+    )
+    quantized_output_dir: str = field(
+        default=None,
+        metadata={'help': "Save the quantized model and tokenizer there, to be loaded as --model_name_or_path"}
+    )
+    safetensors_output_dir: str = field(
+        default=None,
+        metadata={'help': "Export the (quantized) model and tokenizer there as model.safetensors, to be loaded as "
+                          "--model_name_or_path: the weights are memory-mapped instead of read, and shared with the "
+                          "generation workers and other runs through the page cache"}
+    )
+    compile_mode: str = field(
+        default='none',
+        metadata={'help': f"torch.compile the prefill and decode forwards (torch >= 2.0), one of {COMPILE_MODES}. "
+                          "Not with --num_workers > 1"}
+    )
+    layer_streaming: bool = field(
+        default=False,
+        metadata={'help': "Keep the transformer blocks of a safetensors --model_name_or_path on disk and page them in "
+                          "one at a time, prefetching the next one, for models that barely fit in RAM next to their "
+                          "KV cache. CPU only, with the --torch_dtype of the export"}
+    )
 
 class PycodegptDataset(Dataset):
     def __init__(self, problems, args=None, tokenizer=None):
         self.problems = []
+        remapper = ReplicatedTokensRemapper(args.replicated_tokens_map) if args.replicated_tokens_map else None
 
         pbar = tqdm(problems)
         for task_id in pbar:
@@ -97,25 +213,13 @@ class PycodegptDataset(Dataset):
                 docstring_ids = tokenizer.encode('\n    \"\"\" ' + docstring + ' \"\"\"', add_special_tokens=False)
 
             code_ids = tokenizer.encode(signature, add_special_tokens=False)
-            if args.replicated_tokens_map:
-                new_code_ids = []
-                for cid in code_ids:
-                    if cid in args.replicated_tokens_map:
-                        new_code_ids.append(args.replicated_tokens_map[cid])
-                    else:
-                        new_code_ids.append(cid)
-                code_ids = copy.deepcopy(new_code_ids)
+            if remapper is not None:
+                code_ids = remapper(code_ids)
 
             if problems[task_id]['completion'] != '':  # for incremental
                 completion_ids = tokenizer.encode(problems[task_id]['completion'], add_special_tokens=False)
-                if args.replicated_tokens_map:
-                    new_complition_ids = []
-                    for cid in completion_ids:
-                        if cid in args.replicated_tokens_map:
-                            new_complition_ids.append(args.replicated_tokens_map[cid])
-                        else:
-                            new_complition_ids.append(cid)
-                    completion_ids = copy.deepcopy(new_complition_ids)
+                if remapper is not None:
+                    completion_ids = remapper(completion_ids)
 
                 comp_len = len(completion_ids)
                 encoded_prompt = [tokenizer.convert_tokens_to_ids('<|beginoftext|>')] + \
@@ -157,6 +261,7 @@ class PycodegptDataset(Dataset):
 class PanguDataset(Dataset):
     def __init__(self, problems, args=None, tokenizer=None):
         self.problems = []
+        remapper = ReplicatedTokensRemapper(args.replicated_tokens_map) if args.replicated_tokens_map else None
 
         pbar = tqdm(problems)
         for task_id in pbar:
@@ -176,14 +281,8 @@ class PanguDataset(Dataset):
                 comp_len = 0
                 code_ids = tokenizer.encode(code, add_special_tokens=False)
 
-            if args.replicated_tokens_map:
-                new_code_ids = []
-                for cid in code_ids:
-                    if cid in args.replicated_tokens_map:
-                        new_code_ids.append(args.replicated_tokens_map[cid])
-                    else:
-                        new_code_ids.append(cid)
-                code_ids = copy.deepcopy(new_code_ids)
+            if remapper is not None:
+                code_ids = remapper(code_ids)
 
             encoded_code = [tokenizer.convert_tokens_to_ids('<python>')] + code_ids
 
@@ -219,6 +318,8 @@ class MyCollate:
         self.tokenizer = tokenizer
 
     def __call__(self, batch):
+        # padding is added to copies, the dataset items are batched with other prompts on the next sample
+        batch = [dict(item) for item in batch]
         task_id_batch = [item['task_id'] for item in batch]
         orig_prompt_batch = [item['original_prompt'] for item in batch]
 
@@ -243,6 +344,32 @@ class MyCollate:
         return task_id_batch, prompt_length_batch, problem_batch, attnmasks_batch, prefix_batch, orig_prompt_batch
 
 
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batches of dataset indices sorted by prompt length, so that `MyCollate` left-pads every prompt to a similar
+    length instead of to the longest prompt of a random slice of the dataset. Batches are yielded longest first,
+    which also surfaces out of memory errors on the first batch.
+    """
+    def __init__(self, dataset, batch_size, indices=None):
+        self.batch_size = batch_size
+        indices = range(len(dataset)) if indices is None else indices
+        order = sorted(indices, key=lambda idx: len(dataset[idx]['encoded_prompt']), reverse=True)
+        self.batches = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def padding_ratio(attention_mask):
+    """
+    Fraction of the prompt positions of a batch that are padding
+    """
+    return 1.0 - attention_mask.sum().item() / attention_mask.numel()
+
+
 def post_process_generated_tokens(generated_tokens, indent_spaces=4):
     generated_tokens = ''.join(generated_tokens).replace('\u2581', ' ').replace('[_DUP_]', '')
     generated_tokens = generated_tokens.split("<NEW_LINE>")
@@ -270,6 +397,8 @@ def main():
     if args.replicated_tokens_map:
         with open(os.path.join(args.data_path, 'replicated_tokens_map.pkl'), 'rb') as f:
             args.replicated_tokens_map = pickle.load(f)
+        if os.path.exists(os.path.join(args.data_path, VOCAB_PARTITION_FILE)):
+            args.vocab_partition = VocabPartition.load(os.path.join(args.data_path, VOCAB_PARTITION_FILE))
 
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
@@ -291,6 +420,9 @@ def main():
     if args.torch_dtype == 'fp16':
         logger.info("========== Using FP16 to load the model ==========")
         dtype = torch.float16
+    elif args.torch_dtype == 'bf16':
+        logger.info("========== Using BF16 to load the model ==========")
+        dtype = torch.bfloat16
     elif args.torch_dtype == 'fp32':
         logger.info("========== Using FP32 to load the model ==========")
         dtype = torch.float32
@@ -298,13 +430,86 @@ def main():
         logger.info("========== Using AUTO to load the model ==========")
         dtype = "auto"
 
-    model = model2model[args.model_type].from_pretrained(
-        args.model_name_or_path,
-        args=args,
-        torch_dtype=dtype,
-        tokenizer=tokenizer
-    )
-    model.to('cuda')
+    start_time = time.time()
+    if is_safetensors_checkpoint(args.model_name_or_path):
+        model = load_safetensors_model(
+            model2model[args.model_type],
+            args.model_name_or_path,
+            torch_dtype=dtype,
+            args=args,
+            tokenizer=tokenizer
+        )
+        weight_quantization = getattr(model.config, 'weight_quantization', None)
+        args.quantization = weight_quantization['mode'] if weight_quantization else 'none'
+        logger.info(f'Memory-mapped the model from {args.model_name_or_path}')
+    elif is_quantized_checkpoint(args.model_name_or_path):
+        model = load_quantized_model(
+            model2model[args.model_type],
+            args.model_name_or_path,
+            torch_dtype=dtype,
+            args=args,
+            tokenizer=tokenizer
+        )
+        args.quantization = model.config.weight_quantization['mode']
+        logger.info(f'Loaded the {args.quantization} quantized model from {args.model_name_or_path}')
+    else:
+        model = model2model[args.model_type].from_pretrained(
+            args.model_name_or_path,
+            args=args,
+            torch_dtype=dtype,
+            tokenizer=tokenizer
+        )
+        quantize_model(model, args.quantization, args.quantization_group_size)
+        if args.quantized_output_dir and args.quantization != 'none':
+            save_quantized_model(model, args.quantized_output_dir)
+            tokenizer.save_pretrained(args.quantized_output_dir)
+    if args.safetensors_output_dir:
+        save_safetensors_model(model, args.safetensors_output_dir)
+        tokenizer.save_pretrained(args.safetensors_output_dir)
+    model.to('cpu' if args.no_cuda else 'cuda')
+    logger.info(f'Model loaded in {time.time() - start_time:.2f}s')
+    args.attention_backend = set_attention_backend(model, args.attention_backend)
+
+    if args.draft_model_name_or_path or args.prompt_lookup_ngram_size > 0:
+        if args.continuous_batching or args.prefix_cache_mb > 0 or args.static_cache or args.compact_vocab:
+            raise ValueError("Speculative decoding works with the batched and fan-out generation, without static cache "
+                             "or compacted vocabulary")
+    if args.compile_mode != 'none' and args.num_workers > 1:
+        raise ValueError("Compiled models cannot be shared with generation workers, use --num_workers 1")
+    if args.layer_streaming:
+        if not is_safetensors_checkpoint(args.model_name_or_path) or not args.no_cuda:
+            raise ValueError("Layer streaming runs on CPU (--no_cuda), from a safetensors export")
+        if args.compile_mode != 'none' or (args.compact_vocab and args.num_workers > 1):
+            raise ValueError("Layer streaming works without --compile_mode, and without --compact_vocab with workers")
+        stream_layers(model)
+
+    if args.compact_vocab:
+        if args.compact_vocab_file and os.path.exists(args.compact_vocab_file):
+            logger.info(f'Loading the compacted vocabulary from {args.compact_vocab_file}')
+            compact_vocab = torch.load(args.compact_vocab_file)
+            model.compact_vocabulary(compact_vocab['token_ids'], compact_vocab['weight'])
+        else:
+            model.compact_vocabulary()
+            if args.compact_vocab_file:
+                model.save_compact_vocabulary(args.compact_vocab_file)
+        logger.info(f'Sampling from {model.compact_token_ids.numel()} code tokens out of {len(tokenizer)}')
+
+    draft_model = None
+    if args.draft_model_name_or_path:
+        logger.info(f'Loading draft model: {args.draft_model_name_or_path}')
+        draft_model = GPTNeoForCausalLM.from_pretrained(
+            args.draft_model_name_or_path,
+            args=args,
+            torch_dtype=dtype,
+            tokenizer=tokenizer
+        )
+        quantize_model(draft_model, args.quantization, args.quantization_group_size)
+        set_attention_backend(draft_model, args.attention_backend)
+        draft_model.to(model.device).eval()
+
+    compile_model(model, args.compile_mode)
+    if draft_model is not None:
+        compile_model(draft_model, args.compile_mode)
 
     ##########################
     # Example Generation
@@ -334,19 +539,220 @@ def main():
             args=args
         )
 
-    dataloader = DataLoader(
-        dataset,
-        batch_size=args.batch_size,
-        collate_fn=MyCollate(args=args, tokenizer=tokenizer),
-        shuffle=False
+    model.eval()
+
+    if args.num_workers > 1:
+        generated_sequences = generate_sharded(model, dataset, tokenizer, args, draft_model=draft_model)
+    else:
+        generated_sequences = run_generation(model, dataset, tokenizer, args, output_file_name(args),
+                                             draft_model=draft_model)
+    # kilobytes on Linux, of this process only (not of the sharded workers)
+    logger.info(f'Peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB')
+    return generated_sequences
+
+
+def run_generation(model, dataset, tokenizer, args, filename, rank=0, num_workers=1, draft_model=None):
+    output = ResumableOutput(
+        filename,
+        task_ids=[dataset[idx]['task_id'] for idx in range(len(dataset))],
+        mlp_samples=args.mlp_samples,
+        resume=args.resume,
+        rank=rank,
+        num_workers=num_workers
     )
-    generated_sequences = []
 
-    model.eval()
+    stop_report = None
+    if args.stop_at_function_end:
+        stop_report = FunctionBodyStopReport(
+            FunctionBodyStoppingCriteria(tokenizer, replicated_tokens_map=args.replicated_tokens_map or None)
+        )
+
+    speculation = None
+    if draft_model is not None or args.prompt_lookup_ngram_size > 0:
+        speculation = SpeculationReport(
+            draft_model=draft_model,
+            num_draft_tokens=args.num_draft_tokens,
+            prompt_lookup_ngram_size=args.prompt_lookup_ngram_size or None
+        )
+
+    if args.continuous_batching or args.prefix_cache_mb > 0:
+        generated_sequences = generate_continuous(model, dataset, tokenizer, args, output, stop_report=stop_report)
+    elif args.fan_out:
+        generated_sequences = generate_fan_out(
+            model, dataset, tokenizer, args, output, stop_report=stop_report, speculation=speculation
+        )
+    else:
+        generated_sequences = generate_batched(
+            model, dataset, tokenizer, args, output, stop_report=stop_report, speculation=speculation
+        )
+
+    if stop_report is not None:
+        stop_report.log()
+        stop_report.write(filename.replace('.jsonl', '_function_end.jsonl'))
+    if speculation is not None:
+        speculation.log()
+        speculation.write(filename.replace('.jsonl', '_speculation.jsonl'))
+
+    return generated_sequences
+
+
+def worker_file_name(args, rank):
+    return output_file_name(args).replace('.jsonl', f'_worker={rank}of{args.num_workers}.jsonl')
+
+
+def generation_worker(rank, model, dataset, tokenizer, args, cores, draft_model=None):
+    """
+    Entry point of a `generate_sharded` process: the parameters of `model` are in shared memory, or `model` is the
+    loader of a safetensors export mapped by every worker, so the worker only pins itself to `cores` and runs its
+    share of the generation
+    """
+    if isinstance(model, functools.partial):
+        model = model()
+        set_attention_backend(model, args.attention_backend)
+        if args.layer_streaming:
+            stream_layers(model)
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    # every worker samples different tasks, a seed per worker keeps the merged output reproducible
+    set_seed(args.seed + rank)
+    logger.info(f'Worker {rank}: {len(cores)} cores ({min(cores)}-{max(cores)}), {torch.get_num_threads()} threads')
+
+    run_generation(
+        model, dataset, tokenizer, args, worker_file_name(args, rank),
+        rank=rank, num_workers=args.num_workers, draft_model=draft_model
+    )
+
+
+def generate_sharded(model, dataset, tokenizer, args, draft_model=None):
+    """
+    Splits the generation over `num_workers` CPU processes. The weights are moved to shared memory once, and the
+    spawned workers map them instead of loading their own copy, or the workers map the safetensors export the model
+    was loaded from, whose pages they share. Each worker writes its own output, which are merged in the order of a
+    single process run.
+    """
+    if not args.no_cuda:
+        raise ValueError("Sharded generation runs on CPU, use it with --no_cuda")
+
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < args.num_workers:
+        raise ValueError(f"{args.num_workers} workers need at least as many cores, only {len(cores)} are available")
+    # contiguous slices, which keeps a worker on one socket when the cores are numbered per socket
+    per_worker = len(cores) // args.num_workers
+    core_slices = [cores[rank * per_worker:(rank + 1) * per_worker] for rank in range(args.num_workers)]
+
+    if is_safetensors_checkpoint(args.model_name_or_path) and not args.compact_vocab:
+        model = functools.partial(
+            load_safetensors_model, type(model), args.model_name_or_path, torch_dtype=model.dtype, args=args,
+            tokenizer=tokenizer
+        )
+    else:
+        model.share_memory()
+    if draft_model is not None:
+        draft_model.share_memory()
+    context = torch.multiprocessing.get_context('spawn')
+    processes = []
+    for rank in range(args.num_workers):
+        process = context.Process(
+            target=generation_worker, args=(rank, model, dataset, tokenizer, args, core_slices[rank], draft_model)
+        )
+        process.start()
+        processes.append(process)
+
+    for process in processes:
+        process.join()
+    failed = [rank for rank, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Generation workers {failed} failed, rerun with --resume to finish their samples")
+
+    task_ids = [dataset[idx]['task_id'] for idx in range(len(dataset))]
+    output = ResumableOutput(output_file_name(args), task_ids=task_ids, mlp_samples=args.mlp_samples)
+    stop_report = FunctionBodyStopReport(criteria=None) if args.stop_at_function_end else None
+    speculation = None
+    if draft_model is not None or args.prompt_lookup_ngram_size > 0:
+        speculation = SpeculationReport(draft_model=None)
+    for rank in range(args.num_workers):
+        filename = worker_file_name(args, rank)
+        worker_output = ResumableOutput(filename, task_ids=task_ids, mlp_samples=args.mlp_samples, resume=True)
+        for key, sample in zip(worker_output.completed, stream_jsonl(filename)):
+            output.add(key, sample)
+        if stop_report is not None:
+            stop_report.read(filename.replace('.jsonl', '_function_end.jsonl'))
+        if speculation is not None:
+            speculation.read(filename.replace('.jsonl', '_speculation.jsonl'))
+
+    if stop_report is not None:
+        stop_report.log()
+        stop_report.write(output_file_name(args).replace('.jsonl', '_function_end.jsonl'))
+    if speculation is not None:
+        speculation.log()
+        speculation.write(output_file_name(args).replace('.jsonl', '_speculation.jsonl'))
+    return output.finalize()
+
+
+def output_file_name(args):
+    # quantized samples are kept apart from the floating point ones, to compare their pass@k
+    dtype = args.torch_dtype if args.quantization == 'none' else f'{args.torch_dtype}-{args.quantization}'
+    return os.path.join(
+        args.output_dir,
+        f"samples={args.num_return_sequences}_{dtype}_bs={args.batch_size}_t={args.temperature}_k={args.k}_p={args.p}.jsonl"
+    )
+
+
+def decode_generated_tokens(generated_sequence, tokenizer, args):
+    # Decode text
+    answer = tokenizer.convert_tokens_to_string(tokenizer.convert_ids_to_tokens(generated_sequence))
+
+    # Remove all text after the stop token
+    answer = answer[: answer.find(args.stop_token) if args.stop_token else None]
+
+    # post-process
+    return post_process_generated_tokens(answer)
+
+
+def count_generated_tokens(generated_sequence, eos_token_id, pad_token_id=None):
+    """
+    Number of tokens up to (and including) the first `eos_token_id`, i.e. the tokens a row actually needed.
+    Rows finished by another criterion are padded, the padding is not counted.
+    """
+    generated_sequence = generated_sequence.tolist() if isinstance(generated_sequence, torch.Tensor) else generated_sequence
+    if eos_token_id in generated_sequence:
+        return generated_sequence.index(eos_token_id) + 1
+    num_tokens = len(generated_sequence)
+    while pad_token_id is not None and num_tokens > 0 and generated_sequence[num_tokens - 1] == pad_token_id:
+        num_tokens -= 1
+    return num_tokens
+
+
+def generate_batched(model, dataset, tokenizer, args, output, stop_report=None, speculation=None):
+    pad_token_id = tokenizer.convert_tokens_to_ids('<pad>')
+    eos_token_id = tokenizer.convert_tokens_to_ids('<eot>')
+    stats = GenerationStats()
 
     for sample_no in tqdm(range(args.num_return_sequences), leave=False, desc='Generating samples'):
-        for task_ids, prompt_lengths, batch, attn_masks, prefix_idx, orig_prompts in \
-                tqdm(dataloader, leave=False, desc=f'For sample #{sample_no} / {args.num_return_sequences}'):
+        indices = [idx for idx in range(len(dataset)) if output.owns(sample_no, idx)]
+        if args.length_bucketing:
+            batch_sampler = LengthBucketBatchSampler(dataset, args.batch_size, indices=indices)
+        else:
+            batch_sampler = [indices[start:start + args.batch_size] for start in range(0, len(indices), args.batch_size)]
+
+        dataloader = DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=MyCollate(args=args, tokenizer=tokenizer)
+        )
+
+        for batch_indices, (task_ids, prompt_lengths, batch, attn_masks, prefix_idx, orig_prompts) in \
+                zip(batch_sampler, tqdm(dataloader, leave=False, desc=f'For sample #{sample_no} / {args.num_return_sequences}')):
+
+            # prompts are repeated `mlp_samples` times in a row
+            keys = [(sample_no, idx, j) for idx in batch_indices for j in range(args.mlp_samples)]
+            if all(output.is_done(key) for key in keys):
+                continue
+
+            batch_padding = padding_ratio(attn_masks)
+            stats.padding_tokens += int(attn_masks.numel() - attn_masks.sum().item())
+            stats.prompt_positions += attn_masks.numel()
+            logger.info(f'Batch of {batch.size(0)} prompts of {batch.size(-1)} tokens, {100 * batch_padding:.1f}% padding')
 
             if not args.no_cuda:
                 batch = batch.to('cuda')
@@ -355,8 +761,13 @@ def main():
                 if args.prefix_lm:
                     prefix_idx = prefix_idx.to('cuda')
 
-            pad_token_id = tokenizer.convert_tokens_to_ids('<pad>')
+            stopping_criteria = StoppingCriteriaList()
+            if stop_report is not None:
+                # prompts are repeated `mlp_samples` times in a row
+                stop_report.criteria.reset([length for length in prompt_lengths for _ in range(args.mlp_samples)])
+                stopping_criteria.append(stop_report.criteria)
 
+            start_time = time.time()
             with torch.no_grad():
                 output_sequences = model.generate(
                     input_ids=batch,
@@ -371,35 +782,202 @@ def main():
                     attention_mask=attn_masks,
                     prefix_lm_mask=prefix_idx if args.prefix_lm else None,
                     pad_token_id=pad_token_id,
-                    eos_token_id=tokenizer.convert_tokens_to_ids('<eot>'),
-                    sample_replacement=True
+                    eos_token_id=eos_token_id,
+                    sample_replacement=True,
+                    static_cache=args.static_cache,
+                    stopping_criteria=stopping_criteria,
+                    **(speculation.generate_kwargs() if speculation is not None else {})
                 )
+            stats.elapsed += time.time() - start_time
+            if args.max_seq_length:
+                length_limit = args.max_seq_length
+            elif args.max_new_tokens:
+                length_limit = batch.size(-1) + args.max_new_tokens
+            else:
+                length_limit = model.config.max_length
+
+            # every row occupies its slot until the slowest row of the batch is done
+            num_steps = output_sequences.size(-1) - batch.size(-1)
+            stats.decode_steps += num_steps
+            stats.total_slots += num_steps * output_sequences.size(0)
+
+            # prompts are repeated `mlp_samples` times in a row
+            prompt_lengths = [length for length in prompt_lengths for _ in range(args.mlp_samples)]
+            task_ids = [task_id for task_id in task_ids for _ in range(args.mlp_samples)]
+            orig_prompts = [orig_prompt for orig_prompt in orig_prompts for _ in range(args.mlp_samples)]
+            if speculation is not None:
+                speculation.add_rows(task_ids)
+
+            for row, (key, task_id, prompt_length, generated_sequence, orig_prompt) in \
+                    enumerate(zip(keys, task_ids, prompt_lengths, output_sequences, orig_prompts)):
+
+                num_tokens = count_generated_tokens(generated_sequence[batch.size(-1):], eos_token_id, pad_token_id)
+                stats.generated_tokens += num_tokens
+                stats.occupied_slots += num_tokens
+
+                if stop_report is not None:
+                    finished_at = stop_report.criteria.finished_at[row]
+                    stop_report.add(task_id, length_limit - finished_at if finished_at is not None else None)
+
+                if not output.is_done(key):
+                    answer = decode_generated_tokens(generated_sequence[prompt_length:], tokenizer, args)
+                    output.add(key, dict(task_id=task_id, generation=answer, prompt=orig_prompt))
+            output.flush()
+
+    stats.log(prefix='Batched generation: ')
+    # back to the dataset order
+    return output.finalize()
+
+
+def generate_continuous(model, dataset, tokenizer, args, output, stop_report=None):
+    """
+    Same outputs as `generate_batched`, but rows that are done are replaced by new prompts at every decode step
+    """
+    def requests():
+        for sample_no in range(args.num_return_sequences):
+            for idx in range(len(dataset)):
+                item = dataset[idx]
+                for j in range(args.mlp_samples):
+                    if not output.owns(sample_no, idx) or output.is_done((sample_no, idx, j)):
+                        continue
+                    yield GenerationRequest(
+                        key=(sample_no, idx, j),
+                        task_id=item['task_id'],
+                        prompt_length=item['prompt_length'],
+                        encoded_prompt=item['encoded_prompt'],
+                        original_prompt=item['original_prompt'],
+                        prefix_lm_mask=item.get('prefix_lm_mask')
+                    )
+
+    engine = ContinuousBatchingEngine(
+        model,
+        num_slots=args.batch_size,
+        pad_token_id=tokenizer.convert_tokens_to_ids('<pad>'),
+        eos_token_id=tokenizer.convert_tokens_to_ids('<eot>'),
+        max_length=args.max_seq_length if args.max_seq_length else None,
+        max_new_tokens=args.max_new_tokens if args.max_new_tokens else None,
+        do_sample=not args.greedy,
+        temperature=args.temperature,
+        top_k=args.k,
+        top_p=args.p,
+        repetition_penalty=args.repetition_penalty,
+        sample_replacement=True,
+        device=torch.device('cpu') if args.no_cuda else torch.device('cuda'),
+        prefix_cache=RadixPrefixCache(max_bytes=args.prefix_cache_mb * 2 ** 20) if args.prefix_cache_mb > 0 else None,
+        stopping_criteria=stop_report.criteria if stop_report is not None else None
+    )
+    eos_token_id = tokenizer.convert_tokens_to_ids('<eot>')
+
+    num_requests = sum(
+        output.owns(sample_no, idx) for sample_no in range(args.num_return_sequences) for idx in range(len(dataset))
+    ) * args.mlp_samples - len(output)
+    for request, generated_sequence in tqdm(engine.generate(requests()), total=num_requests, desc='Generating samples'):
+        answer = decode_generated_tokens(generated_sequence[request.prompt_length:], tokenizer, args)
+        output.add(request.key, dict(task_id=request.task_id, generation=answer, prompt=request.original_prompt))
+        if len(output.pending) >= args.batch_size:
+            output.flush()
+
+        if stop_report is not None:
+            num_new_tokens = len(generated_sequence) - len(request.encoded_prompt)
+            length_limit = engine.length_limit(request)
+            stopped = generated_sequence[-1] != eos_token_id and num_new_tokens < length_limit
+            stop_report.add(request.task_id, length_limit - num_new_tokens if stopped else None)
+
+    engine.stats.log(prefix='Continuous batching: ')
+    if engine.prefix_cache is not None:
+        engine.prefix_cache.stats.log(prefix='Prefix cache: ')
+    # keep the order of `generate_batched`
+    return output.finalize()
+
+
+def generate_fan_out(model, dataset, tokenizer, args, output, stop_report=None, speculation=None):
+    """
+    Same outputs as `generate_batched`, but all `num_return_sequences` x `mlp_samples` sequences of a task are sampled
+    from a single prefill of its prompt
+    """
+    device = torch.device('cpu') if args.no_cuda else torch.device('cuda')
+    num_samples = args.num_return_sequences * args.mlp_samples
+    eos_token_id = tokenizer.convert_tokens_to_ids('<eot>')
+    pad_token_id = tokenizer.convert_tokens_to_ids('<pad>')
+    chunk_sizes = [min(args.batch_size, num_samples - start) for start in range(0, num_samples, args.batch_size)]
+    stats = GenerationStats()
+
+    stopping_criteria = StoppingCriteriaList()
+    if stop_report is not None:
+        stopping_criteria.append(stop_report.criteria)
+
+    for idx in tqdm(range(len(dataset)), desc='Generating samples'):
+        # same ordering key as `generate_continuous`
+        keys = [(row // args.mlp_samples, idx, row % args.mlp_samples) for row in range(num_samples)]
+        # all samples of a task share its prefill, so tasks are not split between workers
+        if not output.owns(0, idx) or all(output.is_done(key) for key in keys):
+            continue
+
+        item = dataset[idx]
+        input_ids = torch.tensor([item['encoded_prompt']], dtype=torch.long, device=device)
+        prefix_idx = torch.tensor([item['prefix_lm_mask']], dtype=torch.long, device=device) if args.prefix_lm else None
+
+        if args.max_seq_length:
+            length_limit = args.max_seq_length
+        elif args.max_new_tokens:
+            length_limit = input_ids.size(-1) + args.max_new_tokens
+        else:
+            length_limit = model.config.max_length
+
+        if stop_report is not None:
+            stop_report.criteria.reset([item['prompt_length']] * chunk_sizes[0])
+
+        start_time = time.time()
+        output_chunks = model.generate_fan_out(
+            input_ids,
+            num_samples=num_samples,
+            chunk_size=args.batch_size,
+            max_length=args.max_seq_length if args.max_seq_length else None,
+            max_new_tokens=args.max_new_tokens if args.max_new_tokens else None,
+            do_sample=not args.greedy,
+            temperature=args.temperature,
+            top_k=args.k,
+            top_p=args.p,
+            repetition_penalty=args.repetition_penalty,
+            prefix_lm_mask=prefix_idx,
+            pad_token_id=pad_token_id,
+            eos_token_id=eos_token_id,
+            sample_replacement=True,
+            stopping_criteria=stopping_criteria,
+            **(speculation.generate_kwargs() if speculation is not None else {})
+        )
 
-            for task_id, prompt_length, generated_sequence, orig_prompt in \
-                    zip(task_ids, prompt_lengths, output_sequences, orig_prompts):
-
-                generated_sequence = generated_sequence[prompt_length:]
+        row = 0
+        for chunk, output_sequences in enumerate(output_chunks):
+            stats.elapsed += time.time() - start_time
+            num_steps = output_sequences.size(-1) - input_ids.size(-1)
+            stats.decode_steps += num_steps
+            stats.total_slots += num_steps * output_sequences.size(0)
+            if speculation is not None:
+                speculation.add_rows([item['task_id']] * output_sequences.size(0))
 
-                # Decode text
-                answer = tokenizer.convert_tokens_to_string(tokenizer.convert_ids_to_tokens(generated_sequence))
+            for chunk_row, generated_sequence in enumerate(output_sequences):
+                num_tokens = count_generated_tokens(generated_sequence[input_ids.size(-1):], eos_token_id, pad_token_id)
+                stats.generated_tokens += num_tokens
+                stats.occupied_slots += num_tokens
 
-                # Remove all text after the stop token
-                answer = answer[: answer.find(args.stop_token) if args.stop_token else None]
+                if stop_report is not None:
+                    finished_at = stop_report.criteria.finished_at[chunk_row]
+                    stop_report.add(item['task_id'], length_limit - finished_at if finished_at is not None else None)
 
-                # post-process
-                answer = post_process_generated_tokens(answer)
-                
-                generated_sequences.append(dict(task_id=task_id, generation=answer, prompt=orig_prompt))
+                if not output.is_done(keys[row]):
+                    answer = decode_generated_tokens(generated_sequence[item['prompt_length']:], tokenizer, args)
+                    output.add(keys[row], dict(task_id=item['task_id'], generation=answer, prompt=item['original_prompt']))
+                row += 1
 
-        write_jsonl(
-            os.path.join(
-                args.output_dir,
-                f"samples={args.num_return_sequences}_{args.torch_dtype}_bs={args.batch_size}_t={args.temperature}_k={args.k}_p={args.p}.jsonl"
-            ),
-            generated_sequences
-        )
+            # the next chunk is only generated when the loop asks for it
+            if stop_report is not None and chunk + 1 < len(chunk_sizes):
+                stop_report.criteria.reset([item['prompt_length']] * chunk_sizes[chunk + 1])
+            start_time = time.time()
+        output.flush()
 
-    return generated_sequences
+    stats.log(prefix='Fan-out generation: ')
+    return output.finalize()
 
 
 def example_generation_pangu(tokenizer=None, model=None, args=None):
@@ -418,13 +996,7 @@ def example_generation_pangu(tokenizer=None, model=None, args=None):
 
     code_ids = tokenizer.encode(signature, add_special_tokens=False)
     if args.replicated_tokens_map:
-        new_code_ids = []
-        for cid in code_ids:
-            if cid in args.replicated_tokens_map:
-                new_code_ids.append(args.replicated_tokens_map[cid])
-            else:
-                new_code_ids.append(cid)
-        code_ids = copy.deepcopy(new_code_ids)
+        code_ids = ReplicatedTokensRemapper(args.replicated_tokens_map)(code_ids)
     encoded_code = [tokenizer.convert_tokens_to_ids('<python>')] + code_ids
 
     encoded_prompt = encoded_comments + encoded_code
@@ -434,7 +1006,7 @@ def example_generation_pangu(tokenizer=None, model=None, args=None):
     else:
         prefix_lm_mask = None
 
-    encoded_prompt = torch.LongTensor([encoded_prompt]).to('cuda')
+    encoded_prompt = torch.LongTensor([encoded_prompt]).to(model.device)
 
     if encoded_prompt.size()[-1] == 0:
         input_ids = None
@@ -452,7 +1024,7 @@ def example_generation_pangu(tokenizer=None, model=None, args=None):
         num_return_sequences=1,
         output_scores=True,
         return_dict_in_generate=True,
-        prefix_lm_mask=torch.LongTensor([prefix_lm_mask]).to('cuda') if prefix_lm_mask is not None else None,
+        prefix_lm_mask=torch.LongTensor([prefix_lm_mask]).to(model.device) if prefix_lm_mask is not None else None,
         eos_token_id=tokenizer.convert_tokens_to_ids('<eot>'),
         sample_replacement=True
     )
@@ -485,13 +1057,7 @@ def example_generation_pycodegpt(tokenizer=None, model=None, args=None):
 
     code_ids = tokenizer.encode(signature, add_special_tokens=False)
     if args.replicated_tokens_map:
-        new_code_ids = []
-        for cid in code_ids:
-            if cid in args.replicated_tokens_map:
-                new_code_ids.append(args.replicated_tokens_map[cid])
-            else:
-                new_code_ids.append(cid)
-        code_ids = copy.deepcopy(new_code_ids)
+        code_ids = ReplicatedTokensRemapper(args.replicated_tokens_map)(code_ids)
 
     encoded_prompt = [tokenizer.convert_tokens_to_ids('<|beginoftext|>')] + \
                      code_ids + \
@@ -504,7 +1070,7 @@ def example_generation_pycodegpt(tokenizer=None, model=None, args=None):
     else:
         prefix_lm_mask = None
 
-    encoded_prompt = torch.LongTensor([encoded_prompt]).to('cuda')
+    encoded_prompt = torch.LongTensor([encoded_prompt]).to(model.device)
 
     if encoded_prompt.size()[-1] == 0:
         input_ids = None
@@ -522,7 +1088,7 @@ def example_generation_pycodegpt(tokenizer=None, model=None, args=None):
         num_return_sequences=1,
         output_scores=True,
         return_dict_in_generate=True,
-        prefix_lm_mask=torch.LongTensor([prefix_lm_mask]).to('cuda') if prefix_lm_mask is not None else None,
+        prefix_lm_mask=torch.LongTensor([prefix_lm_mask]).to(model.device) if prefix_lm_mask is not None else None,
         eos_token_id=tokenizer.convert_tokens_to_ids('<eot>'),
         sample_replacement=True
     )
@@ -0,0 +1,106 @@
+# Copyright (C) 2024. Huawei Technologies Co., Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+
+import logging
+from collections import defaultdict
+from utils import write_jsonl, stream_jsonl
+from pangu_alpha.generation_utils import SpeculativeDecodingStats
+
+logger = logging.getLogger(__name__)
+
+
+class FunctionBodyStopReport:
+    """
+    Per-task count of the sequences that `FunctionBodyStoppingCriteria` finished, and of the tokens that were not
+    decoded because of it (up to the length limit, so an upper bound if the sequence would have hit `<eot>` earlier)
+    """
+    def __init__(self, criteria):
+        self.criteria = criteria
+        self.tasks = defaultdict(lambda: dict(sequences=0, stopped=0, tokens_saved=0))
+
+    def add(self, task_id, tokens_saved=None):
+        self.tasks[task_id]['sequences'] += 1
+        if tokens_saved is not None:
+            self.tasks[task_id]['stopped'] += 1
+            self.tasks[task_id]['tokens_saved'] += tokens_saved
+
+    def log(self):
+        sequences = sum(task['sequences'] for task in self.tasks.values())
+        stopped = sum(task['stopped'] for task in self.tasks.values())
+        tokens_saved = sum(task['tokens_saved'] for task in self.tasks.values())
+        logger.info(f'Function end: stopped {stopped}/{sequences} sequences early, saving up to {tokens_saved} tokens '
+                    f'({tokens_saved / max(len(self.tasks), 1):.1f} per task)')
+
+    def write(self, filename):
+        write_jsonl(filename, [dict(task_id=task_id, **task) for task_id, task in self.tasks.items()])
+
+    def read(self, filename):
+        """
+        Adds the counts of a report written by `write`, e.g. by a generation worker
+        """
+        for task in stream_jsonl(filename):
+            for name in ('sequences', 'stopped', 'tokens_saved'):
+                self.tasks[task['task_id']][name] += task[name]
+
+
+class SpeculationReport:
+    """
+    Settings of the speculative decoding and the per-task acceptance of the proposed tokens
+    """
+    def __init__(self, draft_model=None, num_draft_tokens=4, prompt_lookup_ngram_size=None):
+        self.draft_model = draft_model
+        self.num_draft_tokens = num_draft_tokens
+        self.prompt_lookup_ngram_size = prompt_lookup_ngram_size
+        self.stats = SpeculativeDecodingStats()
+        self.tasks = defaultdict(lambda: dict(proposed=0, accepted=0))
+
+    def generate_kwargs(self):
+        return dict(
+            draft_model=self.draft_model,
+            num_draft_tokens=self.num_draft_tokens,
+            prompt_lookup_ngram_size=self.prompt_lookup_ngram_size,
+            speculative_stats=self.stats
+        )
+
+    def add_rows(self, task_ids):
+        """
+        Attributes the rows of the last `generate` call to `task_ids`
+        """
+        for task_id, proposed, accepted in zip(task_ids, self.stats.row_proposed, self.stats.row_accepted):
+            self.tasks[task_id]['proposed'] += proposed
+            self.tasks[task_id]['accepted'] += accepted
+        self.stats.row_proposed, self.stats.row_accepted = [], []
+
+    def log(self):
+        if self.stats.target_forwards > 0:
+            logger.info(f'Speculative decoding: {self.stats.summary()}')
+        else:
+            proposed = sum(task['proposed'] for task in self.tasks.values())
+            accepted = sum(task['accepted'] for task in self.tasks.values())
+            logger.info(f'Speculative decoding: {accepted}/{proposed} proposed tokens accepted')
+
+    def write(self, filename):
+        write_jsonl(filename, [
+            dict(task_id=task_id, acceptance_rate=task['accepted'] / task['proposed'] if task['proposed'] else 0.0, **task)
+            for task_id, task in self.tasks.items()
+        ])
+
+    def read(self, filename):
+        """
+        Adds the counts of a report written by `write`, e.g. by a generation worker
+        """
+        for task in stream_jsonl(filename):
+            self.tasks[task['task_id']]['proposed'] += task['proposed']
+            self.tasks[task['task_id']]['accepted'] += task['accepted']
@@ -6,6 +6,7 @@ BS=16
 dtype='fp32'
 incremental=False
 greedy=False
+quantization='none'
 
 while [ $# -gt 1 ]
 do
@@ -33,6 +34,10 @@ do
 		-greedy|--greedy)
             greedy="$2"
             shift
+            ;;
+		-q|--quantization)
+            quantization="$2"
+            shift
             ;;
 		*)
         echo "Unknown argument $2"
@@ -85,6 +90,13 @@ echo "${model_name} | prefix=${prefix} | replicated_tokens_map=${replicated_toke
 
 output_dir="${LOCAL_DIR_GEN}/${model_name}_${dataset}_incr${incremental}"
 
+# generation.py tags the samples of quantized models with the quantization
+if [[ "$quantization" == "none" ]]; then
+	dtype_tag="${dtype}"
+else
+	dtype_tag="${dtype}-${quantization}"
+fi
+
 
 if [[ "$greedy" == True ]]; then
 	k=0
@@ -109,7 +121,8 @@ if [[ "$greedy" == True ]]; then
 		--model_type="${model_family}" \
 		--replicated_tokens_map="${replicated_tokens_map}" \
 		--data_path="${data_path}" \
-		--incremental="${incremental}"
+		--incremental="${incremental}" \
+		--quantization="${quantization}"
 
 else
 	k=0
@@ -133,13 +146,14 @@ else
 		--model_type="${model_family}" \
 		--replicated_tokens_map="${replicated_tokens_map}" \
 		--data_path="${data_path}" \
-		--incremental="${incremental}"
+		--incremental="${incremental}" \
+		--quantization="${quantization}"
 fi
 
 
 # Evaluate
 bash ${eval_script} \
-"${output_dir}/samples=${num_return_sequences}_${dtype}_bs=${BS}_t=${temp}_k=${k}_p=${p}.jsonl" \
+"${output_dir}/samples=${num_return_sequences}_${dtype_tag}_bs=${BS}_t=${temp}_k=${k}_p=${p}.jsonl" \
 "python" \
-6 > "${output_dir}/samples=${num_return_sequences}_${dtype}_bs=${BS}_t=${temp}_k=${k}_p=${p}.out"
+6 > "${output_dir}/samples=${num_return_sequences}_${dtype_tag}_bs=${BS}_t=${temp}_k=${k}_p=${p}.out"
 
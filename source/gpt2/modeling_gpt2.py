@@ -32,6 +32,9 @@ import torch.utils.checkpoint
 from packaging import version
 from torch import nn
 from torch.nn import BCEWithLogitsLoss, CrossEntropyLoss, MSELoss
+from source.attention_masks import (
+    packed_attention_mask, build_prefix_key_mask, shared_causal_mask, sdpa_attention
+)
 
 
 if version.parse(torch.__version__) >= version.parse("1.6"):
@@ -138,13 +141,7 @@ class GPT2Attention(nn.Module):
     def __init__(self, config, is_cross_attention=False, layer_idx=None):
         super().__init__()
 
-        max_positions = config.max_position_embeddings
-        self.register_buffer(
-            "bias",
-            torch.tril(torch.ones((max_positions, max_positions), dtype=torch.uint8)).view(
-                1, 1, max_positions, max_positions
-            ),
-        )
+        # the causal mask is shared by all layers, see `shared_causal_mask`
         self.register_buffer("masked_bias", torch.tensor(-1e4))
 
         self.embed_dim = config.hidden_size
@@ -173,6 +170,8 @@ class GPT2Attention(nn.Module):
 
         self.attn_dropout = nn.Dropout(config.attn_pdrop)
         self.resid_dropout = nn.Dropout(config.resid_pdrop)
+        # `eager` or `sdpa`, see `set_attention_backend`
+        self.attention_backend = getattr(config, "attention_backend", "eager")
 
         self.pruned_heads = set()
 
@@ -191,7 +190,34 @@ class GPT2Attention(nn.Module):
         self.num_heads = self.num_heads - len(heads)
         self.pruned_heads = self.pruned_heads.union(heads)
 
-    def _attn(self, query, key, value, attention_mask=None, head_mask=None, prefix_lm_mask=None):
+    def _causal_mask(self, query_length, key_length, attention_mask=None, prefix_lm_mask=None, segment_ids=None):
+        """
+        Boolean mask of the keys every query attends to: causal, per packed document and bidirectional over the
+        prefix, of shape `(batch_size or 1, 1, query_length, key_length)`. `prefix_lm_mask` is a 3D prefix mask in
+        training, the prefix index or the mask of the prefix keys at generation (see `build_prefix_key_mask`).
+        """
+        if segment_ids is not None:  # packed documents, the mask covers their prefixes too
+            return packed_attention_mask(segment_ids, prefix_lm_mask, query_length)
+
+        if attention_mask is not None and len(attention_mask.size()) == 3:  # this means causal mask is already given
+            causal_mask = attention_mask[:, None, :, :].bool()  # expand across attn_heads
+        else:
+            # Means attention given is 2-D, so assuming one example per instance
+            causal_mask = shared_causal_mask(query_length, key_length, device=self.masked_bias.device)
+
+        if prefix_lm_mask is not None:
+            if isinstance(prefix_lm_mask, torch.Tensor) and len(prefix_lm_mask.size()) == 3:  # prefix mask is given
+                prefix_lm_mask = prefix_lm_mask[:, None, :, :].bool()
+            elif len(prefix_lm_mask.size()) == 1:  # otherwise index up-to-which we consider as prefix is given
+                prefix_lm_mask = build_prefix_key_mask(prefix_lm_mask, key_length)[:, None, None, :]
+            else:  # keys in the prefix, broadcast across heads and queries
+                prefix_lm_mask = prefix_lm_mask[:, None, None, :]
+
+            causal_mask = torch.where(prefix_lm_mask, True, causal_mask)  # expand mask so that it covers all the prefix
+        return causal_mask
+
+    def _attn(self, query, key, value, attention_mask=None, head_mask=None, prefix_lm_mask=None, segment_ids=None,
+              causal_mask=None):
         attn_weights = torch.matmul(query, key.transpose(-1, -2))
 
         if self.scale_attn_weights:
@@ -202,31 +228,19 @@ class GPT2Attention(nn.Module):
             attn_weights = attn_weights / float(self.layer_idx + 1)
 
         if not self.is_cross_attention:
-            if len(attention_mask.size()) == 3:  # this means causal mask is already given
-                causal_mask = attention_mask[:, None, :, :].bool()  # expand across attn_heads
-            else:
-                # Means attention given is 2-D, so assuming one example per instance
-                query_length, key_length = query.size(-2), key.size(-2)
-                causal_mask = self.bias[:, :, key_length - query_length: key_length, :key_length].bool()
-
-            if prefix_lm_mask is not None:
-                if isinstance(prefix_lm_mask, torch.Tensor) and len(prefix_lm_mask.size()) == 3:
-                    prefix_lm_mask = prefix_lm_mask[:, None, :, :].bool()  # given, only for training
-                else:
-                    cond1 = prefix_lm_mask[:, None, None, None]  # broadcast prefix indexes
-                    cond2 = torch.arange(causal_mask.size(-1)).to(causal_mask.device)[None, None, None, :]  # broadcast all indexes
-                    prefix_lm_mask = torch.le(cond2, cond1)
-
-                prefix_lm_mask = torch.where(prefix_lm_mask, True,
-                                             causal_mask)  # expand mask so that it covers all the prefix
-                attn_weights = torch.where(prefix_lm_mask, attn_weights, self.masked_bias.to(attn_weights.dtype))
-            else:
-                attn_weights = torch.where(causal_mask, attn_weights, self.masked_bias.to(attn_weights.dtype))
+            if causal_mask is None:  # not shared by the model
+                causal_mask = self._causal_mask(
+                    query.size(-2), key.size(-2), attention_mask, prefix_lm_mask, segment_ids
+                )
+            attn_weights = torch.where(causal_mask, attn_weights, self.masked_bias.to(attn_weights.dtype))
 
         if attention_mask is not None and len(attention_mask.size()) == 4:  # we have expanded it before
             # Apply the attention mask
             attn_weights = attn_weights + attention_mask
 
+        if attn_weights.dtype == torch.bfloat16:
+            # softmax in fp32, bf16 keeps too few bits of the scores
+            attn_weights = attn_weights.to(torch.float32)
         attn_weights = nn.functional.softmax(attn_weights, dim=-1)
         attn_weights = torch.where(torch.isnan(attn_weights),
                                    torch.zeros(1).to(attn_weights.device).to(attn_weights.dtype)[0],
@@ -244,7 +258,10 @@ class GPT2Attention(nn.Module):
 
         return attn_output, attn_weights
 
-    def _upcast_and_reordered_attn(self, query, key, value, attention_mask=None, head_mask=None, prefix_lm_mask=None):
+    def _upcast_and_reordered_attn(
+        self, query, key, value, attention_mask=None, head_mask=None, prefix_lm_mask=None, segment_ids=None,
+        causal_mask=None
+    ):
         # Use `torch.baddbmm` (a bit more efficient w/ alpha param for scaling -- from Megatron-LM)
         bsz, num_heads, q_seq_len, dk = query.size()
         _, _, k_seq_len, _ = key.size()
@@ -272,27 +289,11 @@ class GPT2Attention(nn.Module):
             attn_weights = attn_weights.reshape(bsz, num_heads, q_seq_len, k_seq_len)
 
         if not self.is_cross_attention:
-            if len(attention_mask.size()) == 3:  # this means causal mask is already given
-                causal_mask = attention_mask[:, None, :, :].bool()  # expand across attn_heads
-            else:
-                # Means attention given is 2-D, so assuming one example per instance
-                query_length, key_length = query.size(-2), key.size(-2)
-                causal_mask = self.bias[:, :, key_length - query_length: key_length, :key_length].bool()
-
-            if prefix_lm_mask is not None:
-                if isinstance(prefix_lm_mask, torch.Tensor) and len(prefix_lm_mask.size()) == 3:
-                    prefix_lm_mask = prefix_lm_mask[:, None, :, :].bool()  # given, only for training
-                else:
-                    cond1 = prefix_lm_mask[:, None, None, None]  # broadcast prefix indexes
-                    cond2 = torch.arange(causal_mask.size(-1)).to(causal_mask.device)[None, None, None,
-                            :]  # broadcast all indexes
-                    prefix_lm_mask = torch.le(cond2, cond1)
-
-                prefix_lm_mask = torch.where(prefix_lm_mask, True,
-                                             causal_mask)  # expand mask so that it covers all the prefix
-                attn_weights = torch.where(prefix_lm_mask, attn_weights, self.masked_bias.to(attn_weights.dtype))
-            else:
-                attn_weights = torch.where(causal_mask, attn_weights, self.masked_bias.to(attn_weights.dtype))
+            if causal_mask is None:  # not shared by the model
+                causal_mask = self._causal_mask(
+                    query.size(-2), key.size(-2), attention_mask, prefix_lm_mask, segment_ids
+                )
+            attn_weights = torch.where(causal_mask, attn_weights, self.masked_bias.to(attn_weights.dtype))
 
         if attention_mask is not None and len(attention_mask.size()) == 4:  # we have expanded it before
             # Apply the attention mask
@@ -317,6 +318,34 @@ class GPT2Attention(nn.Module):
 
         return attn_output, attn_weights
 
+    def _sdpa_attn(self, query, key, value, attention_mask=None, prefix_lm_mask=None, segment_ids=None,
+                   causal_mask=None):
+        query_length, key_length = query.size(-2), key.size(-2)
+        padding_mask = attention_mask if attention_mask is not None and len(attention_mask.size()) == 4 else None
+        plain_causal = (segment_ids is None and prefix_lm_mask is None and
+                        (attention_mask is None or len(attention_mask.size()) != 3))
+        if self.is_cross_attention or (causal_mask is None and plain_causal and (
+                query_length == 1 or (query_length == key_length and padding_mask is None))):
+            # a single query sees everything, otherwise the kernel masks the future itself
+            causal_mask = None
+        elif causal_mask is None:  # not shared by the model
+            causal_mask = self._causal_mask(query_length, key_length, attention_mask, prefix_lm_mask, segment_ids)
+
+        scale = 1.0
+        if self.scale_attn_weights:
+            scale /= float(value.size(-1)) ** 0.5
+        if self.scale_attn_by_inverse_layer_idx:
+            scale /= float(self.layer_idx + 1)
+
+        return sdpa_attention(
+            query, key, value,
+            mask=causal_mask,
+            padding_mask=padding_mask,
+            scale=scale,
+            dropout_p=self.attn_dropout.p if self.training else 0.0,
+            is_causal=causal_mask is None and not self.is_cross_attention and query_length > 1,
+        )
+
     def _split_heads(self, tensor, num_heads, attn_head_size):
         """
         Splits hidden_size dim into attn_head_size and num_heads
@@ -343,7 +372,9 @@ class GPT2Attention(nn.Module):
         encoder_attention_mask: Optional[torch.FloatTensor] = None,
         use_cache: Optional[bool] = False,
         output_attentions: Optional[bool] = False,
-        prefix_lm_mask: Optional[torch.Tensor] = None
+        prefix_lm_mask: Optional[torch.Tensor] = None,
+        segment_ids: Optional[torch.LongTensor] = None,
+        causal_mask: Optional[torch.BoolTensor] = None
     ) -> Tuple[Union[torch.Tensor, Tuple[torch.Tensor]], ...]:
         if encoder_hidden_states is not None:
             if not hasattr(self, "q_attn"):
@@ -362,20 +393,32 @@ class GPT2Attention(nn.Module):
         key = self._split_heads(key, self.num_heads, self.head_dim)
         value = self._split_heads(value, self.num_heads, self.head_dim)
 
-        if layer_past is not None:
+        if layer_past is not None and hasattr(layer_past, "update"):
+            # preallocated cache, written in place
+            key, value = layer_past.update(key, value)
+        elif layer_past is not None:
             past_key, past_value = layer_past
             key = torch.cat((past_key, key), dim=-2)
             value = torch.cat((past_value, value), dim=-2)
 
         if use_cache is True:
-            present = (key, value)
+            present = layer_past if hasattr(layer_past, "update") else (key, value)
         else:
             present = None
 
-        if self.reorder_and_upcast_attn:
-            attn_output, attn_weights = self._upcast_and_reordered_attn(query, key, value, attention_mask, head_mask, prefix_lm_mask)
+        if self.attention_backend == "sdpa" and not output_attentions and head_mask is None:
+            attn_output = self._sdpa_attn(
+                query, key, value, attention_mask, prefix_lm_mask, segment_ids, causal_mask
+            )
+            attn_weights = None
+        elif self.reorder_and_upcast_attn:
+            attn_output, attn_weights = self._upcast_and_reordered_attn(
+                query, key, value, attention_mask, head_mask, prefix_lm_mask, segment_ids, causal_mask
+            )
         else:
-            attn_output, attn_weights = self._attn(query, key, value, attention_mask, head_mask, prefix_lm_mask)
+            attn_output, attn_weights = self._attn(
+                query, key, value, attention_mask, head_mask, prefix_lm_mask, segment_ids, causal_mask
+            )
 
         attn_output = self._merge_heads(attn_output, self.num_heads, self.head_dim)
         attn_output = self.c_proj(attn_output)
@@ -432,6 +475,8 @@ class GPT2Block(nn.Module):
         use_cache: Optional[bool] = False,
         output_attentions: Optional[bool] = False,
         prefix_lm_mask: Optional[torch.Tensor] = None,
+        segment_ids: Optional[torch.LongTensor] = None,
+        causal_mask: Optional[torch.BoolTensor] = None,
     ) -> Union[Tuple[torch.Tensor], Optional[Tuple[torch.Tensor, Tuple[torch.FloatTensor, ...]]]]:
         
         residual = hidden_states
@@ -443,7 +488,9 @@ class GPT2Block(nn.Module):
             head_mask=head_mask,
             use_cache=use_cache,
             output_attentions=output_attentions,
-            prefix_lm_mask=prefix_lm_mask
+            prefix_lm_mask=prefix_lm_mask,
+            segment_ids=segment_ids,
+            causal_mask=causal_mask
         )
         attn_output = attn_outputs[0]  # output_attn: a, present, (attentions)
         outputs = attn_outputs[1:]
@@ -496,6 +543,8 @@ class GPT2PreTrainedModel(PreTrainedModel):
     config_class = GPT2Config
     load_tf_weights = load_tf_weights_in_gpt2
     base_model_prefix = "transformer"
+    # causal masks are shared by the layers instead of their former `bias` buffers, which older checkpoints contain
+    _keys_to_ignore_on_load_unexpected = [r"h\.\d+\.attn\.bias$", r"top_query_layer\.attn\.bias$"]
     is_parallelizable = True
     supports_gradient_checkpointing = True
 
@@ -807,7 +856,10 @@ class GPT2Model(GPT2PreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
-        prefix_lm_mask: Optional[torch.LongTensor] = None
+        prefix_lm_mask: Optional[torch.LongTensor] = None,
+        segment_ids: Optional[torch.LongTensor] = None,
+        prefix_key_mask: Optional[torch.BoolTensor] = None,
+        causal_mask: Optional[torch.BoolTensor] = None
     ) -> Union[Tuple, BaseModelOutputWithPastAndCrossAttentions]:
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -894,6 +946,17 @@ class GPT2Model(GPT2PreTrainedModel):
 
         output_shape = input_shape + (hidden_states.size(-1),)
 
+        # Causal, packed and prefix-LM masks are the same for all the layers, build them once per forward
+        if causal_mask is None and (prefix_lm_mask is not None or segment_ids is not None or (
+                attention_mask is not None and len(attention_mask.size()) == 3)):
+            key_length = past_length + input_shape[-1]
+            if segment_ids is None and prefix_lm_mask is not None and len(prefix_lm_mask.size()) == 1:
+                # at generation, extends the mask of the previous step if there is one
+                prefix_lm_mask = build_prefix_key_mask(prefix_lm_mask, key_length, prefix_key_mask)
+            causal_mask = self.h[0].attn._causal_mask(
+                input_shape[-1], key_length, attention_mask, prefix_lm_mask, segment_ids
+            )
+
         presents = () if use_cache else None
         all_self_attentions = () if output_attentions else None
         all_cross_attentions = () if output_attentions and self.config.add_cross_attention else None
@@ -910,6 +973,8 @@ class GPT2Model(GPT2PreTrainedModel):
                 # Ensure that attention_mask is always on the same device as hidden_states
                 if attention_mask is not None:
                     attention_mask = attention_mask.to(hidden_states.device)
+                if causal_mask is not None:
+                    causal_mask = causal_mask.to(hidden_states.device)
                 if isinstance(head_mask, torch.Tensor):
                     head_mask = head_mask.to(hidden_states.device)
             if output_hidden_states:
@@ -926,7 +991,7 @@ class GPT2Model(GPT2PreTrainedModel):
                 def create_custom_forward(module):
                     def custom_forward(*inputs):
                         # None for past_key_value
-                        return module(*inputs, use_cache, output_attentions, prefix_lm_mask)
+                        return module(*inputs, use_cache, output_attentions, prefix_lm_mask, segment_ids, causal_mask)
 
                     return custom_forward
 
@@ -949,7 +1014,9 @@ class GPT2Model(GPT2PreTrainedModel):
                     encoder_attention_mask=encoder_attention_mask,
                     use_cache=use_cache,
                     output_attentions=output_attentions,
-                    prefix_lm_mask=prefix_lm_mask
+                    prefix_lm_mask=prefix_lm_mask,
+                    segment_ids=segment_ids,
+                    causal_mask=causal_mask
                 )
 
             hidden_states = outputs[0]
@@ -1040,8 +1107,9 @@ class GPT2LMHeadModel(GPT2PreTrainedModel):
 
     def prepare_inputs_for_generation(self, input_ids, past=None, **kwargs):
         token_type_ids = kwargs.get("token_type_ids", None)
-        # only last token for inputs_ids if past is defined in kwargs
-        if past:
+        # only last token for inputs_ids if past is defined in kwargs (and not an empty static cache)
+        past_length = past[0][0].size(-2) if past is not None else 0
+        if past_length > 0:
             input_ids = input_ids[:, -1].unsqueeze(-1)
             if token_type_ids is not None:
                 token_type_ids = token_type_ids[:, -1].unsqueeze(-1)
@@ -1056,7 +1124,7 @@ class GPT2LMHeadModel(GPT2PreTrainedModel):
             # create position_ids on the fly for batch generation
             position_ids = attention_mask.long().cumsum(-1) - 1
             position_ids.masked_fill_(attention_mask == 0, 1)
-            if past:
+            if past_length > 0:
                 position_ids = position_ids[:, -1].unsqueeze(-1)
         else:
             position_ids = None
@@ -1156,6 +1224,7 @@ class GPT2LMHeadModel(GPT2PreTrainedModel):
         beam_idx at every generation step.
         """
         return tuple(
+            layer_past.reorder(beam_idx) if hasattr(layer_past, "reorder") else
             tuple(past_state.index_select(0, beam_idx.to(past_state.device)) for past_state in layer_past)
             for layer_past in past
         )
@@ -1217,8 +1286,9 @@ class GPT2DoubleHeadsModel(GPT2PreTrainedModel):
 
     def prepare_inputs_for_generation(self, input_ids, past=None, **kwargs):
         token_type_ids = kwargs.get("token_type_ids", None)
-        # only last token for inputs_ids if past is defined in kwargs
-        if past:
+        # only last token for inputs_ids if past is defined in kwargs (and not an empty static cache)
+        past_length = past[0][0].size(-2) if past is not None else 0
+        if past_length > 0:
             input_ids = input_ids[:, -1].unsqueeze(-1)
             if token_type_ids is not None:
                 token_type_ids = token_type_ids[:, -1].unsqueeze(-1)
@@ -1230,7 +1300,7 @@ class GPT2DoubleHeadsModel(GPT2PreTrainedModel):
             # create position_ids on the fly for batch generation
             position_ids = attention_mask.long().cumsum(-1) - 1
             position_ids.masked_fill_(attention_mask == 0, 1)
-            if past:
+            if past_length > 0:
                 position_ids = position_ids[:, -1].unsqueeze(-1)
         else:
             position_ids = None
@@ -1364,6 +1434,7 @@ class GPT2DoubleHeadsModel(GPT2PreTrainedModel):
         beam_idx at every generation step.
         """
         return tuple(
+            layer_past.reorder(beam_idx) if hasattr(layer_past, "reorder") else
             tuple(past_state.index_select(0, beam_idx.to(past_state.device)) for past_state in layer_past)
             for layer_past in past
         )
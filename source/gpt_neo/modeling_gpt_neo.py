@@ -41,7 +41,11 @@ from transformers.modeling_outputs import (
 from transformers.modeling_utils import PreTrainedModel
 from transformers.utils import add_code_sample_docstrings, add_start_docstrings, add_start_docstrings_to_model_forward, logging
 from .configuration_gpt_neo import GPTNeoConfig
-from source.pangu_alpha.generation_utils import CustomGenerationMixin
+from source.pangu_alpha.generation_utils import CustomGenerationMixin, cached_length
+from source.vocab_partition import build_token_masks
+from source.attention_masks import (
+    packed_attention_mask, build_prefix_key_mask, shared_causal_mask, sliding_window_mask, sdpa_attention
+)
 
 
 logger = logging.get_logger(__name__)
@@ -141,22 +145,17 @@ class GPTNeoSelfAttention(nn.Module):
     def __init__(self, config, attention_type):
         super().__init__()
 
-        max_positions = config.max_position_embeddings
-        bias = torch.tril(torch.ones((max_positions, max_positions), dtype=torch.uint8)).view(
-            1, 1, max_positions, max_positions
-        )
-
         # local causal self attention is a sliding window where each token can only attend to the previous
-        # window_size tokens. This is implemented by updating the causal mask such that for each token
-        # all other tokens are masked except the previous window_size tokens.
-        if attention_type == "local":
-            bias = torch.bitwise_xor(bias, torch.tril(bias, -config.window_size))
+        # window_size tokens. The causal masks of both types are shared by all layers, see `shared_causal_mask`.
+        self.attention_type = attention_type
+        self.window_size = config.window_size if attention_type == "local" else None
 
-        self.register_buffer("bias", bias)
         self.register_buffer("masked_bias", torch.tensor(-1e9))
 
         self.attn_dropout = nn.Dropout(config.attention_dropout)
         self.resid_dropout = nn.Dropout(config.resid_dropout)
+        # `eager` or `sdpa`, see `set_attention_backend`
+        self.attention_backend = getattr(config, "attention_backend", "eager")
 
         self.embed_dim = config.hidden_size
         self.num_heads = config.num_heads
@@ -187,33 +186,46 @@ class GPTNeoSelfAttention(nn.Module):
         new_shape = tensor.size()[:-2] + (num_heads * attn_head_size,)
         return tensor.view(new_shape)
 
-    def _attn(self, query, key, value, attention_mask=None, head_mask=None, prefix_lm_mask=None):
-        # Keep the attention weights computation in fp32 to avoid overflow issues
-        query = query.to(torch.float32)
-        key = key.to(torch.float32)
-
-        attn_weights = torch.matmul(query, key.transpose(-1, -2))
+    def _causal_mask(self, query_length, key_length, attention_mask=None, prefix_lm_mask=None, segment_ids=None):
+        """
+        Boolean mask of the keys every query attends to: causal (local layers within their window), per packed
+        document and bidirectional over the prefix, of shape `(batch_size or 1, 1, query_length, key_length)`.
+        `prefix_lm_mask` is a 3D prefix mask in training, the prefix index or the mask of the prefix keys at
+        generation (see `build_prefix_key_mask`).
+        """
+        if segment_ids is not None:  # packed documents, the mask covers their prefixes too
+            return packed_attention_mask(segment_ids, prefix_lm_mask, query_length)
 
-        if len(attention_mask.size()) == 3:   # this means causal mask is already given
+        if attention_mask is not None and len(attention_mask.size()) == 3:   # this means causal mask is already given
             causal_mask = attention_mask[:, None, :, :].bool()   # expand across attn_heads
         else:
             # Means attention given is 2-D, so assuming one example per instance
-            query_length, key_length = query.size(-2), key.size(-2)
-            causal_mask = self.bias[:, :, key_length - query_length: key_length, :key_length].bool()
+            causal_mask = shared_causal_mask(query_length, key_length, self.window_size, self.masked_bias.device)
 
         if prefix_lm_mask is not None:
             if isinstance(prefix_lm_mask, torch.Tensor) and len(prefix_lm_mask.size()) == 3:
                 prefix_lm_mask = prefix_lm_mask[:, None, :, :].bool()  # given, only for training
-            else:
-                # print('WE ARE BLOODY HERE')
-                cond1 = prefix_lm_mask[:, None, None, None]  # broadcast prefix indexes
-                cond2 = torch.arange(causal_mask.size(-1)).to(causal_mask.device)[None, None, None, :]  # broadcast all indexes
-                prefix_lm_mask = torch.le(cond2, cond1)
+            elif len(prefix_lm_mask.size()) == 1:  # index up-to-which we consider as prefix
+                prefix_lm_mask = build_prefix_key_mask(prefix_lm_mask, key_length)[:, None, None, :]
+            else:  # keys in the prefix, broadcast across heads and queries
+                prefix_lm_mask = prefix_lm_mask[:, None, None, :]
 
-            prefix_lm_mask = torch.where(prefix_lm_mask, True, causal_mask)  # expand mask so that it covers all the prefix
-            attn_weights = torch.where(prefix_lm_mask, attn_weights, self.masked_bias.to(attn_weights.dtype))
-        else:
-            attn_weights = torch.where(causal_mask, attn_weights, self.masked_bias.to(attn_weights.dtype))
+            causal_mask = torch.where(prefix_lm_mask, True, causal_mask)  # expand mask so that it covers all the prefix
+        return causal_mask
+
+    def _attn(self, query, key, value, attention_mask=None, head_mask=None, prefix_lm_mask=None, segment_ids=None,
+              causal_mask=None):
+        # Keep the attention weights computation in fp32 to avoid overflow issues. bf16 has the range of fp32, its
+        # scores are computed in bf16 and only upcast for the softmax
+        if query.dtype != torch.bfloat16:
+            query = query.to(torch.float32)
+            key = key.to(torch.float32)
+
+        attn_weights = torch.matmul(query, key.transpose(-1, -2)).to(torch.float32)
+
+        if causal_mask is None:  # not shared by the model
+            causal_mask = self._causal_mask(query.size(-2), key.size(-2), attention_mask, prefix_lm_mask, segment_ids)
+        attn_weights = torch.where(causal_mask, attn_weights, self.masked_bias.to(attn_weights.dtype))
 
         if attention_mask is not None and len(attention_mask.size()) == 4:  # we have expanded it before and size is 2
             # Apply the attention mask
@@ -235,6 +247,26 @@ class GPTNeoSelfAttention(nn.Module):
 
         return attn_output, attn_weights
 
+    def _sdpa_attn(self, query, key, value, attention_mask=None, prefix_lm_mask=None, segment_ids=None,
+                   causal_mask=None):
+        query_length, key_length = query.size(-2), key.size(-2)
+        padding_mask = attention_mask if attention_mask is not None and len(attention_mask.size()) == 4 else None
+        plain_causal = (self.attention_type == "global" and segment_ids is None and prefix_lm_mask is None and
+                        (attention_mask is None or len(attention_mask.size()) != 3))
+        # without a mask shared by the model: a single query sees everything, otherwise the kernel masks the future
+        if causal_mask is None and not (
+                plain_causal and (query_length == 1 or (query_length == key_length and padding_mask is None))):
+            causal_mask = self._causal_mask(query_length, key_length, attention_mask, prefix_lm_mask, segment_ids)
+
+        # GPT-Neo does not scale the attention scores
+        return sdpa_attention(
+            query, key, value,
+            mask=causal_mask,
+            padding_mask=padding_mask,
+            dropout_p=self.attn_dropout.p if self.training else 0.0,
+            is_causal=causal_mask is None and query_length > 1,
+        )
+
     def forward(
         self,
         hidden_states,
@@ -243,7 +275,9 @@ class GPTNeoSelfAttention(nn.Module):
         head_mask=None,
         use_cache=False,
         output_attentions=False,
-        prefix_lm_mask=None
+        prefix_lm_mask=None,
+        segment_ids=None,
+        causal_mask=None
     ):
 
         query = self.q_proj(hidden_states)
@@ -254,18 +288,38 @@ class GPTNeoSelfAttention(nn.Module):
         key = self._split_heads(key, self.num_heads, self.head_dim)
         value = self._split_heads(value, self.num_heads, self.head_dim)
 
-        if layer_past is not None:
+        if layer_past is not None and hasattr(layer_past, "update"):
+            # preallocated cache, written in place
+            key, value = layer_past.update(key, value)
+        elif layer_past is not None:
             past_key = layer_past[0]
             past_value = layer_past[1]
             key = torch.cat((past_key, key), dim=-2)
             value = torch.cat((past_value, value), dim=-2)
 
         if use_cache is True:
-            present = (key, value)
+            present = layer_past if hasattr(layer_past, "update") else (key, value)
         else:
             present = None
 
-        attn_output, attn_weights = self._attn(query, key, value, attention_mask, head_mask, prefix_lm_mask)
+        if getattr(layer_past, "key_positions", None) is not None:
+            # sliding window cache: the keys are the prefix and the window only, masks follow their positions
+            query_positions = torch.arange(layer_past.seq_length - query.size(-2), layer_past.seq_length,
+                                           device=query.device)
+            causal_mask = sliding_window_mask(layer_past.key_positions, query_positions, self.window_size,
+                                              prefix_lm_mask)
+            if attention_mask is not None and len(attention_mask.size()) == 4:
+                attention_mask = attention_mask[..., layer_past.key_positions.clamp(min=0)]
+
+        if self.attention_backend == "sdpa" and not output_attentions and head_mask is None:
+            attn_output = self._sdpa_attn(
+                query, key, value, attention_mask, prefix_lm_mask, segment_ids, causal_mask
+            )
+            attn_weights = None
+        else:
+            attn_output, attn_weights = self._attn(
+                query, key, value, attention_mask, head_mask, prefix_lm_mask, segment_ids, causal_mask
+            )
 
         attn_output = self._merge_heads(attn_output, self.num_heads, self.head_dim)
         attn_output = self.out_proj(attn_output)
@@ -301,7 +355,9 @@ class GPTNeoAttention(nn.Module):
         head_mask=None,
         use_cache=False,
         output_attentions=False,
-        prefix_lm_mask=None
+        prefix_lm_mask=None,
+        segment_ids=None,
+        causal_mask=None
     ):
         return self.attention(
             hidden_states,
@@ -310,7 +366,9 @@ class GPTNeoAttention(nn.Module):
             head_mask=head_mask,
             use_cache=use_cache,
             output_attentions=output_attentions,
-            prefix_lm_mask=prefix_lm_mask
+            prefix_lm_mask=prefix_lm_mask,
+            segment_ids=segment_ids,
+            causal_mask=causal_mask
         )
 
 
@@ -349,7 +407,9 @@ class GPTNeoBlock(nn.Module):
         head_mask=None,
         use_cache=False,
         output_attentions=False,
-        prefix_lm_mask=None
+        prefix_lm_mask=None,
+        segment_ids=None,
+        causal_mask=None
     ):
         residual = hidden_states
         hidden_states = self.ln_1(hidden_states)
@@ -360,7 +420,9 @@ class GPTNeoBlock(nn.Module):
             head_mask=head_mask,
             use_cache=use_cache,
             output_attentions=output_attentions,
-            prefix_lm_mask=prefix_lm_mask
+            prefix_lm_mask=prefix_lm_mask,
+            segment_ids=segment_ids,
+            causal_mask=causal_mask
         )
         attn_output = attn_outputs[0]  # output_attn: a, present, (attentions)
         outputs = attn_outputs[1:]
@@ -390,6 +452,8 @@ class GPTNeoPreTrainedModel(PreTrainedModel):
     config_class = GPTNeoConfig
     load_tf_weights = load_tf_weights_in_gpt_neo
     base_model_prefix = "transformer"
+    # causal masks are shared by the layers instead of their former `bias` buffers, which older checkpoints contain
+    _keys_to_ignore_on_load_unexpected = [r"h\.\d+\.attn\.attention\.bias$"]
     supports_gradient_checkpointing = True
 
     def __init__(self, *inputs, **kwargs):
@@ -542,7 +606,9 @@ class GPTNeoModel(GPTNeoPreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
-        prefix_lm_mask = None
+        prefix_lm_mask = None,
+        segment_ids: Optional[torch.LongTensor] = None,
+        prefix_key_mask: Optional[torch.BoolTensor] = None
     ) -> Union[Tuple[torch.Tensor], BaseModelOutputWithPastAndCrossAttentions]:
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -574,7 +640,7 @@ class GPTNeoModel(GPTNeoPreTrainedModel):
             past_length = 0
             past_key_values = tuple([None] * len(self.h))
         else:
-            past_length = past_key_values[0][0].size(-2)
+            past_length = cached_length(past_key_values)
 
         device = input_ids.device if input_ids is not None else inputs_embeds.device
         if position_ids is None:
@@ -620,10 +686,27 @@ class GPTNeoModel(GPTNeoPreTrainedModel):
 
         output_shape = input_shape + (hidden_states.size(-1),)
 
+        # Causal, packed and prefix-LM masks are the same for all the layers of a type, build them once per forward
+        causal_masks = {}
+        if prefix_lm_mask is not None or segment_ids is not None or (
+                attention_mask is not None and len(attention_mask.size()) == 3):
+            key_length = past_length + input_shape[-1]
+            if segment_ids is None and prefix_lm_mask is not None and len(prefix_lm_mask.size()) == 1:
+                # at generation, extends the mask of the previous step if there is one
+                prefix_lm_mask = build_prefix_key_mask(prefix_lm_mask, key_length, prefix_key_mask)
+            for block, layer_past in zip(self.h, past_key_values):
+                attention = block.attn.attention
+                # layers with a sliding window cache build their mask from its positions
+                if attention.attention_type not in causal_masks and not hasattr(layer_past, "key_positions"):
+                    causal_masks[attention.attention_type] = attention._causal_mask(
+                        input_shape[-1], key_length, attention_mask, prefix_lm_mask, segment_ids
+                    )
+
         presents = () if use_cache else None
         all_self_attentions = () if output_attentions else None
         all_hidden_states = () if output_hidden_states else None
         for i, (block, layer_past) in enumerate(zip(self.h, past_key_values)):
+            causal_mask = causal_masks.get(block.attn.attention_type)
             if output_hidden_states:
                 all_hidden_states = all_hidden_states + (hidden_states,)
 
@@ -635,15 +718,15 @@ class GPTNeoModel(GPTNeoPreTrainedModel):
                     )
                     use_cache = False
 
-                def create_custom_forward(module):
+                def create_custom_forward(module, causal_mask):
                     def custom_forward(*inputs):
                         # None for past_key_value
-                        return module(*inputs, use_cache, output_attentions, prefix_lm_mask)
+                        return module(*inputs, use_cache, output_attentions, prefix_lm_mask, segment_ids, causal_mask)
 
                     return custom_forward
 
                 outputs = torch.utils.checkpoint.checkpoint(
-                    create_custom_forward(block),
+                    create_custom_forward(block, causal_mask),
                     hidden_states,
                     None,
                     attention_mask,
@@ -657,7 +740,9 @@ class GPTNeoModel(GPTNeoPreTrainedModel):
                     head_mask=head_mask[i],
                     use_cache=use_cache,
                     output_attentions=output_attentions,
-                    prefix_lm_mask=prefix_lm_mask
+                    prefix_lm_mask=prefix_lm_mask,
+                    segment_ids=segment_ids,
+                    causal_mask=causal_mask
                 )
 
             hidden_states = outputs[0]
@@ -692,7 +777,7 @@ class GPTNeoModel(GPTNeoPreTrainedModel):
     """,
     GPT_NEO_START_DOCSTRING,
 )
-class GPTNeoForCausalLM(GPTNeoPreTrainedModel):
+class GPTNeoForCausalLM(GPTNeoPreTrainedModel, CustomGenerationMixin):
     _keys_to_ignore_on_load_missing = [
         r"h\.\d+\.attn\.masked_bias",
         r"lm_head\.weight",
@@ -709,19 +794,7 @@ class GPTNeoForCausalLM(GPTNeoPreTrainedModel):
         self.tokenizer = tokenizer
         self.config = config
 
-        code_tokens_mask = torch.zeros((len(tokenizer),))
-        doc_tokens_mask = torch.zeros((len(tokenizer),))
-
-        if self.args.replicated_tokens_map:
-            for tok_id in range(0, len(tokenizer)):
-                if tok_id in self.args.replicated_tokens_map:
-                    code_tokens_mask[self.args.replicated_tokens_map[tok_id]] = 1
-                    doc_tokens_mask[tok_id] = 1
-                # if not replicated and also not new_id
-                elif (tok_id not in self.args.replicated_tokens_map.keys()) and \
-                        (tok_id not in self.args.replicated_tokens_map.values()):
-                    code_tokens_mask[tok_id] = 1
-                    doc_tokens_mask[tok_id] = 1
+        code_tokens_mask, doc_tokens_mask = build_token_masks(self.args, len(tokenizer))
 
         self.register_buffer('code_tokens_mask', code_tokens_mask)
         self.register_buffer('doc_tokens_mask', doc_tokens_mask)
@@ -740,8 +813,9 @@ class GPTNeoForCausalLM(GPTNeoPreTrainedModel):
 
     def prepare_inputs_for_generation(self, input_ids, past=None, **kwargs):
         token_type_ids = kwargs.get("token_type_ids", None)
-        # only last token for inputs_ids if past is defined in kwargs
-        if past:
+        # only last token for inputs_ids if past is defined in kwargs (and not an empty static cache)
+        past_length = cached_length(past)
+        if past_length > 0:
             input_ids = input_ids[:, -1].unsqueeze(-1)
             if token_type_ids is not None:
                 token_type_ids = token_type_ids[:, -1].unsqueeze(-1)
@@ -754,7 +828,7 @@ class GPTNeoForCausalLM(GPTNeoPreTrainedModel):
             # create position_ids on the fly for batch generation
             position_ids = attention_mask.long().cumsum(-1) - 1
             position_ids.masked_fill_(attention_mask == 0, 1)
-            if past:
+            if past_length > 0:
                 position_ids = position_ids[:, -1].unsqueeze(-1)
         else:
             position_ids = None
@@ -766,7 +840,9 @@ class GPTNeoForCausalLM(GPTNeoPreTrainedModel):
             "position_ids": position_ids,
             "attention_mask": attention_mask,
             "token_type_ids": token_type_ids,
-            "prefix_lm_mask": prefix_lm_mask
+            "prefix_lm_mask": prefix_lm_mask,
+            "prefix_key_mask": kwargs.get("prefix_key_mask"),
+            "num_logits_to_keep": kwargs.get("num_logits_to_keep", 1)
         }
 
     @add_start_docstrings_to_model_forward(GPT_NEO_INPUTS_DOCSTRING)
@@ -793,12 +869,25 @@ class GPTNeoForCausalLM(GPTNeoPreTrainedModel):
         docstr_mask=None,  # extra
         prefix_lm_mask=None,  # extra
         code_mask=None,
+        num_logits_to_keep: Optional[int] = None,
+        segment_ids: Optional[torch.LongTensor] = None,
+        prefix_key_mask: Optional[torch.BoolTensor] = None,
     ) -> Union[Tuple[torch.Tensor], CausalLMOutputWithCrossAttentions]:
         r"""
         labels (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
             Labels for language modeling. Note that the labels **are shifted** inside the model, i.e. you can set
             `labels = input_ids` Indices are selected in `[-100, 0, ..., config.vocab_size]` All labels set to `-100`
             are ignored (masked), the loss is only computed for labels in `[0, ..., config.vocab_size]`
+        num_logits_to_keep (`int`, *optional*):
+            Without `labels`, only project the last `num_logits_to_keep` positions on the vocabulary (generation only
+            needs the last one). All positions by default.
+        segment_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
+            Document index of every position of packed sequences (-1 for padding), in place of a dense 3D
+            `attention_mask`. `prefix_lm_mask` is then the `(batch_size, sequence_length)` prefix flags of the
+            positions, see `packed_attention_mask`.
+        prefix_key_mask (`torch.BoolTensor` of shape `(batch_size, past_length)`, *optional*):
+            At generation with a prefix index in `prefix_lm_mask`, the mask of the prefix keys of the previous step,
+            which is extended instead of being built again (see `build_prefix_key_mask`).
         """
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
@@ -814,10 +903,19 @@ class GPTNeoForCausalLM(GPTNeoPreTrainedModel):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
-            prefix_lm_mask=prefix_lm_mask
+            prefix_lm_mask=prefix_lm_mask,
+            segment_ids=segment_ids,
+            prefix_key_mask=prefix_key_mask
         )
         hidden_states = transformer_outputs[0]
-        lm_logits = self.lm_head(hidden_states)
+        if labels is None and num_logits_to_keep:
+            hidden_states = hidden_states[:, -num_logits_to_keep:, :]
+        compact_vocabulary = labels is None and getattr(self, "compact_lm_head_weight", None) is not None
+        if compact_vocabulary:
+            # logits of the code tokens only, see `compact_vocabulary`
+            lm_logits = nn.functional.linear(hidden_states, self.compact_lm_head_weight)
+        else:
+            lm_logits = self.lm_head(hidden_states)
 
         loss = None
         if labels is not None:
@@ -884,7 +982,7 @@ class GPTNeoForCausalLM(GPTNeoPreTrainedModel):
                 loss = loss.to(hidden_states.dtype)
 
         else:
-            if self.args.replicated_tokens_map:
+            if self.args.replicated_tokens_map and not compact_vocabulary:
                 lm_logits.masked_fill_(~self.code_tokens_mask[None, None, :].bool(), float('-inf'))
 
         if not return_dict:
@@ -907,6 +1005,7 @@ class GPTNeoForCausalLM(GPTNeoPreTrainedModel):
         beam_idx at every generation step.
         """
         return tuple(
+            layer_past.reorder(beam_idx) if hasattr(layer_past, "reorder") else
             tuple(past_state.index_select(0, beam_idx.to(past_state.device)) for past_state in layer_past)
             for layer_past in past
         )
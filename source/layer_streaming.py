@@ -0,0 +1,161 @@
+# Copyright (C) 2024. Huawei Technologies Co., Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+
+import mmap
+import ctypes
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+from torch import nn
+
+
+logger = logging.getLogger(__name__)
+
+_MADV_POPULATE_READ = 22  # maps the pages of a range, reading them if needed (Linux >= 5.14)
+
+
+@functools.lru_cache(maxsize=None)
+def _libc_madvise():
+    madvise = ctypes.CDLL(None, use_errno=True).madvise
+    madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+    return madvise
+
+
+def _madvise(start: int, end: int, advice: int) -> bool:
+    return end <= start or _libc_madvise()(start, end - start, advice) == 0
+
+
+def _file_mappings() -> List[Tuple[int, int]]:
+    """
+    Address ranges of the files mapped by the process (Linux)
+    """
+    mappings = []
+    with open('/proc/self/maps') as maps:
+        for line in maps:
+            fields = line.split()
+            if len(fields) >= 6 and fields[5].startswith('/'):
+                start, end = fields[0].split('-')
+                mappings.append((int(start, 16), int(end, 16)))
+    return mappings
+
+
+def streamed_blocks(model: nn.Module) -> List[nn.Module]:
+    """
+    Transformer blocks of a `GPTNeoForCausalLM` or `PanguAlphaModel` in their execution order: those of
+    `transformer.h`, then the top query layer of PanGu-Alpha
+    """
+    blocks = list(model.transformer.h)
+    if getattr(model, 'top_query_layer', None) is not None:
+        blocks.append(model.top_query_layer)
+    return blocks
+
+
+class LayerStreamer:
+    """
+    Executes the transformer blocks of a model whose weights are memory-mapped from a safetensors export (see
+    `fast_loading.load_safetensors_model`) with only a couple of them resident: the pages of a block are released
+    once it has run (`MADV_DONTNEED`, they stay in the page cache, which the kernel can reclaim), and those of the next
+    block are mapped by a background thread while the current one computes (`MADV_POPULATE_READ`, or a `WILLNEED`
+    readahead on older kernels). The last block prefetches the first one, for the next decoding step.
+
+    The embeddings and output layer stay resident. Every forward pays the page faults of all the blocks, which large
+    batches amortize. Only for inference: the mapped weights must not be written to.
+    """
+
+    def __init__(self, blocks: List[nn.Module], prefetch: bool = True):
+        mappings = _file_mappings()
+        self.ranges = []
+        for index, block in enumerate(blocks):
+            ranges = []
+            for tensor in list(block.parameters()) + list(block.buffers()):
+                if tensor.device.type != 'cpu':
+                    raise ValueError("Layer streaming runs on CPU")
+                if tensor.numel() == 0:
+                    continue
+                start = tensor.data_ptr()
+                end = start + tensor.numel() * tensor.element_size()
+                if not any(map_start <= start and end <= map_end for map_start, map_end in mappings):
+                    raise ValueError(f"Block {index} is not memory-mapped from a file, layer streaming needs a model "
+                                     "loaded from a safetensors export without dtype conversion")
+                ranges.append((start, end))
+            self.ranges.append(self._merge(ranges))
+
+        self.num_bytes = sum(end - start for ranges in self.ranges for start, end in ranges)
+        self.populate = True
+        self.executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        self.pending = {}
+        self.handles = []
+        for index, block in enumerate(blocks):
+            self.handles.append(block.register_forward_pre_hook(self._before_hook(index)))
+            self.handles.append(block.register_forward_hook(self._after_hook(index)))
+        for index in range(len(blocks)):
+            self.release(index)
+
+    @staticmethod
+    def _merge(ranges):
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    def prefetch(self, index: int):
+        # pages overlapping the block, including those it shares with its neighbours
+        for start, end in self.ranges[index]:
+            start, end = start - start % mmap.PAGESIZE, end + (-end) % mmap.PAGESIZE
+            if not (self.populate and _madvise(start, end, _MADV_POPULATE_READ)):
+                self.populate = False
+                _madvise(start, end, mmap.MADV_WILLNEED)
+
+    def release(self, index: int):
+        # pages entirely inside the block only, the others may be used by the block running next
+        for start, end in self.ranges[index]:
+            _madvise(start + (-start) % mmap.PAGESIZE, end - end % mmap.PAGESIZE, mmap.MADV_DONTNEED)
+
+    def _before_hook(self, index):
+        def hook(module, inputs):
+            pending = self.pending.pop(index, None)
+            if pending is not None:
+                pending.result()
+            if self.executor is not None:
+                following = (index + 1) % len(self.ranges)
+                self.pending[following] = self.executor.submit(self.prefetch, following)
+        return hook
+
+    def _after_hook(self, index):
+        def hook(module, inputs, outputs):
+            pending = self.pending.get(index)
+            if pending is None or pending.done():
+                self.release(index)
+        return hook
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def stream_layers(model: nn.Module, prefetch: bool = True) -> LayerStreamer:
+    """
+    Streams the transformer blocks of `model` (see `LayerStreamer`), in place. `LayerStreamer.remove` stops it.
+    """
+    streamer = LayerStreamer(streamed_blocks(model), prefetch=prefetch)
+    logger.info(f'Streaming {len(streamer.ranges)} blocks of {type(model).__name__} '
+                f'({streamer.num_bytes / 2 ** 20:.1f} MB), {"with" if prefetch else "without"} prefetch')
+    return streamer
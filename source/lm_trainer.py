@@ -55,6 +55,7 @@ from custom_collator import (
     DataCollatorWithPaddingForCLM
 )
 from tokenization import tokenization_function, tokenization_function_raw
+from attention_masks import set_attention_backend
 from deepspeed.runtime.zero.stage_1_and_2 import estimate_zero2_model_states_mem_needs_all_live
 from deepspeed.runtime.zero.stage3 import estimate_zero3_model_states_mem_needs_all_live
 from deepspeed.runtime.utils import see_memory_usage
@@ -128,6 +129,26 @@ class ModelArguments:
         default=False,
         metadata={"help": "Add masks on the Docstring Only."}
     )
+    packed_masks: Optional[bool] = field(
+        default=False,
+        metadata={"help": "Give per-position segment ids to the model instead of dense attention and prefix masks, "
+                          "which the attention layers expand on the fly"}
+    )
+    attention_backend: Optional[str] = field(
+        default="eager",
+        metadata={"help": "Attention implementation: `eager` or `sdpa` (fused scaled_dot_product_attention, "
+                          "torch >= 2.0)"}
+    )
+    compile_mode: Optional[str] = field(
+        default="none",
+        metadata={"help": "torch.compile the training forward, and the prefill and decode forwards of the generation "
+                          "callbacks (torch >= 2.0): `none`, `default`, `reduce-overhead` or `max-autotune`"}
+    )
+    cpu_bf16: Optional[bool] = field(
+        default=False,
+        metadata={"help": "bf16 mixed precision on CPU (e.g. AVX512-BF16 or AMX hosts) with --no_cuda, which `--bf16` "
+                          "does not support: matmuls run in bf16 under autocast, softmax and loss stay in fp32"}
+    )
 
 
 @dataclass
@@ -174,6 +195,10 @@ def main():
     training_args.prefix_lm = model_args.prefix_lm
     training_args.separate_embeds = model_args.separate_embeds
     training_args.min_learning_rate = model_args.min_learning_rate
+    training_args.cpu_bf16 = model_args.cpu_bf16
+    training_args.compile_mode = model_args.compile_mode
+    if training_args.cpu_bf16 and training_args.device.type != 'cpu':
+        raise ValueError("--cpu_bf16 trains on CPU, use it with --no_cuda (or --bf16 on GPUs)")
     training_args.debugging = model_args.debugging
     training_args.separate_some_embeds = model_args.separate_some_embeds
 
@@ -333,6 +358,7 @@ def main():
     # Extend the embedding layer
     ##############################################################
     model.resize_token_embeddings(len(tokenizer))
+    set_attention_backend(model, model_args.attention_backend)
 
     ############################
     # DeepSpeed check
@@ -421,6 +447,7 @@ def main():
             tokenizer=tokenizer,
             prefix_lm=training_args.prefix_lm,
             code_mask=True if 'pycodegpt' in model_args.model_name_or_path else False,
+            packed_masks=model_args.packed_masks,
         )
     else:
         logger.info("Using Dynamic Padding Data Collator for CLM")
@@ -429,6 +456,7 @@ def main():
             tokenizer=tokenizer,
             prefix_lm=training_args.prefix_lm,
             code_mask=True if 'pycodegpt' in model_args.model_name_or_path else False,
+            packed_masks=model_args.packed_masks,
         )
 
     ############################
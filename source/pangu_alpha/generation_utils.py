@@ -21,7 +21,7 @@
 
 import inspect
 import warnings
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
 
 import torch
@@ -61,18 +61,771 @@ from transformers.utils import ModelOutput, logging
 from transformers.generation_utils import (
 	GenerationMixin,
 	SampleOutput,
+	SampleDecoderOnlyOutput,
+	SampleEncoderDecoderOutput,
+	GreedySearchDecoderOnlyOutput,
+	GreedySearchEncoderDecoderOutput,
 	GreedySearchOutput,
 	BeamSearchOutput,
 	BeamSampleOutput
 )
+from source.attention_masks import build_prefix_key_mask
 
 logger = logging.get_logger(__name__)
 
 
+def pad_past_key_values(past, pad_length):
+	"""
+	Left-pads every cached key/value state with `pad_length` empty positions, so that caches of different lengths can
+	be stacked along the batch dimension. The padded positions must be masked in the attention mask.
+	"""
+	if pad_length == 0:
+		return past
+	return tuple(
+		tuple(nn.functional.pad(past_state, (0, 0, pad_length, 0)) for past_state in layer_past)
+		for layer_past in past
+	)
+
+
+def concat_past_key_values(past, other_past):
+	"""
+	Stacks two caches of the same length along the batch dimension
+	"""
+	return tuple(
+		tuple(torch.cat((past_state, other_state), dim=0) for past_state, other_state in zip(layer_past, other_layer_past))
+		for layer_past, other_layer_past in zip(past, other_past)
+	)
+
+
+def concat_past_key_values_list(pasts):
+	"""
+	Stacks a list of caches of the same length along the batch dimension
+	"""
+	return tuple(
+		tuple(torch.cat([past[i][j] for past in pasts], dim=0) for j in range(len(pasts[0][i])))
+		for i in range(len(pasts[0]))
+	)
+
+
+def select_past_key_values(past, batch_idx):
+	"""
+	Keeps only the rows `batch_idx` of every cached key/value state
+	"""
+	return tuple(
+		tuple(past_state.index_select(0, batch_idx.to(past_state.device)) for past_state in layer_past)
+		for layer_past in past
+	)
+
+
+def trim_past_key_values(past, trim_length):
+	"""
+	Drops the first `trim_length` positions of every cached key/value state
+	"""
+	if trim_length == 0:
+		return past
+	return tuple(tuple(past_state[..., trim_length:, :] for past_state in layer_past) for layer_past in past)
+
+
+def crop_past_key_values(past, length):
+	"""
+	Keeps the first `length` positions of every cached key/value state
+	"""
+	return tuple(tuple(past_state[..., :length, :] for past_state in layer_past) for layer_past in past)
+
+
+def cached_length(past):
+	if past is None:
+		return 0
+	# layers of a `StaticKVCache` count their positions (a sliding window one holds fewer)
+	return past[0].seq_length if hasattr(past[0], "seq_length") else past[0][0].size(-2)
+
+
+def forward_new_positions(model, input_ids, past, attention_mask, prefix_lm_mask=None, num_logits_to_keep=None):
+	"""
+	Runs `model` over the positions of `input_ids` that are not in `past` yet (several at once, unlike
+	`prepare_inputs_for_generation`). Returns the fp32 logits of these positions (only of the last
+	`num_logits_to_keep` ones if given) and the extended cache.
+	"""
+	num_new = input_ids.size(-1) - cached_length(past)
+	position_ids = attention_mask.long().cumsum(-1) - 1
+	position_ids.masked_fill_(attention_mask == 0, 1)
+	outputs = model(
+		input_ids=input_ids[:, -num_new:],
+		past_key_values=past,
+		attention_mask=attention_mask,
+		position_ids=position_ids[:, -num_new:],
+		use_cache=True,
+		prefix_lm_mask=prefix_lm_mask,
+		return_dict=True,
+		num_logits_to_keep=num_logits_to_keep,
+	)
+	return outputs.logits.float(), outputs.past_key_values
+
+
+def expand_past_key_values(past, expand_size):
+	"""
+	Repeats a cache computed for a single sequence `expand_size` times along the batch dimension. The result is a view
+	of the given cache, nothing is copied until the next forward pass concatenates new positions to it.
+	"""
+	return tuple(
+		tuple(past_state.expand(expand_size, *past_state.shape[1:]) for past_state in layer_past)
+		for layer_past in past
+	)
+
+
+class StaticKVCacheLayer:
+	"""
+	Key/value states of one attention layer in a `StaticKVCache`. Attention layers recognise it by its `update` method
+	and write the new states in place instead of concatenating them to the `(key, value)` tuple.
+	"""
+	def __init__(self, key_states, value_states):
+		self.key_states = key_states
+		self.value_states = value_states
+		self.seq_length = 0
+
+	def update(self, key, value):
+		start, end = self.seq_length, self.seq_length + key.size(-2)
+		if end > self.key_states.size(-2):
+			raise ValueError(
+				f"The static cache holds {self.key_states.size(-2)} positions, but {end} are needed. "
+				"Increase `max_length` of the cache."
+			)
+		self.key_states[:, :, start:end] = key
+		self.value_states[:, :, start:end] = value
+		self.seq_length = end
+		return self[0], self[1]
+
+	def reorder(self, beam_idx):
+		beam_idx = beam_idx.to(self.key_states.device)
+		self.key_states.copy_(self.key_states.index_select(0, beam_idx))
+		self.value_states.copy_(self.value_states.index_select(0, beam_idx))
+		return self
+
+	def __getitem__(self, idx):
+		# (batch, head, seq_length, head_features) views, like the tuple cache
+		return (self.key_states, self.value_states)[idx][:, :, :self.seq_length]
+
+	def __len__(self):
+		return 2
+
+	def __iter__(self):
+		yield self[0]
+		yield self[1]
+
+
+class SlidingWindowKVCacheLayer:
+	"""
+	Key/value states of a local attention layer in a `StaticKVCache`, which only ever attends to the last
+	`window_size` positions: these are kept in a ring buffer, where every new position overwrites the one that just
+	left the window, and the first `num_pinned` positions (the prefix, which every query attends to) are kept aside.
+
+	`update` returns the pinned states, the window and the new states, whose positions in the sequence are then in
+	`key_positions` (-1 for empty slots and for slots duplicating a pinned position). Attention layers recognise the
+	cache by these and build their mask from them, see `sliding_window_mask`.
+	"""
+	def __init__(self, key_states, value_states, pinned_key_states, pinned_value_states):
+		self.key_states = key_states
+		self.value_states = value_states
+		self.pinned_key_states = pinned_key_states
+		self.pinned_value_states = pinned_value_states
+		self.window_size = key_states.size(-2)
+		self.num_pinned = pinned_key_states.size(-2)
+		self.slot_positions = torch.full((self.window_size,), -1, dtype=torch.long, device=key_states.device)
+		self.key_positions = None
+		self.seq_length = 0
+
+	def update(self, key, value):
+		start, end = self.seq_length, self.seq_length + key.size(-2)
+		new_positions = torch.arange(start, end, device=key.device)
+		if start == 0:
+			keys, values, key_positions = key, value, new_positions
+		else:
+			num_pinned = min(self.num_pinned, start)
+			keys = torch.cat([self.pinned_key_states[:, :, :num_pinned], self.key_states, key], dim=-2)
+			values = torch.cat([self.pinned_value_states[:, :, :num_pinned], self.value_states, value], dim=-2)
+			key_positions = torch.cat([
+				torch.arange(num_pinned, device=key.device),
+				self.slot_positions.masked_fill(self.slot_positions < self.num_pinned, -1),
+				new_positions
+			])
+
+		if start < self.num_pinned:
+			num_new_pinned = min(self.num_pinned, end) - start
+			self.pinned_key_states[:, :, start:start + num_new_pinned] = key[:, :, :num_new_pinned]
+			self.pinned_value_states[:, :, start:start + num_new_pinned] = value[:, :, :num_new_pinned]
+		# only the last `window_size` new positions can still be attended to
+		first = max(start, end - self.window_size)
+		slots = new_positions[first - start:] % self.window_size
+		self.key_states.index_copy_(2, slots, key[:, :, first - start:])
+		self.value_states.index_copy_(2, slots, value[:, :, first - start:])
+		self.slot_positions[slots] = new_positions[first - start:]
+
+		self.seq_length = end
+		self.key_positions = key_positions
+		return keys, values
+
+	def reorder(self, beam_idx):
+		beam_idx = beam_idx.to(self.key_states.device)
+		for states in (self.key_states, self.value_states, self.pinned_key_states, self.pinned_value_states):
+			states.copy_(states.index_select(0, beam_idx))
+		return self
+
+
+class StaticKVCache:
+	"""
+	Key/value cache allocated once for `max_length` positions, so that decoding writes every new position in place
+	instead of copying the whole cache with `torch.cat`. It behaves like the tuple of per-layer `(key, value)` tuples
+	returned as `past_key_values` (indexing, slicing, `cached_length` being the cached length).
+
+	Layers with a `window_sizes` entry (local attention layers) get a `SlidingWindowKVCacheLayer` of that many
+	positions instead, plus `num_pinned` prefix positions.
+	"""
+	def __init__(self, num_layers, batch_size, num_heads, max_length, head_dim, dtype=torch.float32, device=None,
+				 window_sizes=None, num_pinned=0):
+		shape = (batch_size, num_heads, max_length, head_dim)
+		self.max_length = max_length
+		window_sizes = window_sizes or [None] * num_layers
+		self.layers = tuple(
+			StaticKVCacheLayer(
+				torch.empty(shape, dtype=dtype, device=device),
+				torch.empty(shape, dtype=dtype, device=device)
+			)
+			if window_size is None or window_size + num_pinned >= max_length else
+			# zeros, since empty slots are masked but still multiplied with
+			SlidingWindowKVCacheLayer(
+				torch.zeros((batch_size, num_heads, window_size, head_dim), dtype=dtype, device=device),
+				torch.zeros((batch_size, num_heads, window_size, head_dim), dtype=dtype, device=device),
+				torch.zeros((batch_size, num_heads, num_pinned, head_dim), dtype=dtype, device=device),
+				torch.zeros((batch_size, num_heads, num_pinned, head_dim), dtype=dtype, device=device)
+			)
+			for window_size in window_sizes
+		)
+
+	def get_seq_length(self):
+		return self.layers[0].seq_length
+
+	def __getitem__(self, idx):
+		return self.layers[idx]
+
+	def __len__(self):
+		return len(self.layers)
+
+	def __iter__(self):
+		return iter(self.layers)
+
+
+@dataclass
+class SpeculativeDecodingStats:
+	"""
+	Counts of `CustomGenerationMixin.speculative_sample`, accumulated over calls. `proposed_tokens` and
+	`accepted_tokens` are summed over the unfinished rows, `target_forwards` counts the verification passes of the
+	target model and `generated_tokens` the tokens a row gains per pass (summed over passes). `row_proposed` and
+	`row_accepted` hold the counts of every row of the last call, e.g. to attribute them to tasks.
+	"""
+	proposed_tokens: int = 0
+	accepted_tokens: int = 0
+	target_forwards: int = 0
+	generated_tokens: int = 0
+	# per row of the last call
+	row_proposed: List[int] = field(default_factory=list)
+	row_accepted: List[int] = field(default_factory=list)
+
+	@property
+	def acceptance_rate(self):
+		return self.accepted_tokens / self.proposed_tokens if self.proposed_tokens > 0 else 0.0
+
+	@property
+	def tokens_per_forward(self):
+		return self.generated_tokens / self.target_forwards if self.target_forwards > 0 else 0.0
+
+	def summary(self):
+		return (
+			f"{self.accepted_tokens}/{self.proposed_tokens} draft tokens accepted ({100 * self.acceptance_rate:.1f}%), "
+			f"{self.tokens_per_forward:.2f} tokens per forward pass of the target model"
+		)
+
+
+class DraftModelProposer:
+	"""
+	Proposes tokens for `CustomGenerationMixin.speculative_sample` by decoding them with a (smaller) draft model,
+	which keeps its own cache between the steps. `process` turns the draft logits into the scores that are sampled.
+	"""
+	def __init__(self, draft_model, process, do_sample=True, prefix_lm_mask=None):
+		self.draft_model = draft_model
+		self.process = process
+		self.do_sample = do_sample
+		self.prefix_lm_mask = prefix_lm_mask
+		self.past = None
+
+	def propose(self, input_ids, attention_mask, num_tokens):
+		"""
+		Returns the `(batch_size, num_tokens)` proposed tokens, which of them are valid (all of them) and the
+		distributions they were sampled from (`None` for greedy search)
+		"""
+		draft_ids, draft_mask = input_ids, attention_mask
+		draft_probs = []
+		for _ in range(num_tokens):
+			logits, self.past = forward_new_positions(
+				self.draft_model, draft_ids, self.past, draft_mask, prefix_lm_mask=self.prefix_lm_mask, num_logits_to_keep=1
+			)
+			scores = self.process(draft_ids, logits[:, -1, :])
+			if self.do_sample:
+				probs = nn.functional.softmax(scores, dim=-1)
+				next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+				draft_probs.append(probs)
+			else:
+				next_tokens = torch.argmax(scores, dim=-1)
+			draft_ids = torch.cat([draft_ids, next_tokens[:, None]], dim=-1)
+			draft_mask = torch.cat([draft_mask, draft_mask.new_ones((draft_mask.shape[0], 1))], dim=-1)
+
+		proposed = draft_ids[:, input_ids.shape[-1]:]
+		valid = torch.ones_like(proposed, dtype=torch.bool)
+		return proposed, valid, torch.stack(draft_probs, dim=1) if draft_probs else None
+
+	def crop(self, length):
+		if self.past is not None:
+			self.past = crop_past_key_values(self.past, min(cached_length(self.past), length))
+
+
+class PromptLookupProposer:
+	"""
+	Proposes tokens for `CustomGenerationMixin.speculative_sample` without a draft model: the last n tokens of every
+	row are looked up in the row itself (the prompt and what was generated so far), and the tokens that followed
+	their latest occurrence are proposed. Generated code often copies names from the signature and the docstring.
+	N-grams from `max_ngram_size` down to `min_ngram_size` are tried, the longest match wins.
+	"""
+	def __init__(self, max_ngram_size=3, min_ngram_size=1):
+		self.max_ngram_size = max_ngram_size
+		self.min_ngram_size = min_ngram_size
+
+	def propose(self, input_ids, attention_mask, num_tokens):
+		"""
+		Returns the `(batch_size, k)` proposed tokens, which of them are valid (rows can have shorter or no matches),
+		and `None` as the proposals are deterministic. `k <= num_tokens` is the longest valid proposal.
+		"""
+		batch_size, length = input_ids.shape
+		proposed = input_ids.new_zeros((batch_size, num_tokens))
+		valid = torch.zeros((batch_size, num_tokens), dtype=torch.bool, device=input_ids.device)
+		found = torch.zeros(batch_size, dtype=torch.bool, device=input_ids.device)
+		offsets = torch.arange(num_tokens, device=input_ids.device)
+
+		for ngram_size in range(self.max_ngram_size, self.min_ngram_size - 1, -1):
+			if num_tokens == 0 or length <= ngram_size:
+				continue
+			# windows that are followed by at least one token, i.e. all but the current n-gram
+			windows = input_ids[:, :-1].unfold(1, ngram_size, 1)
+			matches = (windows == input_ids[:, None, -ngram_size:]).all(dim=-1)
+			starts = torch.arange(matches.shape[-1], device=input_ids.device)
+			latest = torch.where(matches, starts, starts.new_full((), -1)).max(dim=-1).values
+
+			use = (latest >= 0) & ~found
+			positions = latest[:, None] + ngram_size + offsets
+			tokens = input_ids.gather(1, positions.clamp(min=0, max=length - 1))
+			proposed = torch.where(use[:, None], tokens, proposed)
+			valid = torch.where(use[:, None], positions < length, valid)
+			found |= use
+
+		# no need to score positions that no row proposes anything for
+		num_valid = int(valid.sum(dim=-1).max()) if num_tokens > 0 else 0
+		return proposed[:, :num_valid], valid[:, :num_valid], None
+
+	def crop(self, length):
+		pass
+
+
+class RowStoppingCriteria(StoppingCriteria):
+	"""
+	Stopping criteria that decide per row. `CustomGenerationMixin.sample` marks the rows returned by `finished_rows`
+	as finished (they get padded from then on), generation stops once all rows are finished.
+	"""
+	def finished_rows(self, input_ids: torch.LongTensor) -> torch.BoolTensor:
+		raise NotImplementedError(f"{self.__class__} is an abstract class. Only classes inheriting this class can be called.")
+
+	def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+		return bool(self.finished_rows(input_ids).all())
+
+
+class FunctionBodyTracker:
+	"""
+	Follows the `<NEW_LINE>`/`<INDENT>`/`<DEDENT>` tokens of one generated row the way `post_process_generated_tokens`
+	turns them into indentation (at most one indent per line, every dedent counts), and tells when a line with content
+	ends up at column 0. The evaluation (`process_mbpp_test`, `process_humaneval_test`) drops everything from that line
+	on, so the row does not need to be decoded any further.
+	"""
+	def __init__(self, criteria):
+		self.criteria = criteria
+		self.depth = 0
+		self.line_indented = False
+		self.line_has_content = False
+		self.finished = False
+		self.num_tokens = 0
+
+	def feed(self, token_id):
+		if self.finished:
+			return True
+		self.num_tokens += 1
+
+		criteria = self.criteria
+		if token_id in criteria.new_line_ids:
+			if self.line_has_content and self.depth <= 0:
+				self.finished = True
+			self.line_indented = False
+			self.line_has_content = False
+		elif token_id in criteria.indent_ids:
+			if not self.line_indented:
+				self.depth += 1
+				self.line_indented = True
+		elif token_id in criteria.dedent_ids:
+			self.depth -= 1
+		elif criteria.is_content[token_id]:
+			self.line_has_content = True
+
+		# decide before the end of the line when no later token of the line can indent it anymore
+		if self.line_has_content and self.depth + (0 if self.line_indented else 1) <= 0:
+			self.finished = True
+		return self.finished
+
+
+class FunctionBodyStoppingCriteria(RowStoppingCriteria):
+	"""
+	Finishes a row once the generated function body dedents back to column 0, i.e. once a line with content has no
+	indentation left.
+
+	Args:
+		tokenizer:
+			The tokenizer, used to find the structural tokens and the tokens that only hold whitespace.
+		start_positions (`List[int]`, *optional*):
+			Position of every row from which the generated code is tracked (the prompt length, including left padding
+			and excluding the completion of incremental tasks). Needed by `finished_rows`.
+		replicated_tokens_map (`Dict[int, int]`, *optional*):
+			Map of docstring to code token ids, whose code ids are tracked like the original ones.
+	"""
+	def __init__(self, tokenizer, start_positions=None, replicated_tokens_map=None):
+		def with_replicas(token):
+			token_id = tokenizer.convert_tokens_to_ids(token)
+			ids = {token_id}
+			if replicated_tokens_map and token_id in replicated_tokens_map:
+				ids.add(replicated_tokens_map[token_id])
+			return ids
+
+		self.new_line_ids = with_replicas('<NEW_LINE>')
+		self.indent_ids = with_replicas('<INDENT>')
+		self.dedent_ids = with_replicas('<DEDENT>')
+
+		# tokens that put visible text on the line (the others are whitespace or special tokens), from the raw pieces
+		# in a single pass like `post_process_generated_tokens` joins them, not one decoding per vocabulary entry
+		special_ids = set(tokenizer.all_special_ids)
+		self.is_content = [
+			token is not None and token_id not in special_ids
+			and len(token.replace('\u2581', ' ').replace('[_DUP_]', '').strip()) > 0
+			for token_id, token in enumerate(tokenizer.convert_ids_to_tokens(list(range(len(tokenizer)))))
+		]
+
+		self.trackers = None
+		if start_positions is not None:
+			self.reset(start_positions)
+
+	def reset(self, start_positions):
+		"""
+		Starts tracking a new batch, whose rows begin at `start_positions`
+		"""
+		self.trackers = [FunctionBodyTracker(self) for _ in start_positions]
+		self.num_seen = list(start_positions)
+		# length of every row when it got finished, `None` while it is not
+		self.finished_at = [None] * len(start_positions)
+
+	def new_row(self):
+		"""
+		Tracker of a single row, to be fed every token after the prompt
+		"""
+		return FunctionBodyTracker(self)
+
+	def finished_rows(self, input_ids: torch.LongTensor) -> torch.BoolTensor:
+		if self.trackers is None:
+			raise ValueError("`start_positions` have to be given to track the rows of a batch")
+
+		# a single device to host copy of the positions not seen yet
+		offset = min(self.num_seen)
+		new_tokens = input_ids[:, offset:].tolist()
+		for i, tracker in enumerate(self.trackers):
+			if not tracker.finished:
+				for position in range(self.num_seen[i], input_ids.size(-1)):
+					if tracker.feed(new_tokens[i][position - offset]):
+						self.finished_at[i] = position + 1
+						break
+			self.num_seen[i] = input_ids.size(-1)
+		return torch.tensor([tracker.finished for tracker in self.trackers], dtype=torch.bool, device=input_ids.device)
+
+
 class CustomGenerationMixin(GenerationMixin):
 	def __init__(self):
 		super().__init__()
 
+	def _update_model_kwargs_for_generation(
+		self, outputs: ModelOutput, model_kwargs: Dict[str, Any], is_encoder_decoder: bool = False
+	) -> Dict[str, Any]:
+		model_kwargs = super()._update_model_kwargs_for_generation(
+			outputs, model_kwargs, is_encoder_decoder=is_encoder_decoder
+		)
+		# with a prefix index, the mask of the prefix keys is kept across steps and extended by the new position,
+		# instead of being built again by every forward
+		prefix_lm_mask = model_kwargs.get("prefix_lm_mask")
+		attention_mask = model_kwargs.get("attention_mask")
+		if isinstance(prefix_lm_mask, torch.Tensor) and prefix_lm_mask.dim() == 1 and attention_mask is not None:
+			model_kwargs["prefix_key_mask"] = build_prefix_key_mask(
+				prefix_lm_mask, attention_mask.size(-1), model_kwargs.get("prefix_key_mask")
+			)
+		return model_kwargs
+
+	def _sample_next_tokens(
+		self,
+		input_ids: torch.LongTensor,
+		next_token_logits: torch.FloatTensor,
+		logits_processor: LogitsProcessorList,
+		logits_warper: LogitsProcessorList,
+		sample_replacement: bool = False,
+		do_sample: bool = True,
+	) -> Tuple[torch.LongTensor, torch.FloatTensor]:
+		"""
+		Pre-processes the logits of the last position and samples the next token of every row (or takes the argmax
+		if `do_sample=False`). Returns the next tokens and the processed scores they were chosen from.
+		"""
+		compact_index = getattr(self, "compact_index", None)
+		if compact_index is not None and len(logits_processor) > 0:
+			# the logits only cover the code vocabulary, the processors see the ids of the other tokens as an extra
+			# column that stays at -inf
+			input_ids = compact_index[input_ids]
+			next_token_logits = torch.cat(
+				[next_token_logits, next_token_logits.new_full((next_token_logits.shape[0], 1), float("-inf"))], dim=-1
+			)
+
+		next_token_scores = logits_processor(input_ids, next_token_logits)
+		if not do_sample:
+			next_tokens = torch.argmax(next_token_scores, dim=-1)
+		else:
+			next_token_scores = logits_warper(input_ids, next_token_scores)
+
+			probs = nn.functional.softmax(next_token_scores, dim=-1)
+			# --- Hack Begin --- #
+			next_tokens = torch.multinomial(probs, num_samples=1, replacement=sample_replacement).squeeze(1)
+			# next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+			# ---- Hack End ---- #
+
+		if compact_index is not None:
+			next_tokens = self.compact_token_ids[next_tokens]
+			next_token_scores = next_token_scores[:, :self.compact_token_ids.shape[0]]
+		return next_tokens, next_token_scores
+
+	def _mask_non_code_tokens(self, logits: torch.FloatTensor) -> torch.FloatTensor:
+		"""
+		Restricts `logits` to the code vocabulary, as the forward pass of the model does at inference when the
+		vocabulary is replicated
+		"""
+		if getattr(self.args, "replicated_tokens_map", None):
+			logits = logits.masked_fill(~self.code_tokens_mask.bool(), float("-inf"))
+		return logits
+
+	def _output_embedding_weight(self) -> torch.Tensor:
+		output_embeddings = self.get_output_embeddings()
+		# PanGu-Alpha projects on the (tied) input embeddings directly
+		return output_embeddings.weight if output_embeddings is not None else self.transformer.wte.weight
+
+	def compact_vocabulary(self, token_ids: Optional[torch.LongTensor] = None, weight: Optional[torch.Tensor] = None):
+		"""
+		Switches generation to the code vocabulary: with replicated tokens half of the vocabulary is masked with -inf
+		anyway, so the forward pass projects on the rows of `code_tokens_mask` only, and `_sample_next_tokens` samples
+		from these logits and maps the tokens back to the original ids. `token_ids` and `weight` are the code token ids
+		and their rows of the output embeddings, as saved by `save_compact_vocabulary` (built from the model if not
+		given).
+
+		Logits processors only get consistent ids through `input_ids` (e.g. the repetition penalty), those that index
+		fixed token ids of the original vocabulary (minimum length, bad words) are not supported.
+		"""
+		if not getattr(self.args, "replicated_tokens_map", None):
+			raise ValueError("The vocabulary can only be compacted with a `replicated_tokens_map`")
+
+		device = self.code_tokens_mask.device
+		if token_ids is None:
+			token_ids = self.code_tokens_mask.nonzero().squeeze(-1)
+		token_ids = token_ids.to(device)
+		if weight is None:
+			weight = self._output_embedding_weight().detach().index_select(0, token_ids)
+		weight = weight.to(device=device, dtype=self.dtype)
+
+		# original id -> compact id, the ids of the other tokens point past the compact vocabulary
+		compact_index = torch.full(self.code_tokens_mask.shape, token_ids.shape[0], dtype=torch.long, device=device)
+		compact_index[token_ids] = torch.arange(token_ids.shape[0], device=device)
+
+		self.register_buffer("compact_token_ids", token_ids, persistent=False)
+		self.register_buffer("compact_lm_head_weight", weight, persistent=False)
+		self.register_buffer("compact_index", compact_index, persistent=False)
+		return self
+
+	def save_compact_vocabulary(self, path: str):
+		"""
+		Saves the code token ids and their output embeddings, which `compact_vocabulary` can be given
+		"""
+		if getattr(self, "compact_token_ids", None) is None:
+			self.compact_vocabulary()
+		torch.save({"token_ids": self.compact_token_ids.cpu(), "weight": self.compact_lm_head_weight.cpu()}, path)
+
+	def init_static_cache(
+		self, batch_size: int, max_length: int, prefix_lm_mask: Optional[torch.LongTensor] = None
+	) -> StaticKVCache:
+		"""
+		Allocates a `StaticKVCache` with one entry per attention layer of the model (PanGu-Alpha has an extra one for
+		its `top_query_layer`). Local attention layers of GPT-Neo only keep their window and the prefix up to the
+		largest index of `prefix_lm_mask`.
+		"""
+		num_layers = len(self.transformer.h) + (1 if hasattr(self, "top_query_layer") else 0)
+		num_heads = self.config.num_attention_heads
+		attention_layers = getattr(self.config, "attention_layers", None)
+		window_sizes = None
+		if attention_layers:
+			window_sizes = [
+				self.config.window_size if attention_type == "local" else None for attention_type in attention_layers
+			]
+		num_pinned = 0
+		if isinstance(prefix_lm_mask, torch.Tensor) and prefix_lm_mask.dim() == 1:
+			num_pinned = int(prefix_lm_mask.max()) + 1
+		return StaticKVCache(
+			num_layers=num_layers,
+			batch_size=batch_size,
+			num_heads=num_heads,
+			max_length=max_length,
+			head_dim=self.config.hidden_size // num_heads,
+			dtype=self.dtype,
+			device=self.device,
+			window_sizes=window_sizes,
+			num_pinned=num_pinned,
+		)
+
+	def _get_decoding_processors(
+		self,
+		do_sample: bool = True,
+		temperature: Optional[float] = None,
+		top_k: Optional[int] = None,
+		top_p: Optional[float] = None,
+		repetition_penalty: Optional[float] = None,
+	) -> Tuple[LogitsProcessorList, LogitsProcessorList]:
+		"""
+		Builds the logits processors and warpers that `generate` uses for sampling/greedy search with the given
+		arguments, for decoding loops that do not go through `generate`.
+		"""
+		logits_processor = LogitsProcessorList()
+		if repetition_penalty is not None and repetition_penalty != 1.0:
+			logits_processor.append(RepetitionPenaltyLogitsProcessor(penalty=repetition_penalty))
+
+		if do_sample:
+			logits_warper = self._get_logits_warper(
+				top_k=top_k, top_p=top_p, typical_p=None, temperature=temperature, num_beams=1
+			)
+		else:
+			logits_warper = LogitsProcessorList()
+		return logits_processor, logits_warper
+
+	@torch.no_grad()
+	def generate_fan_out(
+		self,
+		input_ids: torch.LongTensor,
+		num_samples: int,
+		chunk_size: Optional[int] = None,
+		max_length: Optional[int] = None,
+		max_new_tokens: Optional[int] = None,
+		do_sample: bool = True,
+		temperature: Optional[float] = None,
+		top_k: Optional[int] = None,
+		top_p: Optional[float] = None,
+		repetition_penalty: Optional[float] = None,
+		prefix_lm_mask: Optional[torch.LongTensor] = None,
+		**generate_kwargs,
+	) -> Iterable[torch.LongTensor]:
+		r"""
+		Generates `num_samples` continuations of a single prompt, running the forward pass over the prompt only once.
+
+		The prompt cache (including the `top_query_layer` entry of PanGu-Alpha) is expanded to `chunk_size` rows
+		without copying, the first token of every row is sampled from the shared last-position logits, and the rest is
+		left to `generate` which continues from the expanded cache. Rows whose first token is `eos_token_id` are passed
+		to it as finished, so that they are padded like in `sample`.
+
+		Parameters:
+			input_ids (`torch.LongTensor` of shape `(1, sequence_length)`):
+				The (un-padded) prompt.
+			num_samples (`int`):
+				Number of continuations to generate.
+			chunk_size (`int`, *optional*):
+				Maximum number of continuations generated together, defaults to `num_samples`.
+			prefix_lm_mask (`torch.LongTensor` of shape `(1,)`, *optional*):
+				Index up to which the prompt is a prefix-LM prefix.
+
+		Yields:
+			`torch.LongTensor` of shape `(chunk, total_length)`: the prompt followed by the generated tokens, for
+			consecutive chunks of the `num_samples` continuations.
+		"""
+		if input_ids.size(0) != 1:
+			raise ValueError(f"`generate_fan_out` expects a single prompt, but got a batch of {input_ids.size(0)}")
+		chunk_size = chunk_size if chunk_size is not None else num_samples
+		eos_token_id = generate_kwargs.get("eos_token_id", self.config.eos_token_id)
+
+		# same length semantics as `generate`, `max_length` has priority
+		prompt_length = input_ids.size(-1)
+		if max_length is None:
+			max_length = prompt_length + max_new_tokens if max_new_tokens is not None else self.config.max_length
+
+		logits_processor, logits_warper = self._get_decoding_processors(
+			do_sample=do_sample,
+			temperature=temperature,
+			top_k=top_k,
+			top_p=top_p,
+			repetition_penalty=repetition_penalty,
+		)
+
+		# 1. prefill the prompt once
+		attention_mask = input_ids.new_ones(input_ids.shape)
+		model_inputs = self.prepare_inputs_for_generation(
+			input_ids, attention_mask=attention_mask, use_cache=True, prefix_lm_mask=prefix_lm_mask
+		)
+		outputs = self(**model_inputs, return_dict=True)
+		past = outputs.past_key_values
+		next_token_logits = outputs.logits[:, -1, :].float()
+
+		for start in range(0, num_samples, chunk_size):
+			expand_size = min(chunk_size, num_samples - start)
+
+			# 2. sample the first token of every continuation from the shared logits
+			chunk_input_ids = input_ids.expand(expand_size, -1)
+			chunk_logits = next_token_logits.expand(expand_size, -1)
+			next_tokens, _ = self._sample_next_tokens(
+				chunk_input_ids, chunk_logits, logits_processor, logits_warper, sample_replacement=True,
+				do_sample=do_sample
+			)
+			chunk_input_ids = torch.cat([chunk_input_ids, next_tokens[:, None]], dim=-1)
+			unfinished_sequences = None
+			if eos_token_id is not None:
+				unfinished_sequences = (next_tokens != eos_token_id).long()
+
+			all_finished = unfinished_sequences is not None and unfinished_sequences.max() == 0
+			if chunk_input_ids.size(-1) >= max_length or all_finished:
+				yield chunk_input_ids
+				continue
+
+			# 3. decode the rest from the expanded cache
+			yield self.generate(
+				input_ids=chunk_input_ids,
+				past=expand_past_key_values(past, expand_size),
+				attention_mask=chunk_input_ids.new_ones(chunk_input_ids.shape),
+				prefix_lm_mask=prefix_lm_mask.expand(expand_size) if prefix_lm_mask is not None else None,
+				max_length=max_length,
+				do_sample=do_sample,
+				temperature=temperature,
+				top_k=top_k,
+				top_p=top_p,
+				repetition_penalty=repetition_penalty,
+				num_return_sequences=1,
+				unfinished_sequences=unfinished_sequences,
+				**generate_kwargs,
+			)
+
 	def sample(
 		self,
 		input_ids: torch.LongTensor,
@@ -88,8 +841,10 @@ class CustomGenerationMixin(GenerationMixin):
 		return_dict_in_generate: Optional[bool] = None,
 		synced_gpus: Optional[bool] = False,
 		sample_replacement: bool = False,
+		do_sample: bool = True,
+		unfinished_sequences: Optional[torch.LongTensor] = None,
 		**model_kwargs,
-	) -> Union[SampleOutput, torch.LongTensor]:
+	) -> Union[SampleOutput, GreedySearchOutput, torch.LongTensor]:
 		r"""
 		Generates sequences of token ids for models with a language modeling head using **multinomial sampling** and
 		can be used for text-decoder, text-to-text, speech-to-text, and vision-to-text models.
@@ -125,6 +880,13 @@ class CustomGenerationMixin(GenerationMixin):
 				Whether or not to return a [`~utils.ModelOutput`] instead of a plain tuple.
 			synced_gpus (`bool`, *optional*, defaults to `False`):
 				Whether to continue running the while loop until max_length (needed for ZeRO stage 3)
+			sample_replacement (`bool`, *optional*, defaults to `False`):
+				Whether `torch.multinomial` samples with replacement.
+			do_sample (`bool`, *optional*, defaults to `True`):
+				Whether to sample, otherwise the most likely token is taken (greedy search).
+			unfinished_sequences (`torch.LongTensor` of shape `(batch_size,)`, *optional*):
+				0 for the rows that are already finished (e.g. whose first token, sampled by `generate_fan_out`, is
+				`eos_token_id`), which are only padded.
 			model_kwargs:
 				Additional model specific kwargs will be forwarded to the `forward` function of the model. If model is
 				an encoder-decoder model the kwargs should include `encoder_outputs`.
@@ -213,7 +975,9 @@ class CustomGenerationMixin(GenerationMixin):
 			)
 
 		# keep track of which sequences are already finished
-		unfinished_sequences = input_ids.new(input_ids.shape[0]).fill_(1)
+		if unfinished_sequences is None:
+			unfinished_sequences = input_ids.new(input_ids.shape[0]).fill_(1)
+		row_stopping_criteria = [criteria for criteria in stopping_criteria if hasattr(criteria, "finished_rows")]
 		cur_len = input_ids.shape[-1]
 
 		this_peer_finished = False  # used by synced_gpus only
@@ -245,11 +1009,14 @@ class CustomGenerationMixin(GenerationMixin):
 				cur_len = cur_len + 1
 				continue  # don't waste resources running the code we don't need
 
-			next_token_logits = outputs.logits[:, -1, :]
+			# logits processors and sampling in fp32 (no-op unless the model runs in half precision)
+			next_token_logits = outputs.logits[:, -1, :].float()
 
-			# pre-process distribution
-			next_token_scores = logits_processor(input_ids, next_token_logits)
-			next_token_scores = logits_warper(input_ids, next_token_scores)
+			# pre-process distribution and sample
+			next_tokens, next_token_scores = self._sample_next_tokens(
+				input_ids, next_token_logits, logits_processor, logits_warper, sample_replacement=sample_replacement,
+				do_sample=do_sample
+			)
 
 			# Store scores, attentions and hidden_states when required
 			if return_dict_in_generate:
@@ -269,15 +1036,8 @@ class CustomGenerationMixin(GenerationMixin):
 						else (outputs.hidden_states,)
 					)
 
-			# sample
-			probs = nn.functional.softmax(next_token_scores, dim=-1)
-			# --- Hack Begin --- #
-			next_tokens = torch.multinomial(probs, num_samples=1, replacement=sample_replacement).squeeze(1)
-			# next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
-			# ---- Hack End ---- #
-
 			# finished sentences should have their next token be a padding token
-			if eos_token_id is not None:
+			if eos_token_id is not None or row_stopping_criteria:
 				if pad_token_id is None:
 					raise ValueError("If `eos_token_id` is defined, make sure that `pad_token_id` is defined.")
 				next_tokens = next_tokens * unfinished_sequences + pad_token_id * (1 - unfinished_sequences)
@@ -294,6 +1054,10 @@ class CustomGenerationMixin(GenerationMixin):
 			if eos_token_id is not None:
 				unfinished_sequences = unfinished_sequences.mul((next_tokens != eos_token_id).long())
 
+			# rows can also be finished by the per-row stopping criteria
+			for criteria in row_stopping_criteria:
+				unfinished_sequences = unfinished_sequences.mul((~criteria.finished_rows(input_ids)).long())
+
 			# stop when each sentence is finished, or if we exceed the maximum length
 			if unfinished_sequences.max() == 0 or stopping_criteria(input_ids, scores):
 				if not synced_gpus:
@@ -312,6 +1076,13 @@ class CustomGenerationMixin(GenerationMixin):
 					cross_attentions=cross_attentions,
 					decoder_hidden_states=decoder_hidden_states,
 				)
+			elif not do_sample:
+				return GreedySearchDecoderOnlyOutput(
+					sequences=input_ids,
+					scores=scores,
+					attentions=decoder_attentions,
+					hidden_states=decoder_hidden_states,
+				)
 			else:
 				return SampleDecoderOnlyOutput(
 					sequences=input_ids,
@@ -322,6 +1093,210 @@ class CustomGenerationMixin(GenerationMixin):
 		else:
 			return input_ids
 
+	def speculative_sample(
+		self,
+		input_ids: torch.LongTensor,
+		draft_model: Optional["CustomGenerationMixin"] = None,
+		num_draft_tokens: int = 4,
+		prompt_lookup_ngram_size: Optional[int] = None,
+		logits_processor: Optional[LogitsProcessorList] = None,
+		stopping_criteria: Optional[StoppingCriteriaList] = None,
+		logits_warper: Optional[LogitsProcessorList] = None,
+		pad_token_id: Optional[int] = None,
+		eos_token_id: Optional[int] = None,
+		do_sample: bool = True,
+		speculative_stats: Optional[SpeculativeDecodingStats] = None,
+		unfinished_sequences: Optional[torch.LongTensor] = None,
+		output_attentions: Optional[bool] = None,
+		output_hidden_states: Optional[bool] = None,
+		output_scores: Optional[bool] = None,
+		return_dict_in_generate: Optional[bool] = None,
+		**model_kwargs,
+	) -> Union[SampleOutput, GreedySearchOutput, torch.LongTensor]:
+		r"""
+		Speculative decoding: up to `num_draft_tokens` tokens are proposed, either by `draft_model` or by copying what
+		followed the last occurrence of the current n-gram in the sequence (prompt lookup), and this model scores all
+		of them in a single forward pass. Every row accepts a proposed token with probability `min(1, p / q)` (`p` and
+		`q` being the processed and warped distributions of this model and of the proposer, `q = 1` for prompt lookup),
+		and the first rejected one is resampled from `max(p - q, 0)`, so the sequences follow the distribution of this
+		model exactly. With `do_sample=False` a proposed token is accepted if it is the argmax of this model, which
+		gives the greedy output.
+
+		All rows advance by the same number of tokens, the fewest accepted by the unfinished rows plus one. Proposed
+		tokens are restricted to the code vocabulary like the tokens of this model.
+
+		Parameters:
+			input_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`):
+				The sequence used as a prompt for the generation.
+			draft_model ([`CustomGenerationMixin`], *optional*):
+				A smaller model with the same tokenizer (and replicated vocabulary) that proposes the tokens.
+			num_draft_tokens (`int`, *optional*, defaults to 4):
+				Maximum number of tokens proposed per forward pass of this model.
+			prompt_lookup_ngram_size (`int`, *optional*):
+				Without `draft_model`, the longest n-gram looked up in the sequence (shorter ones are tried too).
+			speculative_stats ([`SpeculativeDecodingStats`], *optional*):
+				Accumulates the acceptance counts.
+			unfinished_sequences (`torch.LongTensor` of shape `(batch_size,)`, *optional*):
+				0 for the rows that are already finished, as in `sample`.
+			output_scores (`bool`, *optional*, defaults to `False`):
+				Whether or not to return the processed scores of this model for every generated token, as in `sample`.
+			return_dict_in_generate (`bool`, *optional*, defaults to `False`):
+				Whether or not to return a [`~utils.ModelOutput`] instead of a plain tuple. Attentions and hidden
+				states cannot be returned, the forward passes cover several tokens.
+
+		Return:
+			[`~generation_utils.GreedySearchDecoderOnlyOutput`] (with `do_sample=False`),
+			[`~generation_utils.SampleDecoderOnlyOutput`] or `torch.LongTensor`: the prompt followed by the generated
+			tokens, with their scores if `return_dict_in_generate=True`.
+		"""
+		logits_processor = logits_processor if logits_processor is not None else LogitsProcessorList()
+		stopping_criteria = stopping_criteria if stopping_criteria is not None else StoppingCriteriaList()
+		logits_warper = logits_warper if logits_warper is not None else LogitsProcessorList()
+		pad_token_id = pad_token_id if pad_token_id is not None else self.config.pad_token_id
+		eos_token_id = eos_token_id if eos_token_id is not None else self.config.eos_token_id
+		max_length = stopping_criteria.max_length if stopping_criteria.max_length is not None else self.config.max_length
+		output_scores = output_scores if output_scores is not None else self.config.output_scores
+		output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
+		output_hidden_states = (
+			output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
+		)
+		return_dict_in_generate = (
+			return_dict_in_generate if return_dict_in_generate is not None else self.config.return_dict_in_generate
+		)
+		if return_dict_in_generate and (output_attentions or output_hidden_states):
+			raise ValueError("Speculative decoding cannot return attentions or hidden states, only scores")
+		scores = () if (return_dict_in_generate and output_scores) else None
+
+		attention_mask = model_kwargs.get("attention_mask")
+		if attention_mask is None:
+			attention_mask = input_ids.new_ones(input_ids.shape)
+		prefix_lm_mask = model_kwargs.get("prefix_lm_mask")
+		past = model_kwargs.get("past")
+
+		def process(input_ids, logits):
+			scores = logits_processor(input_ids, logits)
+			return logits_warper(input_ids, scores) if do_sample else scores
+
+		if getattr(self, "compact_index", None) is not None:
+			raise ValueError("Speculative decoding needs the logits of the full vocabulary, not a compacted one")
+		if draft_model is not None:
+			if draft_model.config.vocab_size != self.config.vocab_size:
+				raise ValueError(
+					f"The draft model has a vocabulary of {draft_model.config.vocab_size} tokens, but this model has "
+					f"{self.config.vocab_size}"
+				)
+			proposer = DraftModelProposer(
+				draft_model,
+				process=lambda input_ids, logits: process(input_ids, self._mask_non_code_tokens(logits)),
+				do_sample=do_sample,
+				prefix_lm_mask=prefix_lm_mask,
+			)
+		elif prompt_lookup_ngram_size is not None:
+			proposer = PromptLookupProposer(max_ngram_size=prompt_lookup_ngram_size)
+		else:
+			raise ValueError("Speculative decoding needs either a `draft_model` or a `prompt_lookup_ngram_size`")
+
+		if unfinished_sequences is None:
+			unfinished_sequences = input_ids.new(input_ids.shape[0]).fill_(1)
+		row_stopping_criteria = [criteria for criteria in stopping_criteria if hasattr(criteria, "finished_rows")]
+		if speculative_stats is not None:
+			speculative_stats.row_proposed = [0] * input_ids.shape[0]
+			speculative_stats.row_accepted = [0] * input_ids.shape[0]
+
+		finished = False
+		while not finished:
+			cur_len = input_ids.shape[-1]
+
+			# 1. propose up to `num_draft_tokens` tokens, `valid` tells which ones every row actually has
+			proposed, valid, draft_probs = proposer.propose(
+				input_ids, attention_mask, max(min(num_draft_tokens, max_length - cur_len - 1), 0)
+			)
+			num_draft = proposed.shape[-1]
+			draft_ids = torch.cat([input_ids, proposed], dim=-1)
+			draft_mask = torch.cat([attention_mask, attention_mask.new_ones(proposed.shape)], dim=-1)
+
+			# 2. this model scores all of them at once
+			logits, past = forward_new_positions(
+				self, draft_ids, past, draft_mask, prefix_lm_mask=prefix_lm_mask, num_logits_to_keep=num_draft + 1
+			)
+			target_scores = torch.stack(
+				[process(draft_ids[:, :cur_len + i], logits[:, i, :]) for i in range(num_draft + 1)], dim=1
+			)
+
+			# 3. accept a prefix of the proposal, and correct the first token that was not accepted
+			if do_sample:
+				target_probs = nn.functional.softmax(target_scores, dim=-1)
+				p = target_probs[:, :num_draft].gather(-1, proposed[..., None]).squeeze(-1)
+				q = draft_probs.gather(-1, proposed[..., None]).squeeze(-1) if draft_probs is not None else torch.ones_like(p)
+				accepted = (torch.rand_like(p) * q < p) & valid
+				num_accepted = accepted.long().cumprod(dim=-1).sum(dim=-1)
+				# finished rows are fed pads, which must not hold back the others
+				num_emitted = int(num_accepted.masked_fill(unfinished_sequences == 0, num_draft).min())
+
+				probs = target_probs[:, num_emitted]
+				if num_emitted < num_draft:
+					if draft_probs is not None:
+						residual = (probs - draft_probs[:, num_emitted]).clamp(min=0)
+					else:
+						residual = probs.scatter(-1, proposed[:, num_emitted, None], 0.0)
+					# rows without a proposal there sample from `p`, and `p == q` leaves nothing to resample from
+					use_probs = ~valid[:, num_emitted, None] | (residual.sum(dim=-1, keepdim=True) == 0)
+					correction = torch.multinomial(torch.where(use_probs, probs, residual), num_samples=1).squeeze(1)
+					correction = torch.where(num_accepted > num_emitted, proposed[:, num_emitted], correction)
+				else:
+					correction = torch.multinomial(probs, num_samples=1).squeeze(1)
+			else:
+				target_tokens = torch.argmax(target_scores, dim=-1)
+				accepted = (proposed == target_tokens[:, :num_draft]) & valid
+				num_accepted = accepted.long().cumprod(dim=-1).sum(dim=-1)
+				# finished rows are fed pads, which must not hold back the others
+				num_emitted = int(num_accepted.masked_fill(unfinished_sequences == 0, num_draft).min())
+				correction = target_tokens[:, num_emitted]
+
+			new_tokens = torch.cat([proposed[:, :num_emitted], correction[:, None]], dim=-1)
+			if speculative_stats is not None:
+				unfinished = unfinished_sequences.bool()
+				row_proposed = (valid.sum(dim=-1) * unfinished).tolist()
+				row_accepted = (num_accepted * unfinished).tolist()
+				for i in range(len(row_proposed)):
+					speculative_stats.row_proposed[i] += row_proposed[i]
+					speculative_stats.row_accepted[i] += row_accepted[i]
+				speculative_stats.proposed_tokens += sum(row_proposed)
+				speculative_stats.accepted_tokens += sum(row_accepted)
+				speculative_stats.target_forwards += 1
+				speculative_stats.generated_tokens += num_emitted + 1
+
+			# 4. append the tokens one by one, so that rows finish exactly like in `sample`
+			for i in range(new_tokens.shape[-1]):
+				next_tokens = new_tokens[:, i]
+				if eos_token_id is not None or row_stopping_criteria:
+					if pad_token_id is None:
+						raise ValueError("If `eos_token_id` is defined, make sure that `pad_token_id` is defined.")
+					next_tokens = next_tokens * unfinished_sequences + pad_token_id * (1 - unfinished_sequences)
+
+				input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+				attention_mask = torch.cat([attention_mask, attention_mask.new_ones((attention_mask.shape[0], 1))], dim=-1)
+				if scores is not None:
+					scores += (target_scores[:, i],)
+
+				if eos_token_id is not None:
+					unfinished_sequences = unfinished_sequences.mul((next_tokens != eos_token_id).long())
+				for criteria in row_stopping_criteria:
+					unfinished_sequences = unfinished_sequences.mul((~criteria.finished_rows(input_ids)).long())
+
+				if unfinished_sequences.max() == 0 or stopping_criteria(input_ids, None):
+					finished = True
+					break
+
+			# 5. caches keep everything but the last token, which is fed next
+			past = crop_past_key_values(past, input_ids.shape[-1] - 1)
+			proposer.crop(input_ids.shape[-1] - 1)
+
+		if return_dict_in_generate:
+			output_class = SampleDecoderOnlyOutput if do_sample else GreedySearchDecoderOnlyOutput
+			return output_class(sequences=input_ids, scores=scores)
+		return input_ids
+
 	@torch.no_grad()
 	def generate(
 		self,
@@ -366,6 +1341,11 @@ class CustomGenerationMixin(GenerationMixin):
 		synced_gpus: Optional[bool] = False,
 		exponential_decay_length_penalty: Optional[Tuple[Union[int, float]]] = None,
 		sample_replacement: bool = False,
+		static_cache: bool = False,
+		draft_model: Optional["CustomGenerationMixin"] = None,
+		num_draft_tokens: int = 4,
+		prompt_lookup_ngram_size: Optional[int] = None,
+		speculative_stats: Optional[SpeculativeDecodingStats] = None,
 		**model_kwargs,
 	) -> Union[GreedySearchOutput, SampleOutput, BeamSearchOutput, BeamSampleOutput, torch.LongTensor]:
 		r"""
@@ -512,6 +1492,19 @@ class CustomGenerationMixin(GenerationMixin):
 				This Tuple adds an exponentially increasing length penalty, after a certain amount of tokens have been
 				generated. The tuple shall consist of: `(start_index, decay_factor)` where `start_index` indicates
 				where penalty starts and `decay_factor` represents the factor of exponential decay
+			sample_replacement (`bool`, *optional*, defaults to `False`):
+				Whether `torch.multinomial` samples with replacement.
+			static_cache (`bool`, *optional*, defaults to `False`):
+				Whether to decode into a `StaticKVCache` of `max_length` positions instead of growing the cache at
+				every step (local attention layers only keep their window). Only used by greedy search and sampling,
+				and only when no `past` is given.
+			draft_model ([`CustomGenerationMixin`], *optional*):
+				A smaller model with the same tokenizer, if given greedy search and sampling go through
+				[`CustomGenerationMixin.speculative_sample`] which checks `num_draft_tokens` tokens proposed by the draft
+				model per forward pass. Acceptance counts are added to `speculative_stats` if given.
+			prompt_lookup_ngram_size (`int`, *optional*):
+				Speculative decoding without a draft model, the tokens are proposed by looking up the last n-gram (of
+				at most this size) in the sequence so far.
 			model_kwargs:
 				Additional model specific kwargs will be forwarded to the `forward` function of the model. If the model
 				is an encoder-decoder model, encoder specific kwargs should not be prefixed and decoder specific kwargs
@@ -729,18 +1722,45 @@ class CustomGenerationMixin(GenerationMixin):
 					f"num_return_sequences has to be 1, but is {num_return_sequences} when doing greedy search."
 				)
 
+			if draft_model is not None or prompt_lookup_ngram_size is not None:
+				return self.speculative_sample(
+					input_ids,
+					draft_model=draft_model,
+					num_draft_tokens=num_draft_tokens,
+					prompt_lookup_ngram_size=prompt_lookup_ngram_size,
+					logits_processor=logits_processor,
+					stopping_criteria=stopping_criteria,
+					pad_token_id=pad_token_id,
+					eos_token_id=eos_token_id,
+					do_sample=False,
+					speculative_stats=speculative_stats,
+					output_scores=output_scores,
+					return_dict_in_generate=return_dict_in_generate,
+					**model_kwargs,
+				)
+
+			if static_cache and model_kwargs.get("past") is None:
+				model_kwargs["past"] = self.init_static_cache(
+					input_ids.shape[0], max_length, model_kwargs.get("prefix_lm_mask")
+				)
+
 			# 10. run greedy search
-			return self.greedy_search(
+			# --- Hack Begin --- #
+			# greedy search goes through our `sample` too, so that per-row stopping criteria apply
+			return self.sample(
 				input_ids,
 				logits_processor=logits_processor,
+				logits_warper=LogitsProcessorList(),
 				stopping_criteria=stopping_criteria,
 				pad_token_id=pad_token_id,
 				eos_token_id=eos_token_id,
 				output_scores=output_scores,
 				return_dict_in_generate=return_dict_in_generate,
 				synced_gpus=synced_gpus,
+				do_sample=False,
 				**model_kwargs,
 			)
+			# ---- Hack End ---- #
 
 		elif is_sample_gen_mode:
 			# 10. prepare logits warper
@@ -761,6 +1781,28 @@ class CustomGenerationMixin(GenerationMixin):
 				**model_kwargs,
 			)
 
+			if draft_model is not None or prompt_lookup_ngram_size is not None:
+				return self.speculative_sample(
+					input_ids,
+					draft_model=draft_model,
+					num_draft_tokens=num_draft_tokens,
+					prompt_lookup_ngram_size=prompt_lookup_ngram_size,
+					logits_processor=logits_processor,
+					stopping_criteria=stopping_criteria,
+					logits_warper=logits_warper,
+					pad_token_id=pad_token_id,
+					eos_token_id=eos_token_id,
+					speculative_stats=speculative_stats,
+					output_scores=output_scores,
+					return_dict_in_generate=return_dict_in_generate,
+					**model_kwargs,
+				)
+
+			if static_cache and model_kwargs.get("past") is None:
+				model_kwargs["past"] = self.init_static_cache(
+					input_ids.shape[0], max_length, model_kwargs.get("prefix_lm_mask")
+				)
+
 			# 12. run sample
 			return self.sample(
 				input_ids,
@@ -59,6 +59,10 @@ from transformers.utils import (
 )
 from transformers.utils.model_parallel_utils import assert_device_map, get_device_map
 from .generation_utils import CustomGenerationMixin
+from source.vocab_partition import build_token_masks
+from source.attention_masks import (
+    packed_attention_mask, build_prefix_key_mask, shared_causal_mask, sdpa_attention
+)
 
 logger = logging.get_logger(__name__)
 
@@ -87,7 +91,9 @@ class PanguAlphaHead(nn.Module):
         head_mask=None,
         use_cache=False,
         output_attentions=False,
-        prefix_lm_mask=None
+        prefix_lm_mask=None,
+        segment_ids=None,
+        causal_mask=None
     ):
         residual = hidden_states
         hidden_states = self.ln_1(hidden_states)
@@ -99,7 +105,9 @@ class PanguAlphaHead(nn.Module):
             head_mask=head_mask,
             use_cache=use_cache,
             output_attentions=output_attentions,
-            prefix_lm_mask=prefix_lm_mask
+            prefix_lm_mask=prefix_lm_mask,
+            segment_ids=segment_ids,
+            causal_mask=causal_mask
         )
         attn_output = attn_outputs[0]  # output_attn: a, present, (attentions)
         outputs = attn_outputs[1:]
@@ -125,13 +133,7 @@ class PanguAlphaAttention(nn.Module):
         super().__init__()
 
         self.is_cross_attention = False
-        max_positions = config.max_position_embeddings
-        self.register_buffer(
-            "bias",
-            torch.tril(torch.ones((max_positions, max_positions), dtype=torch.uint8)).view(
-                1, 1, max_positions, max_positions
-            ),
-        )
+        # the causal mask is shared by all layers, see `shared_causal_mask`
         self.register_buffer("masked_bias", torch.tensor(-1e4))
 
         self.embed_dim = config.hidden_size
@@ -155,6 +157,8 @@ class PanguAlphaAttention(nn.Module):
 
         self.attn_dropout = nn.Dropout(config.attn_pdrop)
         self.resid_dropout = nn.Dropout(config.resid_pdrop)
+        # `eager` or `sdpa`, see `set_attention_backend`
+        self.attention_backend = getattr(config, "attention_backend", "eager")
 
         self.pruned_heads = set()
 
@@ -173,7 +177,34 @@ class PanguAlphaAttention(nn.Module):
         self.num_heads = self.num_heads - len(heads)
         self.pruned_heads = self.pruned_heads.union(heads)
 
-    def _attn(self, query, key, value, attention_mask=None, head_mask=None, prefix_lm_mask=None):
+    def _causal_mask(self, query_length, key_length, attention_mask=None, prefix_lm_mask=None, segment_ids=None):
+        """
+        Boolean mask of the keys every query attends to: causal, per packed document and bidirectional over the
+        prefix, of shape `(batch_size or 1, 1, query_length, key_length)`. `prefix_lm_mask` is a 3D prefix mask in
+        training, the prefix index or the mask of the prefix keys at generation (see `build_prefix_key_mask`).
+        """
+        if segment_ids is not None:  # packed documents, the mask covers their prefixes too
+            return packed_attention_mask(segment_ids, prefix_lm_mask, query_length)
+
+        if attention_mask is not None and len(attention_mask.size()) == 3:  # this means causal mask is already given
+            causal_mask = attention_mask[:, None, :, :].bool()  # expand across attn_heads
+        else:
+            # Means attention given is 2-D, so assuming one example per instance
+            causal_mask = shared_causal_mask(query_length, key_length, device=self.masked_bias.device)
+
+        if prefix_lm_mask is not None:
+            if isinstance(prefix_lm_mask, torch.Tensor) and len(prefix_lm_mask.size()) == 3:  # prefix mask is given
+                prefix_lm_mask = prefix_lm_mask[:, None, :, :].bool()
+            elif len(prefix_lm_mask.size()) == 1:  # otherwise index up-to-which we consider as prefix is given
+                prefix_lm_mask = build_prefix_key_mask(prefix_lm_mask, key_length)[:, None, None, :]
+            else:  # keys in the prefix, broadcast across heads and queries
+                prefix_lm_mask = prefix_lm_mask[:, None, None, :]
+
+            causal_mask = torch.where(prefix_lm_mask, True, causal_mask)  # expand mask so that it covers all the prefix
+        return causal_mask
+
+    def _attn(self, query, key, value, attention_mask=None, head_mask=None, prefix_lm_mask=None, segment_ids=None,
+              causal_mask=None):
         attn_weights = torch.matmul(query, key.transpose(-1, -2))
 
         if self.scale_attn_weights:
@@ -184,30 +215,19 @@ class PanguAlphaAttention(nn.Module):
             attn_weights = attn_weights / float(self.layer_idx + 1)
 
         if not self.is_cross_attention:
-            if len(attention_mask.size()) == 3:  # this means causal mask is already given
-                causal_mask = attention_mask[:, None, :, :].bool()  # expand across attn_heads
-            else:
-                # Means attention given is 2-D, so assuming one example per instance
-                query_length, key_length = query.size(-2), key.size(-2)
-                causal_mask = self.bias[:, :, key_length - query_length: key_length, :key_length].bool()
-
-            if prefix_lm_mask is not None:
-                if isinstance(prefix_lm_mask, torch.Tensor) and len(prefix_lm_mask.size()) == 3:   # prefix mask is given
-                    prefix_lm_mask = prefix_lm_mask[:, None, :, :].bool()
-                else:   # otherwise index up-to-which we consider as prefix is given
-                    cond1 = prefix_lm_mask[:, None, None, None]  # broadcast prefix indexes
-                    cond2 = torch.arange(causal_mask.size(-1)).to(causal_mask.device)[None, None, None, :]  # broadcast all indexes
-                    prefix_lm_mask = torch.le(cond2, cond1)
-
-                prefix_lm_mask = torch.where(prefix_lm_mask, True, causal_mask)  # expand mask so that it covers all the prefix
-                attn_weights = torch.where(prefix_lm_mask, attn_weights, self.masked_bias.to(attn_weights.dtype))
-            else:
-                attn_weights = torch.where(causal_mask, attn_weights, self.masked_bias.to(attn_weights.dtype))
+            if causal_mask is None:  # not shared by the model
+                causal_mask = self._causal_mask(
+                    query.size(-2), key.size(-2), attention_mask, prefix_lm_mask, segment_ids
+                )
+            attn_weights = torch.where(causal_mask, attn_weights, self.masked_bias.to(attn_weights.dtype))
 
         if attention_mask is not None and len(attention_mask.size()) == 4:  # we have expanded it before
             # Apply the attention mask
             attn_weights = attn_weights + attention_mask
 
+        if attn_weights.dtype == torch.bfloat16:
+            # softmax in fp32, bf16 keeps too few bits of the scores
+            attn_weights = attn_weights.to(torch.float32)
         attn_weights = nn.functional.softmax(attn_weights, dim=-1)
         attn_weights = torch.where(torch.isnan(attn_weights),
                                    torch.zeros(1).to(attn_weights.device).to(attn_weights.dtype)[0],
@@ -225,7 +245,10 @@ class PanguAlphaAttention(nn.Module):
 
         return attn_output, attn_weights
 
-    def _upcast_and_reordered_attn(self, query, key, value, attention_mask=None, head_mask=None, prefix_lm_mask=None):
+    def _upcast_and_reordered_attn(
+        self, query, key, value, attention_mask=None, head_mask=None, prefix_lm_mask=None, segment_ids=None,
+        causal_mask=None
+    ):
         # Use `torch.baddbmm` (a bit more efficient w/ alpha param for scaling -- from Megatron-LM)
         bsz, num_heads, q_seq_len, dk = query.size()
         _, _, k_seq_len, _ = key.size()
@@ -253,27 +276,11 @@ class PanguAlphaAttention(nn.Module):
             attn_weights = attn_weights.reshape(bsz, num_heads, q_seq_len, k_seq_len)
 
         if not self.is_cross_attention:
-            if len(attention_mask.size()) == 3:  # this means causal mask is already given
-                causal_mask = attention_mask[:, None, :, :].bool()  # expand across attn_heads
-            else:
-                # Means attention given is 2-D, so assuming one example per instance
-                query_length, key_length = query.size(-2), key.size(-2)
-                causal_mask = self.bias[:, :, key_length - query_length: key_length, :key_length].bool()
-
-            if prefix_lm_mask is not None:
-                if isinstance(prefix_lm_mask, torch.Tensor) and len(prefix_lm_mask.size()) == 3:  # prefix mask is given
-                    prefix_lm_mask = prefix_lm_mask[:, None, :, :].bool()
-                else:  # otherwise index up-to-which we consider as prefix is given
-                    cond1 = prefix_lm_mask[:, None, None, None]  # broadcast prefix indexes
-                    cond2 = torch.arange(causal_mask.size(-1)).to(causal_mask.device)[None, None, None,
-                            :]  # broadcast all indexes
-                    prefix_lm_mask = torch.le(cond2, cond1)
-
-                prefix_lm_mask = torch.where(prefix_lm_mask, True,
-                                             causal_mask)  # expand mask so that it covers all the prefix
-                attn_weights = torch.where(prefix_lm_mask, attn_weights, self.masked_bias.to(attn_weights.dtype))
-            else:
-                attn_weights = torch.where(causal_mask, attn_weights, self.masked_bias.to(attn_weights.dtype))
+            if causal_mask is None:  # not shared by the model
+                causal_mask = self._causal_mask(
+                    query.size(-2), key.size(-2), attention_mask, prefix_lm_mask, segment_ids
+                )
+            attn_weights = torch.where(causal_mask, attn_weights, self.masked_bias.to(attn_weights.dtype))
 
         if attention_mask is not None and len(attention_mask.size()) == 4:  # we have expanded it before
             # Apply the attention mask
@@ -298,6 +305,34 @@ class PanguAlphaAttention(nn.Module):
 
         return attn_output, attn_weights
 
+    def _sdpa_attn(self, query, key, value, attention_mask=None, prefix_lm_mask=None, segment_ids=None,
+                   causal_mask=None):
+        query_length, key_length = query.size(-2), key.size(-2)
+        padding_mask = attention_mask if attention_mask is not None and len(attention_mask.size()) == 4 else None
+        plain_causal = (segment_ids is None and prefix_lm_mask is None and
+                        (attention_mask is None or len(attention_mask.size()) != 3))
+        if self.is_cross_attention or (causal_mask is None and plain_causal and (
+                query_length == 1 or (query_length == key_length and padding_mask is None))):
+            # a single query sees everything, otherwise the kernel masks the future itself
+            causal_mask = None
+        elif causal_mask is None:  # not shared by the model
+            causal_mask = self._causal_mask(query_length, key_length, attention_mask, prefix_lm_mask, segment_ids)
+
+        scale = 1.0
+        if self.scale_attn_weights:
+            scale /= float(value.size(-1)) ** 0.5
+        if self.scale_attn_by_inverse_layer_idx:
+            scale /= float(self.layer_idx + 1)
+
+        return sdpa_attention(
+            query, key, value,
+            mask=causal_mask,
+            padding_mask=padding_mask,
+            scale=scale,
+            dropout_p=self.attn_dropout.p if self.training else 0.0,
+            is_causal=causal_mask is None and not self.is_cross_attention and query_length > 1,
+        )
+
     def _split_heads(self, tensor, num_heads, attn_head_size):
         """
         Splits hidden_size dim into attn_head_size and num_heads
@@ -323,7 +358,9 @@ class PanguAlphaAttention(nn.Module):
         head_mask: Optional[torch.FloatTensor] = None,
         use_cache: Optional[bool] = False,
         output_attentions: Optional[bool] = False,
-        prefix_lm_mask: Optional[torch.Tensor] = None
+        prefix_lm_mask: Optional[torch.Tensor] = None,
+        segment_ids: Optional[torch.LongTensor] = None,
+        causal_mask: Optional[torch.BoolTensor] = None
     ) -> Tuple[Union[torch.Tensor, Tuple[torch.Tensor]], ...]:
 
         query = self.q_attn(query_hidden_states)
@@ -333,20 +370,32 @@ class PanguAlphaAttention(nn.Module):
         key = self._split_heads(key, self.num_heads, self.head_dim)
         value = self._split_heads(value, self.num_heads, self.head_dim)
 
-        if layer_past is not None:
+        if layer_past is not None and hasattr(layer_past, "update"):
+            # preallocated cache, written in place
+            key, value = layer_past.update(key, value)
+        elif layer_past is not None:
             past_key, past_value = layer_past
             key = torch.cat((past_key, key), dim=-2)
             value = torch.cat((past_value, value), dim=-2)
 
         if use_cache is True:
-            present = (key, value)
+            present = layer_past if hasattr(layer_past, "update") else (key, value)
         else:
             present = None
 
-        if self.reorder_and_upcast_attn:
-            attn_output, attn_weights = self._upcast_and_reordered_attn(query, key, value, attention_mask, head_mask, prefix_lm_mask)
+        if self.attention_backend == "sdpa" and not output_attentions and head_mask is None:
+            attn_output = self._sdpa_attn(
+                query, key, value, attention_mask, prefix_lm_mask, segment_ids, causal_mask
+            )
+            attn_weights = None
+        elif self.reorder_and_upcast_attn:
+            attn_output, attn_weights = self._upcast_and_reordered_attn(
+                query, key, value, attention_mask, head_mask, prefix_lm_mask, segment_ids, causal_mask
+            )
         else:
-            attn_output, attn_weights = self._attn(query, key, value, attention_mask, head_mask, prefix_lm_mask)
+            attn_output, attn_weights = self._attn(
+                query, key, value, attention_mask, head_mask, prefix_lm_mask, segment_ids, causal_mask
+            )
 
         attn_output = self._merge_heads(attn_output, self.num_heads, self.head_dim)
         attn_output = self.c_proj(attn_output)
@@ -381,19 +430,7 @@ class PanguAlphaModel(GPT2PreTrainedModel, CustomGenerationMixin):
         self.tokenizer = tokenizer
         self.config = config
 
-        code_tokens_mask = torch.zeros((len(tokenizer),))
-        doc_tokens_mask = torch.zeros((len(tokenizer),))
-
-        if self.args.replicated_tokens_map:
-            for tok_id in range(0, len(tokenizer)):
-                if tok_id in self.args.replicated_tokens_map:
-                    code_tokens_mask[self.args.replicated_tokens_map[tok_id]] = 1
-                    doc_tokens_mask[tok_id] = 1
-                # if not replicated and also not new_id
-                elif (tok_id not in self.args.replicated_tokens_map.keys()) and \
-                        (tok_id not in self.args.replicated_tokens_map.values()):
-                    code_tokens_mask[tok_id] = 1
-                    doc_tokens_mask[tok_id] = 1
+        code_tokens_mask, doc_tokens_mask = build_token_masks(self.args, len(tokenizer))
 
         self.register_buffer('code_tokens_mask', code_tokens_mask)
         self.register_buffer('doc_tokens_mask', doc_tokens_mask)
@@ -428,8 +465,9 @@ class PanguAlphaModel(GPT2PreTrainedModel, CustomGenerationMixin):
 
     def prepare_inputs_for_generation(self, input_ids, past=None, **kwargs):
         token_type_ids = kwargs.get("token_type_ids", None)
-        # only last token for inputs_ids if past is defined in kwargs
-        if past:
+        # only last token for inputs_ids if past is defined in kwargs (and not an empty static cache)
+        past_length = past[0][0].size(-2) if past is not None else 0
+        if past_length > 0:
             input_ids = input_ids[:, -1].unsqueeze(-1)
             if token_type_ids is not None:
                 token_type_ids = token_type_ids[:, -1].unsqueeze(-1)
@@ -443,7 +481,7 @@ class PanguAlphaModel(GPT2PreTrainedModel, CustomGenerationMixin):
             # create position_ids on the fly for batch generation
             position_ids = attention_mask.long().cumsum(-1) - 1
             position_ids.masked_fill_(attention_mask == 0, 1)
-            if past:
+            if past_length > 0:
                 position_ids = position_ids[:, -1].unsqueeze(-1)
         else:
             position_ids = None
@@ -454,7 +492,9 @@ class PanguAlphaModel(GPT2PreTrainedModel, CustomGenerationMixin):
             "position_ids": position_ids,
             "attention_mask": attention_mask,
             "token_type_ids": token_type_ids,
-            "prefix_lm_mask": prefix_lm_mask
+            "prefix_lm_mask": prefix_lm_mask,
+            "prefix_key_mask": kwargs.get("prefix_key_mask"),
+            "num_logits_to_keep": kwargs.get("num_logits_to_keep", 1)
         }
 
     def forward(
@@ -474,13 +514,26 @@ class PanguAlphaModel(GPT2PreTrainedModel, CustomGenerationMixin):
         output_hidden_states=None,
         return_dict=None,
         docstr_mask=None,  # extra
-        prefix_lm_mask=None  # extra
+        prefix_lm_mask=None,  # extra
+        num_logits_to_keep=None,
+        segment_ids=None,
+        prefix_key_mask=None
     ):
         r"""
         labels (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
             Labels for language modeling. Note that the labels **are shifted** inside the model, i.e. you can set
             `labels = input_ids` Indices are selected in `[-100, 0, ..., config.vocab_size]` All labels set to
             `-100` are ignored (masked), the loss is only computed for labels in `[0, ..., config.vocab_size]`
+        num_logits_to_keep (`int`, *optional*):
+            Without `labels`, only project the last `num_logits_to_keep` positions on the vocabulary (generation only
+            needs the last one). All positions by default.
+        segment_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
+            Document index of every position of packed sequences (-1 for padding), in place of a dense 3D
+            `attention_mask`. `prefix_lm_mask` is then the `(batch_size, sequence_length)` prefix flags of the
+            positions, see `packed_attention_mask`.
+        prefix_key_mask (`torch.BoolTensor` of shape `(batch_size, past_length)`, *optional*):
+            At generation with a prefix index in `prefix_lm_mask`, the mask of the prefix keys of the previous step,
+            which is extended instead of being built again (see `build_prefix_key_mask`).
         """
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -499,6 +552,18 @@ class PanguAlphaModel(GPT2PreTrainedModel, CustomGenerationMixin):
         else:
             past_key_values_tr = None
 
+        # Causal, packed and prefix-LM masks are the same for the transformer and the query layer, build them once
+        causal_mask = None
+        if prefix_lm_mask is not None or segment_ids is not None or (
+                attention_mask is not None and len(attention_mask.size()) == 3):
+            key_length = (past_key_values[0][0].size(-2) if past_key_values is not None else 0) + seq_len
+            if segment_ids is None and prefix_lm_mask is not None and len(prefix_lm_mask.size()) == 1:
+                # at generation, extends the mask of the previous step if there is one
+                prefix_lm_mask = build_prefix_key_mask(prefix_lm_mask, key_length, prefix_key_mask)
+            causal_mask = self.top_query_layer.attn._causal_mask(
+                seq_len, key_length, attention_mask, prefix_lm_mask, segment_ids
+            )
+
         transformer_outputs = self.transformer(
             input_ids,
             past_key_values=past_key_values_tr,
@@ -513,7 +578,9 @@ class PanguAlphaModel(GPT2PreTrainedModel, CustomGenerationMixin):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
-            prefix_lm_mask=prefix_lm_mask
+            prefix_lm_mask=prefix_lm_mask,
+            segment_ids=segment_ids,
+            causal_mask=causal_mask
         )
         hidden_states = transformer_outputs.last_hidden_state
 
@@ -571,7 +638,9 @@ class PanguAlphaModel(GPT2PreTrainedModel, CustomGenerationMixin):
             head_mask=head_mask,
             use_cache=use_cache,
             output_attentions=output_attentions,
-            prefix_lm_mask=prefix_lm_mask
+            prefix_lm_mask=prefix_lm_mask,
+            segment_ids=segment_ids,
+            causal_mask=causal_mask
         )
         # Set device for model parallelism
         if self.model_parallel:
@@ -579,18 +648,28 @@ class PanguAlphaModel(GPT2PreTrainedModel, CustomGenerationMixin):
             hidden_states = hidden_states.to(self.top_query_embedding.weight.device)
 
         # Get logits (tied weights with embedding layer)
-        lm_logits = F.linear(hidden_states[0], self.transformer.wte.weight)  # (1, vocab_size, dim)
+        last_hidden_states = hidden_states[0]
+        if labels is None and num_logits_to_keep:
+            last_hidden_states = last_hidden_states[:, -num_logits_to_keep:, :]
+        compact_vocabulary = labels is None and getattr(self, "compact_lm_head_weight", None) is not None
+        if compact_vocabulary:
+            # logits of the code tokens only, see `compact_vocabulary`
+            lm_logits = F.linear(last_hidden_states, self.compact_lm_head_weight)
+        else:
+            lm_logits = F.linear(last_hidden_states, self.transformer.wte.weight)  # (1, vocab_size, dim)
 
         loss = None
         if labels is not None:
+            # bf16 logits are upcast for the loss, like in the bf16 attention softmax
+            loss_logits = lm_logits.to(torch.float32) if lm_logits.dtype == torch.bfloat16 else lm_logits
             if self.args.replicated_tokens_map:
 
                 labels = labels.contiguous()
                 docstr_mask = docstr_mask.bool().contiguous()
 
                 # get logits and put non-valid tokens to -infinity so that softmax gives 0! :)
-                lm_logits_docstr = lm_logits.masked_fill(~self.doc_tokens_mask[None, None, :].bool(), float('-inf'))
-                lm_logits_code = lm_logits.masked_fill(~self.code_tokens_mask[None, None, :].bool(), float('-inf'))
+                lm_logits_docstr = loss_logits.masked_fill(~self.doc_tokens_mask[None, None, :].bool(), float('-inf'))
+                lm_logits_code = loss_logits.masked_fill(~self.code_tokens_mask[None, None, :].bool(), float('-inf'))
 
                 # get labels for each sequence
                 labels_docstr = torch.where(docstr_mask, labels, -100)
@@ -626,7 +705,7 @@ class PanguAlphaModel(GPT2PreTrainedModel, CustomGenerationMixin):
                 loss = loss.sum().div(nonzero_elements)
 
             else:
-                shift_lm_logits = lm_logits[..., :-1, :].contiguous()
+                shift_lm_logits = loss_logits[..., :-1, :].contiguous()
                 shift_labels = labels[..., 1:].contiguous()
 
                 # Flatten the tokens
@@ -636,7 +715,7 @@ class PanguAlphaModel(GPT2PreTrainedModel, CustomGenerationMixin):
         # empty labels -> we need this for generation
         else:
 
-            if self.args.replicated_tokens_map:
+            if self.args.replicated_tokens_map and not compact_vocabulary:
                 lm_logits.masked_fill_(~self.code_tokens_mask[None, None, :].bool(), float('-inf'))
 
         if not return_dict:
@@ -666,6 +745,7 @@ class PanguAlphaModel(GPT2PreTrainedModel, CustomGenerationMixin):
         called. This is required to match `past_key_values` with the correct beam_idx at every generation step.
         """
         return tuple(
+            layer_past.reorder(beam_idx) if hasattr(layer_past, "reorder") else
             tuple(past_state.index_select(0, beam_idx.to(past_state.device)) for past_state in layer_past)
             for layer_past in past
         )
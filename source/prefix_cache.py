@@ -0,0 +1,218 @@
+# Copyright (C) 2024. Huawei Technologies Co., Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+
+import logging
+from typing import Dict, List, Optional, Tuple
+from dataclasses import dataclass
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PrefixCacheStats:
+    lookups: int = 0
+    hits: int = 0
+    prompt_tokens: int = 0
+    tokens_saved: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self):
+        return self.hits / self.lookups if self.lookups > 0 else 0.0
+
+    def log(self, prefix=''):
+        logger.info(
+            f'{prefix}{self.hits}/{self.lookups} prompts hit the prefix cache ({100 * self.hit_rate:.1f}%), '
+            f'{self.tokens_saved}/{self.prompt_tokens} prompt tokens not recomputed, {self.evictions} evictions'
+        )
+
+
+class _RadixNode:
+    """
+    Edge of the radix tree: `tokens` and the key/value states they produced, a tuple of per-layer
+    `(key, value)` tensors of shape `(1, num_heads, len(tokens), head_dim)`
+    """
+    __slots__ = ('tokens', 'past', 'children', 'parent', 'last_access', 'num_bytes')
+
+    def __init__(self, tokens, past, parent):
+        self.tokens = tokens
+        self.past = past
+        self.children = {}
+        self.parent = parent
+        self.last_access = 0
+        self.num_bytes = sum(state.numel() * state.element_size() for layer in past for state in layer) if past else 0
+
+
+def _slice_past(past, start, end=None):
+    return tuple(tuple(state[:, :, start:end].clone() for state in layer) for layer in past)
+
+
+class RadixPrefixCache:
+    """
+    Cross-request cache of prompt key/value states, stored in a radix tree over token ids so that a new prompt reuses
+    the states of its longest cached prefix (e.g. the previous step of an incremental completion task).
+    Least recently used leaves are evicted once the states take more than `max_bytes`.
+
+    States depend on the prefix-LM boundary (the prefix attends bidirectionally), so every boundary index gets its own
+    tree, and a match is only usable if it covers the whole prefix.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.roots: Dict[Optional[int], _RadixNode] = {}
+        self.stats = PrefixCacheStats()
+        self._clock = 0
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    def _walk(self, token_ids, namespace):
+        """
+        Returns the matched length and the `(node, length)` edges on the path of the longest cached prefix
+        """
+        path: List[Tuple[_RadixNode, int]] = []
+        node = self.roots.get(namespace)
+        matched = 0
+        while node is not None and matched < len(token_ids):
+            child = node.children.get(token_ids[matched])
+            if child is None:
+                break
+            common = 0
+            for a, b in zip(child.tokens, token_ids[matched:]):
+                if a != b:
+                    break
+                common += 1
+            path.append((child, common))
+            matched += common
+            if common < len(child.tokens):
+                break
+            node = child
+        return matched, path
+
+    def match(self, token_ids, namespace=None):
+        """
+        Length of the longest cached prefix of `token_ids` that can be reused. At least the last token is left to
+        compute, since its logits are needed.
+        """
+        matched, path = self._walk(token_ids, namespace)
+        matched = min(matched, len(token_ids) - 1)
+        if namespace is not None and matched <= namespace:
+            matched = 0
+
+        clock = self._tick()
+        for node, _ in path:
+            node.last_access = clock
+        return matched
+
+    def get(self, token_ids, length, namespace=None):
+        """
+        Key/value states of the first `length` tokens of `token_ids`, which have to be cached
+        """
+        _, path = self._walk(token_ids[:length], namespace)
+        segments = []
+        remaining = length
+        for node, common in path:
+            take = min(common, remaining)
+            segments.append(node.past if take == len(node.tokens) else
+                            tuple(tuple(state[:, :, :take] for state in layer) for layer in node.past))
+            remaining -= take
+        if remaining > 0:
+            raise ValueError(f"Only {length - remaining} of the requested {length} tokens are cached")
+
+        if len(segments) == 1:
+            return segments[0]
+        return tuple(
+            tuple(torch.cat([segment[i][j] for segment in segments], dim=-2) for j in range(len(segments[0][i])))
+            for i in range(len(segments[0]))
+        )
+
+    def record(self, prompt_length, reused_length):
+        self.stats.lookups += 1
+        self.stats.prompt_tokens += prompt_length
+        if reused_length > 0:
+            self.stats.hits += 1
+            self.stats.tokens_saved += reused_length
+
+    def insert(self, token_ids, past, namespace=None):
+        """
+        Caches the key/value states `past` (per-layer tuples of shape `(1, num_heads, len(token_ids), head_dim)`)
+        of `token_ids`. Only the part that is not cached yet is copied.
+        """
+        if namespace is not None and namespace >= len(token_ids) - 1:
+            # the prefix covers the whole prompt, nothing could ever be reused
+            return
+
+        token_ids = tuple(token_ids)
+        clock = self._tick()
+        if namespace not in self.roots:
+            self.roots[namespace] = _RadixNode((), None, None)
+        node = self.roots[namespace]
+
+        matched = 0
+        while matched < len(token_ids):
+            child = node.children.get(token_ids[matched])
+            if child is None:
+                leaf = _RadixNode(token_ids[matched:], _slice_past(past, matched), node)
+                leaf.last_access = clock
+                node.children[token_ids[matched]] = leaf
+                self.num_bytes += leaf.num_bytes
+                break
+
+            common = 0
+            for a, b in zip(child.tokens, token_ids[matched:]):
+                if a != b:
+                    break
+                common += 1
+
+            if common < len(child.tokens):
+                # split the edge, the first part becomes the parent of the remaining one
+                self.num_bytes -= child.num_bytes
+                head = _RadixNode(child.tokens[:common], _slice_past(child.past, 0, common), node)
+                child.tokens = child.tokens[common:]
+                child.past = _slice_past(child.past, common)
+                child.num_bytes = sum(state.numel() * state.element_size() for layer in child.past for state in layer)
+                child.parent = head
+                head.children[child.tokens[0]] = child
+                head.last_access = max(child.last_access, clock)
+                node.children[head.tokens[0]] = head
+                self.num_bytes += head.num_bytes + child.num_bytes
+                child = head
+
+            child.last_access = clock
+            matched += common
+            node = child
+
+        self._evict()
+
+    def _evict(self):
+        while self.num_bytes > self.max_bytes:
+            leaves = [node for node in self._nodes() if not node.children]
+            if not leaves:
+                break
+            lru = min(leaves, key=lambda node: node.last_access)
+            del lru.parent.children[lru.tokens[0]]
+            self.num_bytes -= lru.num_bytes
+            self.stats.evictions += 1
+
+    def _nodes(self):
+        stack = [child for root in self.roots.values() for child in root.children.values()]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node.children.values())
@@ -0,0 +1,251 @@
+# Copyright (C) 2024. Huawei Technologies Co., Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+
+import os
+import logging
+from typing import Optional
+import torch
+from torch import nn
+from transformers.modeling_utils import no_init_weights
+from transformers.pytorch_utils import Conv1D
+
+
+logger = logging.getLogger(__name__)
+
+QUANTIZATION_MODES = ('none', 'int8', 'int8_dynamic', 'int4')
+QUANTIZED_WEIGHTS_NAME = 'quantized_model.bin'
+
+# modules whose projections are quantized, the embeddings and the (tied) output layer are kept as they are
+QUANTIZED_PARENTS = ('GPTNeoSelfAttention', 'GPTNeoMLP', 'GPT2Attention', 'GPT2MLP', 'PanguAlphaAttention')
+
+# quantized engines whose dynamic int8 matmul (`int8_dynamic`) beats the floating point one on CPU (fbgemm or oneDNN
+# kernels), while qnnpack and the int8 x floating point kernel of torch (`_weight_int8pack_mm`) are slower than it
+DYNAMIC_INT8_ENGINES = ('fbgemm', 'x86', 'onednn')
+
+try:
+    _dynamic_int8_linear = torch.ops.quantized.linear_dynamic
+except (AttributeError, RuntimeError):
+    _dynamic_int8_linear = None
+
+
+class WeightOnlyQuantizedLinear(nn.Module):
+    """
+    Linear layer whose weight is stored as symmetric int8 or int4 (two per byte) values with a scale per output
+    feature, or per output feature and group of `group_size` input features. Activations, bias and outputs stay in
+    floating point, the weight is dequantized on the fly. `nn.Linear` and the transposed `Conv1D` of the GPT-2 layers
+    are both converted to this layer.
+    """
+
+    def __init__(self, in_features, out_features, bias=True, bits=8, group_size=None, dtype=torch.float32):
+        super().__init__()
+        group_size = group_size or in_features
+        if bits not in (4, 8):
+            raise ValueError(f"Only 8 and 4 bit weights are supported, not {bits}")
+        if in_features % group_size != 0 or (bits == 4 and group_size % 2 != 0):
+            raise ValueError(f"{in_features} input features cannot be split in groups of {group_size} "
+                             f"{bits} bit values")
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size
+
+        packed_features = in_features if bits == 8 else in_features // 2
+        self.register_buffer('qweight', torch.zeros(
+            (out_features, packed_features), dtype=torch.int8 if bits == 8 else torch.uint8
+        ))
+        self.register_buffer('scales', torch.ones((out_features, in_features // group_size), dtype=dtype))
+        self.bias = nn.Parameter(torch.zeros((out_features,), dtype=dtype)) if bias else None
+
+    @classmethod
+    def from_float(cls, module, bits=8, group_size=None):
+        """
+        Round-to-nearest quantization of an `nn.Linear` or `Conv1D`, scaled by the largest absolute weight of every
+        group: no calibration data is needed
+        """
+        weight = module.weight.detach()
+        if isinstance(module, Conv1D):
+            weight = weight.t()
+        out_features, in_features = weight.shape
+        quantized = cls(in_features, out_features, bias=module.bias is not None, bits=bits, group_size=group_size,
+                        dtype=weight.dtype).to(weight.device)
+
+        max_value = 2 ** (bits - 1) - 1
+        groups = weight.float().reshape(out_features, -1, quantized.group_size)
+        scales = groups.abs().amax(dim=-1).clamp(min=1e-8) / max_value
+        values = torch.round(groups / scales[..., None]).clamp(-max_value - 1, max_value).reshape(out_features, -1)
+        if bits == 8:
+            quantized.qweight.copy_(values.to(torch.int8))
+        else:
+            values = (values + 8).to(torch.uint8)
+            quantized.qweight.copy_(values[:, 0::2] | (values[:, 1::2] << 4))
+        quantized.scales.copy_(scales)
+        if module.bias is not None:
+            quantized.bias.data.copy_(module.bias.detach())
+        return quantized
+
+    def dequantize(self, dtype=None):
+        """
+        `(out_features, in_features)` floating point weight
+        """
+        if self.bits == 8:
+            values = self.qweight
+        else:
+            values = torch.stack([self.qweight & 0xF, self.qweight >> 4], dim=-1).reshape(self.out_features, -1)
+            values = values.to(torch.int8) - 8
+        dtype = dtype or self.scales.dtype
+        groups = values.to(dtype).reshape(self.out_features, -1, self.group_size)
+        return (groups * self.scales.to(dtype)[..., None]).reshape(self.out_features, self.in_features)
+
+    def forward(self, x):
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        return nn.functional.linear(x, self.dequantize(x.dtype), bias)
+
+    def extra_repr(self):
+        return (f'in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}, '
+                f'bits={self.bits}, group_size={self.group_size}')
+
+
+class DynamicInt8QuantizedLinear(WeightOnlyQuantizedLinear):
+    """
+    int8 `WeightOnlyQuantizedLinear` (same weights and state dict, a scale per output feature) whose fp32 inputs on
+    CPU go through the dynamic int8 matmul of the quantized engine (`DYNAMIC_INT8_ENGINES`): the activations are
+    rounded to 7 bits too, with a scale per token, so this is W8A8 rather than weight-only and less accurate than
+    the int8 mode. The weight is packed for the kernel on the first call (one more byte per weight), with the quantized
+    tensors that torch deprecates; other inputs, or a torch without them, dequantize the weight like the base class.
+    """
+
+    def __init__(self, in_features, out_features, bias=True, bits=8, group_size=None, dtype=torch.float32):
+        if bits != 8 or (group_size or in_features) != in_features:
+            raise ValueError("Dynamic int8 quantization needs 8 bit weights with a single scale per output feature")
+        super().__init__(in_features, out_features, bias=bias, bits=bits, group_size=group_size, dtype=dtype)
+        self._packed = None
+
+    def _packed_weight(self):
+        """
+        `qweight` and `scales` packed for the dynamic int8 matmul, again whenever one of them was modified (e.g. by
+        `load_state_dict`) or the quantized engine changed. None if torch can no longer build quantized tensors.
+        """
+        key = (torch.backends.quantized.engine,) + tuple(
+            (tensor.data_ptr(), tensor._version) for tensor in (self.qweight, self.scales)
+        )
+        if self._packed is None or self._packed[0] != key:
+            try:
+                # the dequantized weight is an exact multiple of the scales, it quantizes back to `qweight`
+                weight = torch.quantize_per_channel(
+                    self.dequantize(torch.float32), self.scales[:, 0].double(),
+                    torch.zeros(self.out_features, dtype=torch.long), 0, torch.qint8
+                )
+                packed = torch.ops.quantized.linear_prepack(weight, None)
+            except (AttributeError, RuntimeError):
+                logger.warning("torch cannot pack quantized weights, dynamic int8 layers dequantize their weight")
+                packed = None
+            self._packed = (key, packed)
+        return self._packed[1]
+
+    def forward(self, x):
+        if (_dynamic_int8_linear is None or x.device.type != 'cpu' or x.dtype != torch.float32 or
+                torch.backends.quantized.engine not in DYNAMIC_INT8_ENGINES or self._packed_weight() is None):
+            return super().forward(x)
+        # the kernel quantizes its whole input with one scale, tokens scaled to the same range get one each
+        tokens = x.reshape(-1, self.in_features)
+        token_scales = tokens.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8)
+        # reduce_range, like torch.ao.nn.quantized.dynamic.Linear: 7 bit activations cannot overflow the int16
+        # accumulations of the AVX2 kernels
+        output = _dynamic_int8_linear(tokens / token_scales, self._packed_weight(), True) * token_scales
+        if self.bias is not None:
+            output = output + self.bias
+        return output.reshape(*x.shape[:-1], self.out_features)
+
+
+def quantize_model(model: nn.Module, mode: str = 'int8', group_size: Optional[int] = None, empty: bool = False):
+    """
+    Replaces the attention and MLP projections of `model` by `WeightOnlyQuantizedLinear` layers, in place. int4
+    weights are grouped by 128 input features by default, int8 weights have a single scale per output feature.
+    `int8_dynamic` uses `DynamicInt8QuantizedLinear` layers, which also quantize the activations on CPU.
+    The settings are recorded in `config.weight_quantization`, so that `load_quantized_model` can restore them.
+    With `empty` the quantized layers are left uninitialised, to load a quantized state dict into.
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization {mode}, choose from {QUANTIZATION_MODES}")
+    if mode == 'none':
+        return model
+    bits = 4 if mode == 'int4' else 8
+    if group_size is None and bits == 4:
+        group_size = 128
+    layer_class = DynamicInt8QuantizedLinear if mode == 'int8_dynamic' else WeightOnlyQuantizedLinear
+
+    num_weights, num_bytes = 0, 0
+    for parent in list(model.modules()):
+        if type(parent).__name__ not in QUANTIZED_PARENTS:
+            continue
+        for name, child in list(parent.named_children()):
+            if not isinstance(child, (nn.Linear, Conv1D)):
+                continue
+            in_features, out_features = child.weight.shape if isinstance(child, Conv1D) else child.weight.shape[::-1]
+            layer_group_size = min(group_size or in_features, in_features)
+            if empty:
+                quantized = layer_class(
+                    in_features, out_features, bias=child.bias is not None, bits=bits, group_size=layer_group_size,
+                    dtype=child.weight.dtype
+                ).to(child.weight.device)
+            else:
+                quantized = layer_class.from_float(child, bits=bits, group_size=layer_group_size)
+            setattr(parent, name, quantized)
+            num_weights += 1
+            num_bytes += child.weight.numel() * child.weight.element_size() - quantized.qweight.numel()
+
+    model.config.weight_quantization = {'mode': mode, 'group_size': group_size}
+    if not empty:
+        logger.info(f'Quantized {num_weights} weights to {mode}, {num_bytes / 2 ** 20:.1f} MB saved')
+    return model
+
+
+def is_quantized_checkpoint(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, QUANTIZED_WEIGHTS_NAME))
+
+
+def save_quantized_model(model: nn.Module, save_directory: str):
+    """
+    Writes the configuration (with its `weight_quantization`) and the state dict of a `quantize_model` model
+    """
+    os.makedirs(save_directory, exist_ok=True)
+    model.config.save_pretrained(save_directory)
+    path = os.path.join(save_directory, QUANTIZED_WEIGHTS_NAME)
+    torch.save(model.state_dict(), path)
+    logger.info(f'Quantized model saved to {path}')
+    return path
+
+
+def load_quantized_model(model_class, path: str, torch_dtype=None, **model_kwargs):
+    """
+    Loads a `save_quantized_model` checkpoint: the model is built without initialising its weights, its projections
+    are swapped for empty quantized layers and the saved state dict is loaded into it. `model_kwargs` are passed to
+    the model constructor (`args` and `tokenizer` of the models of this repository).
+    """
+    config = model_class.config_class.from_pretrained(path)
+    weight_quantization = getattr(config, 'weight_quantization', None)
+    if not weight_quantization:
+        raise ValueError(f"{path} is not a quantized checkpoint, its configuration has no weight_quantization")
+
+    with no_init_weights():
+        model = model_class(config, **model_kwargs)
+    if isinstance(torch_dtype, torch.dtype):
+        model.to(torch_dtype)
+    quantize_model(model, weight_quantization['mode'], weight_quantization['group_size'], empty=True)
+
+    state_dict = torch.load(os.path.join(path, QUANTIZED_WEIGHTS_NAME), map_location='cpu')
+    model.load_state_dict(state_dict)
+    model.tie_weights()
+    return model.eval()
@@ -0,0 +1,169 @@
+# Copyright (C) 2024. Huawei Technologies Co., Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+
+import os
+import json
+import logging
+from utils import stream_jsonl
+
+logger = logging.getLogger(__name__)
+
+
+class ResumableOutput:
+    """
+    Generated samples streamed to `filename` in append mode, plus a manifest of the samples that are completely
+    written, so that a killed run can resume where it stopped. Every manifest line lists the (task_id, sample index)
+    pairs of one flush and the size of the output file after it. On resume the output is truncated to the last
+    recorded size, which drops a flush that was interrupted half way. `finalize` writes both files aside and replaces
+    the output before the manifest, so a resume after a crash in between moves the new manifest in place.
+
+    Samples are keyed by `(sample_no, dataset index, mlp sample)` like in the generation loops, and `finalize` puts
+    the output in that order once the run is complete. With `num_workers` > 1 this is the output of worker `rank`,
+    which only generates the samples it `owns`.
+    """
+    def __init__(self, filename, task_ids, mlp_samples, resume=False, rank=0, num_workers=1):
+        self.filename = filename
+        self.rank = rank
+        self.num_workers = num_workers
+        self.manifest_filename = filename.replace('.jsonl', '_manifest.jsonl')
+        self.tmp_filename = self.filename + '.tmp'
+        self.tmp_manifest_filename = self.manifest_filename + '.tmp'
+        self.task_ids = task_ids
+        self.task_index = {task_id: idx for idx, task_id in enumerate(task_ids)}
+        self.mlp_samples = mlp_samples
+        # keys in the order of the output lines
+        self.completed = []
+        self.pending = []
+
+        self._recover_finalize()
+        if resume and os.path.exists(self.filename) and os.path.exists(self.manifest_filename):
+            offset = 0
+            for entry in self._read_manifest():
+                self.completed.extend(self._from_manifest(task_id, sample) for task_id, sample in entry['completed'])
+                offset = entry['offset']
+            with open(self.filename, 'ab') as fp:
+                fp.truncate(offset)
+            logger.info(f'Resuming from {self.manifest_filename}: {len(self.completed)} samples already generated')
+        else:
+            if resume:
+                logger.info(f'Nothing to resume from in {self.manifest_filename}, starting over')
+            open(self.filename, 'wb').close()
+            open(self.manifest_filename, 'wb').close()
+        self.done = set(self.completed)
+
+    def _recover_finalize(self):
+        # a finalize killed after replacing the output: its manifest matches the sorted output, the old one does not
+        if os.path.exists(self.tmp_manifest_filename) and not os.path.exists(self.tmp_filename):
+            os.replace(self.tmp_manifest_filename, self.manifest_filename)
+        # killed before: the output and the manifest are still those of the last flush
+        for filename in (self.tmp_filename, self.tmp_manifest_filename):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def _read_manifest(self):
+        with open(self.manifest_filename, 'r') as fp:
+            for line in fp:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line of a killed run may be incomplete, its samples get generated again
+                    break
+
+    def _to_manifest(self, key):
+        sample_no, idx, j = key
+        return [self.task_ids[idx], sample_no * self.mlp_samples + j]
+
+    def _from_manifest(self, task_id, sample):
+        if task_id not in self.task_index:
+            raise ValueError(f"{self.manifest_filename} lists {task_id}, which is not in the dataset")
+        return sample // self.mlp_samples, self.task_index[task_id], sample % self.mlp_samples
+
+    def __len__(self):
+        return len(self.done) + len(self.pending)
+
+    def owns(self, sample_no, idx):
+        """
+        Whether sample `sample_no` of task `idx` is generated by this worker. Workers take the tasks round-robin,
+        shifted by one for every sample, so that all of them get a share of the tasks and of the samples.
+        """
+        return (sample_no + idx) % self.num_workers == self.rank
+
+    def is_done(self, key):
+        return key in self.done
+
+    def add(self, key, sample):
+        self.pending.append((key, sample))
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        with open(self.filename, 'ab') as fp:
+            for _, sample in self.pending:
+                fp.write((json.dumps(sample) + "\n").encode('utf-8'))
+            fp.flush()
+            os.fsync(fp.fileno())
+            offset = fp.tell()
+
+        keys = [key for key, _ in self.pending]
+        self._append_manifest(keys, offset)
+        self.completed.extend(keys)
+        self.done.update(keys)
+        self.pending = []
+
+    def _manifest_entry(self, keys, offset):
+        entry = dict(completed=[self._to_manifest(key) for key in keys], offset=offset)
+        return (json.dumps(entry) + "\n").encode('utf-8')
+
+    def _append_manifest(self, keys, offset):
+        with open(self.manifest_filename, 'ab') as fp:
+            fp.write(self._manifest_entry(keys, offset))
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def finalize(self):
+        """
+        Rewrites the output (and the manifest) sorted by key, once. Returns the samples.
+
+        Both files are written to temporary files first, then the output and the manifest replace the old ones, in
+        that order: a crash at any point leaves either the old pair, or the new output and a manifest that the next
+        `ResumableOutput` moves in place.
+        """
+        self.flush()
+        samples = list(stream_jsonl(self.filename))
+        order = sorted(range(len(samples)), key=lambda i: self.completed[i])
+        samples = [samples[i] for i in order]
+        completed = [self.completed[i] for i in order]
+
+        with open(self.tmp_filename, 'wb') as fp:
+            for sample in samples:
+                fp.write((json.dumps(sample) + "\n").encode('utf-8'))
+            fp.flush()
+            os.fsync(fp.fileno())
+            offset = fp.tell()
+        with open(self.tmp_manifest_filename, 'wb') as fp:
+            fp.write(self._manifest_entry(completed, offset))
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        os.replace(self.tmp_filename, self.filename)
+        os.replace(self.tmp_manifest_filename, self.manifest_filename)
+        directory = os.open(os.path.dirname(os.path.abspath(self.filename)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.completed = completed
+        return samples
@@ -22,6 +22,7 @@ import os
 from tokenization import tokenization_function, tokenization_function_raw
 import random
 import pickle
+from vocab_partition import VocabPartition, ReplicatedTokensRemapper
 
 
 @dataclass
@@ -156,6 +157,9 @@ def main(args):
 
 	with open(os.path.join(args.main_dir, f'{args.save_name}', 'replicated_tokens_map.pkl'), 'wb') as f:
 		pickle.dump(args.replicated_tokens_map, f)
+	# precomputed docstring/code split, so that the models do not rebuild it from the map at load time
+	vocab_partition = VocabPartition.from_replicated_tokens_map(args.replicated_tokens_map, len(tokenizer))
+	vocab_partition.save(os.path.join(args.main_dir, args.save_name))
 
 	if 'pycodegpt' in args.model_name_or_path:
 		tok_func = tokenization_function_raw
@@ -173,7 +177,7 @@ def main(args):
 		fn_kwargs={
 			'max_seq_length': args.max_seq_length,
 			'tokenizer': tokenizer,
-			'new_id_map': args.replicated_tokens_map
+			'new_id_map': ReplicatedTokensRemapper.from_partition(vocab_partition)
 		}
 	)
 	print(tokenized_data)
@@ -15,8 +15,8 @@
 # limitations under the License.
 # ============================================================================
 
-import copy
 import logging
+from vocab_partition import as_remapper
 
 logger = logging.getLogger(__name__)
 
@@ -28,19 +28,15 @@ def tokenization_function(examples, tokenizer=None, max_seq_length=1024, new_id_
 	my_examples = {"input_ids": [], "code_mask": [], "docstr_mask": [], "special_tokens_mask": [],
 				   "prefix_lm_token_idx": [], "length": []}
 
-	for _id, docstring, code in zip(examples["_id"], examples["docstring"], examples["code"]):
+	# code tokens of the whole batch are replaced by their replicas at once
+	batch_code_ids = [tokenizer.encode(code, add_special_tokens=False) for code in examples["code"]]
+	remapper = as_remapper(new_id_map)
+	if remapper is not None:
+		batch_code_ids = remapper.remap_batch(batch_code_ids)
+
+	for _id, docstring, code_ids in zip(examples["_id"], examples["docstring"], batch_code_ids):
 		pre_docstring_ids = [tokenizer.convert_tokens_to_ids('<comments>')]
 		docstring_ids = tokenizer.encode(docstring, add_special_tokens=False)
-		code_ids = tokenizer.encode(code, add_special_tokens=False)
-
-		if new_id_map is not None:
-			new_code_ids = []
-			for cid in code_ids:
-				if cid in new_id_map:
-					new_code_ids.append(new_id_map[cid])
-				else:
-					new_code_ids.append(cid)
-			code_ids = copy.deepcopy(new_code_ids)
 
 		pre_code_ids = [tokenizer.convert_tokens_to_ids('<python>')]
 		end_of_seq = [tokenizer.convert_tokens_to_ids('<eot>')]
@@ -85,9 +81,9 @@ def tokenization_function_raw(examples, tokenizer=None, max_seq_length=1024, new
 	my_examples = {"input_ids": [], "code_mask": [], "docstr_mask": [], "special_tokens_mask": [],
 				   "prefix_lm_token_idx": [], "length": []}
 
+	batch_docstring_ids, batch_signature_ids, batch_code_ids = [], [], []
 	for _id, docstring, code in zip(examples["_id"], examples["docstring"], examples["code"]):
 		# Handle empty docstring
-		pre_docstring_ids = [tokenizer.convert_tokens_to_ids('<comments>')]
 		if "\n" in docstring:
 			doc = docstring.split('\n')
 			new_doc = []
@@ -123,27 +119,19 @@ def tokenization_function_raw(examples, tokenizer=None, max_seq_length=1024, new
 				# 'code' variable already contains the full code, so no change needed
 
 
-		code_ids = tokenizer.encode(code, add_special_tokens=False)
-		pre_sign_ids = [tokenizer.convert_tokens_to_ids('<|beginoftext|>')]
-		signature_ids = tokenizer.encode(signature, add_special_tokens=False)
-
-		if new_id_map is not None:
-			new_code_ids = []
-			for cid in code_ids:
-				if cid in new_id_map:
-					new_code_ids.append(new_id_map[cid])
-				else:
-					new_code_ids.append(cid)
-			code_ids = copy.deepcopy(new_code_ids)
-
-			new_sign_ids = []
-			for sid in signature_ids:
-				if sid in new_id_map:
-					new_sign_ids.append(new_id_map[sid])
-				else:
-					new_sign_ids.append(sid)
-			signature_ids = copy.deepcopy(new_sign_ids)
+		batch_docstring_ids.append(docstring_ids)
+		batch_code_ids.append(tokenizer.encode(code, add_special_tokens=False))
+		batch_signature_ids.append(tokenizer.encode(signature, add_special_tokens=False))
+
+	# code and signature tokens of the whole batch are replaced by their replicas at once
+	remapper = as_remapper(new_id_map)
+	if remapper is not None:
+		remapped = remapper.remap_batch(batch_code_ids + batch_signature_ids)
+		batch_code_ids, batch_signature_ids = remapped[:len(batch_code_ids)], remapped[len(batch_code_ids):]
 
+	for docstring_ids, signature_ids, code_ids in zip(batch_docstring_ids, batch_signature_ids, batch_code_ids):
+		pre_docstring_ids = [tokenizer.convert_tokens_to_ids('<comments>')]
+		pre_sign_ids = [tokenizer.convert_tokens_to_ids('<|beginoftext|>')]
 		pre_code_ids = [tokenizer.convert_tokens_to_ids('<python>')]
 		end_of_seq = [tokenizer.convert_tokens_to_ids('<eot>')]
 
@@ -0,0 +1,197 @@
+# Copyright (C) 2024. Huawei Technologies Co., Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+
+import os
+import itertools
+import logging
+from typing import Dict, List, Optional
+import numpy as np
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+VOCAB_PARTITION_FILE = 'vocab_partition.npz'
+
+
+class VocabPartition:
+    """
+    Split of a replicated vocabulary into its docstring and code parts, built once from `replicated_tokens_map`
+    (docstring id -> code id) and stored as arrays over the vocabulary:
+
+        replica_ids: code id of every replicated docstring token, -1 for the others
+        source_ids:  docstring id of every code replica, -1 for the others
+        doc_mask:    tokens that can appear in docstrings (everything but the code replicas)
+        code_mask:   tokens that can appear in code (everything but the replicated docstring tokens)
+    """
+
+    def __init__(self, replica_ids: np.ndarray, source_ids: np.ndarray):
+        self.replica_ids = replica_ids
+        self.source_ids = source_ids
+        self.doc_mask = source_ids < 0
+        self.code_mask = replica_ids < 0
+
+    @property
+    def vocab_size(self):
+        return self.replica_ids.shape[0]
+
+    @property
+    def num_replicated(self):
+        return int((self.replica_ids >= 0).sum())
+
+    @classmethod
+    def from_replicated_tokens_map(cls, replicated_tokens_map: Dict[int, int], vocab_size: int):
+        doc_ids = np.fromiter(replicated_tokens_map.keys(), dtype=np.int64, count=len(replicated_tokens_map))
+        code_ids = np.fromiter(replicated_tokens_map.values(), dtype=np.int64, count=len(replicated_tokens_map))
+        if len(doc_ids) and max(doc_ids.max(), code_ids.max()) >= vocab_size:
+            raise ValueError(f"The replicated tokens map has ids beyond the vocabulary size {vocab_size}")
+
+        replica_ids = np.full((vocab_size,), -1, dtype=np.int64)
+        source_ids = np.full((vocab_size,), -1, dtype=np.int64)
+        replica_ids[doc_ids] = code_ids
+        source_ids[code_ids] = doc_ids
+        return cls(replica_ids, source_ids)
+
+    def to_replicated_tokens_map(self) -> Dict[int, int]:
+        doc_ids = np.nonzero(self.replica_ids >= 0)[0]
+        return dict(zip(doc_ids.tolist(), self.replica_ids[doc_ids].tolist()))
+
+    def token_masks(self):
+        """
+        `(code_tokens_mask, doc_tokens_mask)` float tensors, as registered by the models
+        """
+        return torch.from_numpy(self.code_mask).float(), torch.from_numpy(self.doc_mask).float()
+
+    def save(self, directory: str):
+        path = os.path.join(directory, VOCAB_PARTITION_FILE)
+        np.savez(path, replica_ids=self.replica_ids, source_ids=self.source_ids)
+        return path
+
+    @classmethod
+    def load(cls, path: str):
+        if os.path.isdir(path):
+            path = os.path.join(path, VOCAB_PARTITION_FILE)
+        with np.load(path) as arrays:
+            return cls(arrays['replica_ids'], arrays['source_ids'])
+
+
+class ReplicatedTokensRemapper:
+    """
+    Maps docstring token ids to their code replicas (ids without a replica are kept) with a dense lookup table over
+    the vocabulary, so that a list, an array, a tensor, a batch of lists or an Arrow list column is remapped with a
+    single gather. Ids outside the table (e.g. -100 labels) are kept as well.
+    """
+
+    def __init__(self, replicated_tokens_map: Optional[Dict[int, int]] = None, vocab_size: int = 0,
+                 table: Optional[np.ndarray] = None):
+        if table is None:
+            replicated_tokens_map = replicated_tokens_map or {}
+            doc_ids = np.fromiter(replicated_tokens_map.keys(), dtype=np.int64, count=len(replicated_tokens_map))
+            code_ids = np.fromiter(replicated_tokens_map.values(), dtype=np.int64, count=len(replicated_tokens_map))
+            size = max(vocab_size, int(doc_ids.max()) + 1 if len(doc_ids) else 0)
+            table = np.arange(size, dtype=np.int64)
+            table[doc_ids] = code_ids
+        self.table = table
+        self._torch_tables = {}
+
+    @classmethod
+    def from_partition(cls, partition: VocabPartition):
+        replica_ids = partition.replica_ids
+        return cls(table=np.where(replica_ids >= 0, replica_ids, np.arange(replica_ids.shape[0])))
+
+    def __len__(self):
+        return self.table.shape[0]
+
+    def _gather(self, ids: np.ndarray) -> np.ndarray:
+        ids = np.asarray(ids, dtype=np.int64)
+        inside = (ids >= 0) & (ids < len(self))
+        if inside.all():
+            return self.table[ids]
+        if len(self) == 0:
+            return ids.copy()
+        return np.where(inside, self.table[np.clip(ids, 0, len(self) - 1)], ids)
+
+    def _gather_tensor(self, ids: torch.Tensor) -> torch.Tensor:
+        if len(self) == 0:
+            return ids.clone()
+        if ids.device not in self._torch_tables:
+            self._torch_tables[ids.device] = torch.from_numpy(self.table).to(ids.device)
+        table = self._torch_tables[ids.device]
+        inside = (ids >= 0) & (ids < len(self))
+        return torch.where(inside, table[ids.clamp(0, len(self) - 1)].to(ids.dtype), ids)
+
+    def __call__(self, ids):
+        """
+        Remaps a list of ids (returns a list), an array or a tensor of any shape
+        """
+        if isinstance(ids, torch.Tensor):
+            return self._gather_tensor(ids)
+        if isinstance(ids, np.ndarray):
+            return self._gather(ids)
+        return self._gather(ids).tolist()
+
+    def remap_batch(self, batch: List[List[int]]) -> List[List[int]]:
+        """
+        Remaps a batch of id lists of different lengths at once
+        """
+        if not batch:
+            return []
+        lengths = [len(ids) for ids in batch]
+        remapped = self._gather(np.fromiter(itertools.chain.from_iterable(batch), dtype=np.int64, count=sum(lengths)))
+        return [chunk.tolist() for chunk in np.split(remapped, np.cumsum(lengths)[:-1])]
+
+    def remap_arrow(self, column):
+        """
+        Remaps a `pyarrow` list column (`ListArray` or `ChunkedArray` of lists) on its flat values, keeping the offsets
+        """
+        import pyarrow as pa
+
+        if isinstance(column, pa.ChunkedArray):
+            return pa.chunked_array([self.remap_arrow(chunk) for chunk in column.chunks])
+        # `flatten` accounts for the offset of sliced arrays, `offsets` are rebased on it
+        values = self._gather(column.flatten().to_numpy(zero_copy_only=False))
+        offsets = column.offsets.to_numpy(zero_copy_only=False)
+        offsets = offsets - offsets[0]
+        return pa.ListArray.from_arrays(pa.array(offsets, type=pa.int32()), pa.array(values))
+
+
+def as_remapper(new_id_map, vocab_size: int = 0) -> Optional[ReplicatedTokensRemapper]:
+    """
+    `ReplicatedTokensRemapper` of a `replicated_tokens_map` (`None` stays `None`, remappers are returned as is)
+    """
+    if new_id_map is None or isinstance(new_id_map, ReplicatedTokensRemapper):
+        return new_id_map
+    return ReplicatedTokensRemapper(new_id_map, vocab_size=vocab_size)
+
+
+def build_token_masks(args, vocab_size: int):
+    """
+    Code and docstring token masks of the models: from the saved `args.vocab_partition` if there is one matching the
+    vocabulary, from `args.replicated_tokens_map` otherwise. Both are left empty without replicated tokens.
+    """
+    replicated_tokens_map = getattr(args, 'replicated_tokens_map', None)
+    if not replicated_tokens_map:
+        return torch.zeros((vocab_size,)), torch.zeros((vocab_size,))
+
+    partition: Optional[VocabPartition] = getattr(args, 'vocab_partition', None)
+    if partition is not None and (partition.vocab_size != vocab_size or
+                                  partition.num_replicated != len(replicated_tokens_map)):
+        logger.warning(f"The saved vocabulary partition ({partition.vocab_size} tokens, {partition.num_replicated} "
+                       f"replicated) does not match the vocabulary ({vocab_size} tokens, "
+                       f"{len(replicated_tokens_map)} replicated), rebuilding it")
+        partition = None
+    if partition is None:
+        partition = VocabPartition.from_replicated_tokens_map(replicated_tokens_map, vocab_size)
+    return partition.token_masks()
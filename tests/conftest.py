@@ -0,0 +1,54 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the scripts of source/ import each other as top-level modules, the models import them as `source.xxx`
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'source'))
+
+VOCAB_SIZE = 512
+
+
+class VocabStub:
+    """
+    Stands in for the tokenizer in the model constructors, which only need its length
+    """
+    def __init__(self, vocab_size):
+        self.vocab_size = vocab_size
+
+    def __len__(self):
+        return self.vocab_size
+
+
+@pytest.fixture
+def random_model():
+    """
+    Builds a 2-layer random GPT-Neo (`pycodegpt`, a global then a local layer) or PanGu-Alpha model in eval mode
+    """
+    from gpt_neo import GPTNeoConfig, GPTNeoForCausalLM
+    from pangu_alpha import PanguAlphaConfig, PanguAlphaModel
+
+    def build(model_type='pycodegpt', seed=0, window_size=16, replicated_tokens_map=None):
+        torch.manual_seed(seed)
+        model_args = SimpleNamespace(replicated_tokens_map=replicated_tokens_map)
+        if model_type == 'pangu':
+            config = PanguAlphaConfig(vocab_size=VOCAB_SIZE, n_positions=128, n_embd=64, n_layer=2, n_head=4)
+            model = PanguAlphaModel(config, args=model_args, tokenizer=VocabStub(VOCAB_SIZE))
+        else:
+            config = GPTNeoConfig(
+                vocab_size=VOCAB_SIZE,
+                max_position_embeddings=128,
+                hidden_size=64,
+                num_layers=2,
+                attention_types=[[["global", "local"], 1]],
+                num_heads=4,
+                window_size=window_size,
+            )
+            model = GPTNeoForCausalLM(config, args=model_args, tokenizer=VocabStub(VOCAB_SIZE))
+        return model.eval()
+
+    return build
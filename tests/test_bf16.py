@@ -0,0 +1,97 @@
+import copy
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from gpt2.configuration_gpt2 import GPT2Config
+from gpt2.modeling_gpt2 import GPT2LMHeadModel
+from gpt_neo import GPTNeoConfig, GPTNeoForCausalLM
+from pangu_alpha import PanguAlphaConfig, PanguAlphaModel
+
+VOCAB_SIZE = 512
+BATCH_SIZE, LENGTH = 4, 48
+
+
+class _VocabStub:
+    def __init__(self, vocab_size):
+        self.vocab_size = vocab_size
+
+    def __len__(self):
+        return self.vocab_size
+
+
+def _random_model(model_type):
+    model_args = SimpleNamespace(replicated_tokens_map=None)
+    if model_type == 'pangu':
+        config = PanguAlphaConfig(vocab_size=VOCAB_SIZE, n_positions=128, n_embd=64, n_layer=2, n_head=4)
+        model = PanguAlphaModel(config, args=model_args, tokenizer=_VocabStub(VOCAB_SIZE))
+    elif model_type == 'pycodegpt':
+        config = GPTNeoConfig(
+            vocab_size=VOCAB_SIZE,
+            max_position_embeddings=128,
+            hidden_size=64,
+            num_layers=2,
+            attention_types=[[["global", "local"], 1]],
+            num_heads=4,
+            window_size=16,
+        )
+        model = GPTNeoForCausalLM(config, args=model_args, tokenizer=_VocabStub(VOCAB_SIZE))
+    else:
+        model = GPT2LMHeadModel(GPT2Config(vocab_size=VOCAB_SIZE, n_positions=128, n_embd=64, n_layer=2, n_head=4))
+    return model.eval()
+
+
+@pytest.fixture(params=['pycodegpt', 'pangu', 'gpt2'])
+def model(request):
+    torch.manual_seed(0)
+    return _random_model(request.param)
+
+
+@pytest.fixture
+def input_ids():
+    return torch.randint(1, VOCAB_SIZE, (BATCH_SIZE, LENGTH), generator=torch.Generator().manual_seed(0))
+
+
+def test_bf16_logits_match_fp32(model, input_ids):
+    bf16_model = copy.deepcopy(model).to(torch.bfloat16)
+    with torch.no_grad():
+        logits = model(input_ids=input_ids).logits
+        bf16_logits = bf16_model(input_ids=input_ids).logits
+
+    assert torch.isfinite(bf16_logits).all()
+    error = (bf16_logits.float() - logits).abs().max() / logits.abs().max()
+    assert error < 0.05, f"bf16 logits are {100 * error:.1f}% off the fp32 ones"
+
+
+def test_bf16_autocast_loss_is_fp32(model, input_ids):
+    model.train()
+    torch.manual_seed(0)
+    loss = model(input_ids=input_ids, labels=input_ids).loss
+    torch.manual_seed(0)
+    with torch.autocast(device_type='cpu', dtype=torch.bfloat16):
+        autocast_loss = model(input_ids=input_ids, labels=input_ids).loss
+
+    assert autocast_loss.dtype == torch.float32, "the loss is not computed in fp32 under autocast"
+    assert abs(autocast_loss.item() - loss.item()) / loss.item() < 0.01
+
+
+@pytest.mark.parametrize('model_type', ['pycodegpt', 'pangu'])
+def test_bf16_greedy_decoding_samples_fp32_logits(model_type, input_ids):
+    torch.manual_seed(0)
+    bf16_model = _random_model(model_type).to(torch.bfloat16)
+    scores = []
+    with torch.no_grad():
+        outputs = bf16_model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=4,
+            min_length=LENGTH + 4,
+            do_sample=False,
+            pad_token_id=0,
+            eos_token_id=VOCAB_SIZE - 1,
+            logits_processor=[lambda ids, next_scores: scores.append(next_scores.dtype) or next_scores],
+        )
+
+    assert outputs.shape == (BATCH_SIZE, LENGTH + 4)
+    assert scores and all(dtype == torch.float32 for dtype in scores)
@@ -0,0 +1,55 @@
+import pytest
+import torch
+
+from conftest import VOCAB_SIZE
+
+HALF = VOCAB_SIZE // 2
+# the first half of the vocabulary replicated into the second one, which holds the code tokens
+REPLICATED_TOKENS_MAP = {token_id: token_id + HALF for token_id in range(HALF)}
+
+
+def _generate_kwargs(batch_size=3, prompt_length=16, max_new_tokens=10):
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(HALF, VOCAB_SIZE - 1, (batch_size, prompt_length), generator=generator)
+    return dict(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        max_new_tokens=max_new_tokens,
+        repetition_penalty=1.2,
+        pad_token_id=0,
+        eos_token_id=VOCAB_SIZE - 1,
+    )
+
+
+@pytest.mark.parametrize('model_type', ['pycodegpt', 'pangu'])
+def test_compact_vocab_matches_full_vocab(random_model, model_type):
+    model = random_model(model_type, replicated_tokens_map=REPLICATED_TOKENS_MAP)
+    kwargs = _generate_kwargs()
+    with torch.no_grad():
+        expected = model.generate(do_sample=False, **kwargs)
+        model.compact_vocabulary()
+        output = model.generate(do_sample=False, **kwargs)
+    assert model.compact_token_ids.numel() == HALF
+    assert torch.equal(output, expected)
+
+
+@pytest.mark.parametrize('model_type', ['pycodegpt', 'pangu'])
+def test_compact_vocab_samples_code_tokens(random_model, model_type):
+    model = random_model(model_type, replicated_tokens_map=REPLICATED_TOKENS_MAP).compact_vocabulary()
+    kwargs = _generate_kwargs()
+    with torch.no_grad():
+        output = model.generate(do_sample=True, top_p=0.9, **kwargs)
+    generated = output[:, kwargs['input_ids'].size(-1):]
+    assert bool(((generated >= HALF) | (generated == 0)).all())
+
+
+def test_saved_compact_vocab(random_model, tmp_path):
+    model = random_model(replicated_tokens_map=REPLICATED_TOKENS_MAP)
+    kwargs = _generate_kwargs()
+    with torch.no_grad():
+        expected = model.generate(do_sample=False, **kwargs)
+        model.save_compact_vocabulary(str(tmp_path / 'compact_vocab.pt'))
+        saved = torch.load(str(tmp_path / 'compact_vocab.pt'))
+        reloaded = random_model(replicated_tokens_map=REPLICATED_TOKENS_MAP).compact_vocabulary(**saved)
+        output = reloaded.generate(do_sample=False, **kwargs)
+    assert torch.equal(output, expected)
@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+import torch
+
+from custom_collator import create_attn_masks_and_pos, create_segment_ids_and_pos
+
+
+def _create_attn_masks_and_pos_loop(lengths, prefix_token_idxs):
+    """
+    Per-segment construction of the dense masks the collators used before the vectorized `create_attn_masks_and_pos`
+    """
+    b = len(lengths)
+    n = max([sum(l) for l in lengths])
+    attention_masks = torch.zeros((b, n, n))
+    position_ids = -100 * torch.ones((b, n)).long()
+    prefix_mask = torch.zeros((b, n, n)).long()
+
+    for i, l in enumerate(lengths):
+        csum_lengths = np.cumsum(l)
+        prefixes = prefix_token_idxs[i]
+
+        for j in range(len(csum_lengths)):
+            cur, prev = csum_lengths[j], csum_lengths[j - 1]
+            if j == 0:
+                attention_masks[i, :cur, :cur] = torch.tril(torch.ones(cur, cur))
+                prefix_mask[i, :prefixes[j]+1, :prefixes[j]+1] = 1
+
+                if len(csum_lengths) == 1:
+                    position_ids[i, :n] = torch.arange(0, n)
+                else:
+                    position_ids[i, :cur] = torch.arange(0, cur)
+            else:
+                attention_masks[i, prev:cur, prev:cur] = torch.tril(torch.ones(cur - prev, cur - prev))
+                prefix_mask[i, prev:prev + prefixes[j]+1, prev:prev + prefixes[j]+1] = 1
+
+                if j == len(csum_lengths) - 1:
+                    position_ids[i, prev:n] = torch.arange(0, n - prev)
+                else:
+                    position_ids[i, prev:cur] = torch.arange(0, cur - prev)
+
+    return attention_masks, position_ids, prefix_mask
+
+
+def _random_packed_lengths(rng, batch_size=4, max_length=128, max_prefix_overflow=0):
+    """
+    Document lengths and prefix indexes of packed rows of up to `max_length` tokens, as `concatenate_examples` builds
+    them. Prefix indexes go up to `max_prefix_overflow` tokens past the end of their document.
+    """
+    lengths, prefix_token_idxs = [], []
+    for _ in range(batch_size):
+        row_lengths, row_prefixes = [], []
+        while True:
+            length = int(rng.integers(2, max_length // 2))
+            if sum(row_lengths) + length > max_length:
+                break
+            row_lengths.append(length)
+            row_prefixes.append(int(rng.integers(0, length + max_prefix_overflow)))
+        lengths.append(row_lengths or [max_length])
+        prefix_token_idxs.append(row_prefixes or [max_length // 2])
+    return lengths, prefix_token_idxs
+
+
+def _assert_masks_equal(expected, actual):
+    for name, a, b in zip(('attention_masks', 'position_ids', 'prefix_mask'), expected, actual):
+        assert a.dtype == b.dtype and torch.equal(a, b), f"the vectorized collation changes the {name}"
+
+
+@pytest.mark.parametrize('single_document', [False, True])
+@pytest.mark.parametrize('seed', range(8))
+def test_masks_match_per_segment_construction(seed, single_document):
+    lengths, prefix_token_idxs = _random_packed_lengths(np.random.default_rng(seed))
+    if single_document:
+        lengths, prefix_token_idxs = [[sum(row)] for row in lengths], [[row[0]] for row in prefix_token_idxs]
+    _assert_masks_equal(
+        _create_attn_masks_and_pos_loop(lengths, prefix_token_idxs),
+        create_attn_masks_and_pos(lengths, prefix_token_idxs)
+    )
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_prefix_past_document_end_is_clamped(seed):
+    # the per-segment slices let such a prefix spill over the next document (or the padding), the vectorized masks
+    # keep it inside its own document, as if it ended on the last token of the document
+    lengths, prefix_token_idxs = _random_packed_lengths(np.random.default_rng(seed), max_prefix_overflow=16)
+    clamped = [[min(p, l - 1) for l, p in zip(row_lengths, row_prefixes)]
+               for row_lengths, row_prefixes in zip(lengths, prefix_token_idxs)]
+    _assert_masks_equal(
+        _create_attn_masks_and_pos_loop(lengths, clamped),
+        create_attn_masks_and_pos(lengths, prefix_token_idxs)
+    )
+
+
+def test_prefix_past_document_end_stays_in_document():
+    lengths, prefix_token_idxs = [[4, 3], [2, 2]], [[6, 1], [0, 5]]
+    attention_masks, _, prefix_mask = create_attn_masks_and_pos(lengths, prefix_token_idxs)
+
+    assert torch.equal(prefix_mask[0, :4, :4], torch.ones(4, 4).long())
+    assert torch.equal(prefix_mask[0, 4:, 4:], torch.tensor([[1, 1, 0], [1, 1, 0], [0, 0, 0]]))
+    assert not prefix_mask[0, :4, 4:].any() and not prefix_mask[0, 4:, :4].any()
+    # the prefix of the last document does not extend over the padding
+    assert torch.equal(prefix_mask[1, 2:4, 2:4], torch.ones(2, 2).long())
+    assert not prefix_mask[1, 4:].any() and not prefix_mask[1, :, 4:].any()
+    assert not (prefix_mask.bool() & ~attention_masks.bool() & ~attention_masks.bool().transpose(1, 2)).any()
+
+    # the per-segment slices spilled over the next document
+    _, _, loop_prefix_mask = _create_attn_masks_and_pos_loop(lengths, prefix_token_idxs)
+    assert loop_prefix_mask[0, :4, 4:].any()
+
+
+def test_segment_ids_mark_padding():
+    segment_ids, position_ids, prefix_flags = create_segment_ids_and_pos([[3, 2], [4]], [[1, 0], [5]])
+    assert torch.equal(segment_ids, torch.tensor([[0, 0, 0, 1, 1], [0, 0, 0, 0, -1]]))
+    assert torch.equal(position_ids, torch.tensor([[0, 1, 2, 0, 1], [0, 1, 2, 3, 4]]))
+    assert torch.equal(prefix_flags, torch.tensor([[True, True, False, True, False], [True, True, True, True, False]]))
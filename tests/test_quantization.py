@@ -0,0 +1,83 @@
+import copy
+
+import pytest
+import torch
+from torch import nn
+
+from quantization import WeightOnlyQuantizedLinear, DynamicInt8QuantizedLinear, quantize_model
+
+# packing the weights of the dynamic int8 matmul goes through the quantized tensors that torch deprecates
+dynamic_int8 = pytest.mark.filterwarnings('ignore:.*quantized tensor creation functions')
+
+
+@pytest.fixture
+def linear():
+    torch.manual_seed(0)
+    layer = nn.Linear(64, 96)
+    layer.weight.data.normal_(0, 0.02)
+    return layer
+
+
+@pytest.mark.parametrize('bits, group_size', [(8, None), (8, 16), (4, 16), (4, 64)])
+def test_dequantize_is_close_to_the_weight(linear, bits, group_size):
+    quantized = WeightOnlyQuantizedLinear.from_float(linear, bits=bits, group_size=group_size)
+    error = (quantized.dequantize() - linear.weight).norm() / linear.weight.norm()
+    assert error < (0.01 if bits == 8 else 0.15)
+
+
+@pytest.mark.parametrize('bits, group_size', [(8, None), (4, 16)])
+def test_weight_only_forward_is_exact_on_the_dequantized_weight(linear, bits, group_size):
+    quantized = WeightOnlyQuantizedLinear.from_float(linear, bits=bits, group_size=group_size)
+    x = torch.randn(3, 5, 64)
+    with torch.no_grad():
+        expected = nn.functional.linear(x, quantized.dequantize(), quantized.bias)
+        assert torch.allclose(quantized(x), expected, atol=1e-6)
+
+
+@dynamic_int8
+def test_dynamic_forward_is_close_to_the_dequantized_weight(linear):
+    quantized = DynamicInt8QuantizedLinear.from_float(linear)
+    # tokens of very different magnitudes, which the dynamic int8 matmul quantizes with a scale each
+    x = torch.randn(3, 5, 64) * torch.logspace(-2, 2, 5)[:, None]
+    with torch.no_grad():
+        expected = nn.functional.linear(x, quantized.dequantize(), quantized.bias)
+        output = quantized(x)
+    assert output.shape == expected.shape
+    error = (output - expected).norm(dim=-1) / expected.norm(dim=-1)
+    assert error.max() < 0.02
+
+
+@dynamic_int8
+def test_packed_weight_follows_load_state_dict(linear):
+    quantized = DynamicInt8QuantizedLinear.from_float(linear)
+    other = copy.deepcopy(quantized)
+    other.qweight.copy_(-other.qweight)
+    other.bias.data.mul_(2)
+    x = torch.randn(4, 64)
+    with torch.no_grad():
+        quantized(x)
+        quantized.load_state_dict(other.state_dict())
+        assert torch.allclose(quantized(x), other(x), atol=1e-6)
+
+
+def test_dynamic_int8_needs_a_scale_per_output_feature(linear):
+    with pytest.raises(ValueError):
+        DynamicInt8QuantizedLinear.from_float(linear, group_size=16)
+
+
+@pytest.mark.parametrize('mode, layer_class', [
+    ('int8', WeightOnlyQuantizedLinear),
+    ('int8_dynamic', DynamicInt8QuantizedLinear),
+    ('int4', WeightOnlyQuantizedLinear),
+])
+def test_quantize_model_records_the_mode(linear, mode, layer_class):
+    class GPT2MLP(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.c_fc = copy.deepcopy(linear)
+
+    model = nn.Sequential(GPT2MLP())
+    model.config = type('Config', (), {})()
+    quantize_model(model, mode)
+    assert type(model[0].c_fc) is layer_class
+    assert model.config.weight_quantization['mode'] == mode
@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+from resumable_output import ResumableOutput
+from utils import stream_jsonl
+
+TASK_IDS = ['task/0', 'task/1', 'task/2']
+
+
+def _generate(output, keys):
+    for key in keys:
+        sample_no, idx, _ = key
+        output.add(key, dict(task_id=TASK_IDS[idx], completion=f'sample {sample_no}'))
+        output.flush()
+
+
+def _unsorted_keys():
+    return [(1, 2, 0), (0, 1, 0), (1, 0, 0), (0, 2, 0), (0, 0, 0), (1, 1, 0)]
+
+
+def _expected_samples():
+    return [dict(task_id=TASK_IDS[idx], completion=f'sample {sample_no}')
+            for sample_no, idx, _ in sorted(_unsorted_keys())]
+
+
+def test_resume_skips_flushed_samples(tmp_path):
+    filename = str(tmp_path / 'samples.jsonl')
+    keys = _unsorted_keys()
+    _generate(ResumableOutput(filename, TASK_IDS, mlp_samples=1), keys[:4])
+
+    output = ResumableOutput(filename, TASK_IDS, mlp_samples=1, resume=True)
+    assert all(output.is_done(key) for key in keys[:4]) and not any(output.is_done(key) for key in keys[4:])
+    _generate(output, keys[4:])
+    assert output.finalize() == _expected_samples()
+    assert list(stream_jsonl(filename)) == _expected_samples()
+
+
+@pytest.mark.parametrize('crash_after', [0, 1])
+def test_finalize_survives_a_crash(tmp_path, monkeypatch, crash_after):
+    filename = str(tmp_path / 'samples.jsonl')
+    output = ResumableOutput(filename, TASK_IDS, mlp_samples=1)
+    _generate(output, _unsorted_keys())
+
+    replace, replaced = os.replace, []
+
+    def crashing_replace(src, dst):
+        if len(replaced) == crash_after:
+            raise KeyboardInterrupt
+        replaced.append(dst)
+        replace(src, dst)
+
+    monkeypatch.setattr(os, 'replace', crashing_replace)
+    with pytest.raises(KeyboardInterrupt):
+        output.finalize()
+    monkeypatch.setattr(os, 'replace', replace)
+
+    resumed = ResumableOutput(filename, TASK_IDS, mlp_samples=1, resume=True)
+    assert not os.path.exists(filename + '.tmp') and not os.path.exists(resumed.tmp_manifest_filename)
+    assert len(resumed) == len(_unsorted_keys())
+    assert resumed.finalize() == _expected_samples()
+    assert list(stream_jsonl(filename)) == _expected_samples()
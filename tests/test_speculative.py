@@ -0,0 +1,143 @@
+import copy
+
+import pytest
+import torch
+
+from conftest import VOCAB_SIZE
+from pangu_alpha.generation_utils import SpeculativeDecodingStats
+
+
+def _generate_kwargs(batch_size=3, prompt_length=16, max_new_tokens=10, repeated_span=0):
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(1, VOCAB_SIZE - 1, (batch_size, prompt_length - repeated_span), generator=generator)
+    # a prompt ending with a span of its beginning, for prompt lookup to have something to copy
+    input_ids = torch.cat([input_ids, input_ids[:, :repeated_span]], dim=-1)
+    return dict(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        max_new_tokens=max_new_tokens,
+        min_length=prompt_length + max_new_tokens,
+        pad_token_id=0,
+        eos_token_id=VOCAB_SIZE - 1,
+    )
+
+
+def _early_eos_kwargs(kwargs, greedy_outputs):
+    # the second token of the first row ends it, the other rows go on
+    prompt_length = kwargs['input_ids'].size(-1)
+    early_kwargs = dict(kwargs, eos_token_id=int(greedy_outputs[0, prompt_length + 1]))
+    early_kwargs.pop('min_length')
+    return early_kwargs
+
+
+@pytest.mark.parametrize('proposer', ['draft_model', 'prompt_lookup'])
+@pytest.mark.parametrize('do_sample', [False, True])
+def test_return_dict_in_generate(random_model, do_sample, proposer):
+    model = random_model()
+    if proposer == 'draft_model':
+        speculation = dict(draft_model=random_model(seed=1))
+    else:
+        speculation = dict(prompt_lookup_ngram_size=2)
+    kwargs = _generate_kwargs()
+    with torch.no_grad():
+        expected = model.generate(do_sample=do_sample, output_scores=True, return_dict_in_generate=True, **kwargs)
+        output = model.generate(
+            do_sample=do_sample, output_scores=True, return_dict_in_generate=True, **speculation, **kwargs
+        )
+
+    assert type(output) is type(expected)
+    assert output.sequences.shape == expected.sequences.shape
+    assert len(output.scores) == len(expected.scores) == kwargs['max_new_tokens']
+    if not do_sample:
+        assert torch.equal(output.sequences, expected.sequences)
+        for scores, expected_scores in zip(output.scores, expected.scores):
+            assert torch.allclose(scores, expected_scores, atol=1e-5, equal_nan=True)
+
+
+def test_return_dict_without_scores(random_model):
+    with torch.no_grad():
+        output = random_model().generate(
+            do_sample=False, prompt_lookup_ngram_size=2, return_dict_in_generate=True, **_generate_kwargs()
+        )
+    assert output.scores is None and output.sequences.shape == (3, 26)
+
+
+def test_attentions_are_not_returned(random_model):
+    with pytest.raises(ValueError):
+        random_model().generate(
+            do_sample=False, prompt_lookup_ngram_size=2, output_attentions=True, return_dict_in_generate=True,
+            **_generate_kwargs()
+        )
+
+
+@pytest.mark.parametrize('model_type', ['pycodegpt', 'pangu'])
+def test_draft_model_matches_greedy(random_model, model_type):
+    model, draft_model = random_model(model_type), random_model(seed=1)
+    kwargs = _generate_kwargs()
+    with torch.no_grad():
+        expected = model.generate(do_sample=False, **kwargs)
+        output = model.generate(do_sample=False, draft_model=draft_model, num_draft_tokens=3, **kwargs)
+    assert torch.equal(output, expected)
+
+
+def test_self_speculation_accepts_every_token(random_model):
+    model = random_model()
+    kwargs = _generate_kwargs()
+    stats = SpeculativeDecodingStats()
+    with torch.no_grad():
+        expected = model.generate(do_sample=False, **kwargs)
+        output = model.generate(
+            do_sample=False, draft_model=model, num_draft_tokens=3, speculative_stats=stats, **kwargs
+        )
+    assert torch.equal(output, expected)
+    assert stats.acceptance_rate == 1.0
+
+
+def test_draft_model_early_eos(random_model):
+    model = random_model()
+    num_draft_tokens = 3
+    kwargs = _generate_kwargs()
+    with torch.no_grad():
+        kwargs = _early_eos_kwargs(kwargs, model.generate(do_sample=False, **kwargs))
+        expected = model.generate(do_sample=False, **kwargs)
+        # a copy of the target that only gets the padding fed to the finished rows wrong
+        padding_draft = copy.deepcopy(model)
+        padding_noise = torch.randn(model.config.hidden_size)
+        padding_draft.transformer.wte.register_forward_hook(
+            lambda module, inputs, output: output + (inputs[0] == 0)[..., None] * padding_noise
+        )
+        stats = SpeculativeDecodingStats()
+        output = model.generate(
+            do_sample=False, draft_model=padding_draft, num_draft_tokens=num_draft_tokens, speculative_stats=stats,
+            **kwargs
+        )
+    assert torch.equal(output, expected)
+    # the other rows keep advancing by all the proposed tokens, plus one forward for a row generating the padding
+    max_forwards = -(-(expected.size(-1) - kwargs['input_ids'].size(-1)) // (num_draft_tokens + 1)) + 1
+    assert stats.target_forwards <= max_forwards
+
+
+@pytest.mark.parametrize('model_type', ['pycodegpt', 'pangu'])
+def test_prompt_lookup_matches_greedy(random_model, model_type):
+    model = random_model(model_type)
+    kwargs = _generate_kwargs(prompt_length=24, repeated_span=6)
+    with torch.no_grad():
+        expected = model.generate(do_sample=False, **kwargs)
+        output = model.generate(do_sample=False, prompt_lookup_ngram_size=2, num_draft_tokens=3, **kwargs)
+    assert torch.equal(output, expected)
+
+
+def test_prompt_lookup_early_eos(random_model):
+    model = random_model()
+    kwargs = _generate_kwargs(prompt_length=24, repeated_span=6)
+    lookup_kwargs = dict(prompt_lookup_ngram_size=2, num_draft_tokens=3)
+    with torch.no_grad():
+        stats = SpeculativeDecodingStats()
+        greedy_outputs = model.generate(do_sample=False, speculative_stats=stats, **lookup_kwargs, **kwargs)
+        kwargs = _early_eos_kwargs(kwargs, greedy_outputs)
+        expected = model.generate(do_sample=False, **kwargs)
+        early_stats = SpeculativeDecodingStats()
+        output = model.generate(do_sample=False, speculative_stats=early_stats, **lookup_kwargs, **kwargs)
+    assert torch.equal(output, expected)
+    # the padding of the finished row never matches, which must not cost the other rows forward passes
+    assert early_stats.target_forwards <= stats.target_forwards
@@ -0,0 +1,67 @@
+import pytest
+import torch
+
+from conftest import VOCAB_SIZE
+
+
+def _generate_kwargs(batch_size=3, prompt_length=16, max_new_tokens=10):
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(1, VOCAB_SIZE - 1, (batch_size, prompt_length), generator=generator)
+    return dict(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        max_new_tokens=max_new_tokens,
+        pad_token_id=0,
+        eos_token_id=VOCAB_SIZE - 1,
+    )
+
+
+@pytest.mark.parametrize('model_type', ['pycodegpt', 'pangu'])
+def test_static_cache_matches_tuple_cache(random_model, model_type):
+    model = random_model(model_type, window_size=256)
+    kwargs = _generate_kwargs()
+    with torch.no_grad():
+        expected = model.generate(do_sample=False, static_cache=False, **kwargs)
+        output = model.generate(do_sample=False, static_cache=True, **kwargs)
+    assert torch.equal(output, expected)
+
+
+@pytest.mark.parametrize('model_type', ['pycodegpt', 'pangu'])
+def test_static_cache_sampling(random_model, model_type):
+    model = random_model(model_type, window_size=256)
+    kwargs = _generate_kwargs()
+    with torch.no_grad():
+        torch.manual_seed(1)
+        expected = model.generate(do_sample=True, static_cache=False, **kwargs)
+        torch.manual_seed(1)
+        output = model.generate(do_sample=True, static_cache=True, **kwargs)
+    assert torch.equal(output, expected)
+
+
+def test_sliding_window_cache(random_model):
+    # prompts longer than the window, left padded, with a prefix-LM index
+    model = random_model(window_size=8)
+    batch_size, prompt_length, max_new_tokens = 4, 24, 12
+    prompt_lengths = torch.tensor([prompt_length, 20, 14, 17])
+    prompt_mask = (torch.arange(prompt_length)[None, :] >= (prompt_length - prompt_lengths)[:, None]).long()
+    prefix_lm_mask = prompt_length - prompt_lengths + torch.tensor([3, 0, 5, 2])
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(1, VOCAB_SIZE - 1, (batch_size, prompt_length), generator=generator) * prompt_mask
+    kwargs = dict(
+        input_ids=input_ids,
+        attention_mask=prompt_mask,
+        prefix_lm_mask=prefix_lm_mask,
+        max_new_tokens=max_new_tokens,
+        min_length=prompt_length + max_new_tokens,
+        do_sample=False,
+        pad_token_id=0,
+        eos_token_id=VOCAB_SIZE - 1,
+    )
+
+    cache = model.init_static_cache(batch_size, prompt_length + max_new_tokens, prefix_lm_mask)
+    # GPT-Neo imports the cache classes as `source.pangu_alpha`, so the sliding window layers are told by attribute
+    assert [hasattr(layer, 'key_positions') for layer in cache] == [False, True]
+    with torch.no_grad():
+        expected = model.generate(**kwargs)
+        output = model.generate(past=cache, **kwargs)
+    assert torch.equal(output, expected)